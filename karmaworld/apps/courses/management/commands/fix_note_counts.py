@@ -2,8 +2,9 @@ from django.core.management.base import BaseCommand
 from karmaworld.apps.courses.tasks import fix_note_counts
 
 class Command(BaseCommand):
-    help = """Set the field file_count on every Course and School
-            to the correct value."""
+    help = """Set the fields file_count and thank_count on every Course
+            and School to the correct value, and report how far they
+            had drifted."""
 
     def handle(self, *args, **kwargs):
         fix_note_counts()
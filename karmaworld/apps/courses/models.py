@@ -8,10 +8,16 @@
     Courses are the first class object, they contain notes.
     Courses have a manytoone relation to schools.
 """
+import uuid
+import hashlib
 import datetime
 import reversion
 
+from django.core.cache import cache
 from django.db import models
+from django.db.models import F, Q, Sum
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.text import slugify
 from django.core.urlresolvers import reverse
 from karmaworld.settings.manual_unique_together import auto_add_check_unique_together
@@ -92,14 +98,10 @@ class School(models.Model):
         """ Update the School.file_count by summing the
             contained course.file_count
         """
-        # find all courses without a department
-        course_list = set(self.course_set.all())
-        # find all courses with a department
-        for department in self.department_set.all():
-            for course in department.course_set.all():
-                course_list.add(course)
-        self.file_count = sum([course.file_count for course in course_list])
-        self.save()
+        # courses with or without a department
+        courses = Course.objects.filter(Q(school=self) | Q(department__school=self))
+        self.file_count = courses.aggregate(total=Sum('file_count'))['total'] or 0
+        School.objects.filter(pk=self.pk).update(file_count=self.file_count)
 
 @register_channel_name('school_object_by_name')
 class SchoolLookup(AnonLookupChannel):
@@ -275,6 +277,8 @@ class Course(models.Model):
         ordering = ['-file_count', 'school', 'name']
         unique_together = ('name', 'department')
         unique_together = ('name', 'school')
+        # for the sortable course list, which pages by (sort field, id)
+        index_together = [['updated_at', 'id'], ['file_count', 'id'], ['thank_count', 'id']]
         verbose_name = 'course'
         verbose_name_plural = 'courses'
 
@@ -312,16 +316,33 @@ class Course(models.Model):
         return ("name__icontains",)
 
     def update_note_count(self):
-        """ Update self.file_count by summing the note_set """
-        self.file_count = self.note_set.count()
-        self.save()
+        """ Update self.file_count by counting the visible note_set """
+        self.file_count = self.note_set.filter(is_hidden=False).count()
+        Course.objects.filter(pk=self.pk).update(file_count=self.file_count)
 
 
     def update_thank_count(self):
-        """ Update the thank_count by summing the note_set
+        """ Update the thank_count by summing the visible note_set
         """
-        self.thank_count = sum([note.thanks for note in self.note_set.all()])
-        self.save()
+        notes = self.note_set.filter(is_hidden=False)
+        self.thank_count = notes.aggregate(total=Sum('thanks'))['total'] or 0
+        Course.objects.filter(pk=self.pk).update(thank_count=self.thank_count)
+
+    @staticmethod
+    def change_note_counts(course_id, files, thanks):
+        """ Add files to the file_count of a course and its school, and
+            thanks to the thank_count of the course. Uses UPDATEs, so
+            concurrent changes are not lost.
+        """
+        if not files and not thanks:
+            return
+        Course.objects.filter(pk=course_id).update(file_count=F('file_count') + files,
+                                                   thank_count=F('thank_count') + thanks)
+        if files:
+            schools = Course.objects.filter(pk=course_id).values_list('school', 'department__school')
+            for school_id, department_school_id in schools:
+                School.objects.filter(pk=school_id or department_school_id)\
+                              .update(file_count=F('file_count') + files)
 
 
     def get_prof_names(self):
@@ -366,3 +387,61 @@ auto_add_check_unique_together(Course)
 auto_add_check_unique_together(School)
 auto_add_check_unique_together(Department)
 auto_add_check_unique_together(Professor)
+
+
+# Cached views of the course catalog use keys which include a version.
+# Changing a course, department or school replaces the version, so stale
+# entries are never read again and simply expire.
+CATALOG_VERSION_KEY = 'course_catalog_version'
+SCHOOL_DIRECTORY_KEY = 'school_directory:{0}'
+COURSE_COUNT_KEY = 'course_count:{0}:{1}'
+# Note counts change without replacing the version, so cached entries
+# are also rebuilt at least this often (seconds).
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+
+def catalog_version():
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set(CATALOG_VERSION_KEY, version, CATALOG_CACHE_TIMEOUT)
+    return version
+
+
+def get_school_directory():
+    """
+    Returns a list of dictionaries with the id, name, slug and file_count
+    of every school with courses, sorted by name.
+    """
+    key = SCHOOL_DIRECTORY_KEY.format(catalog_version())
+    directory = cache.get(key)
+    if directory is None:
+        schools = School.objects.filter(Q(course__isnull=False) |
+                                        Q(department__course__isnull=False))
+        directory = list(schools.distinct().order_by('name')
+                                .values('id', 'name', 'slug', 'file_count'))
+        cache.set(key, directory, CATALOG_CACHE_TIMEOUT)
+    return directory
+
+
+def get_course_count(queryset, name=''):
+    """
+    Returns the cached count of a queryset of courses. name must
+    identify the filters applied to the queryset.
+    """
+    key = COURSE_COUNT_KEY.format(catalog_version(), hashlib.md5(name.encode('utf-8')).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, CATALOG_CACHE_TIMEOUT)
+    return count
+
+
+@receiver(post_save, sender=School, weak=False)
+@receiver(post_delete, sender=School, weak=False)
+@receiver(post_save, sender=Department, weak=False)
+@receiver(post_delete, sender=Department, weak=False)
+@receiver(post_save, sender=Course, weak=False)
+@receiver(post_delete, sender=Course, weak=False)
+def invalidate_catalog(sender, **kwargs):
+    cache.set(CATALOG_VERSION_KEY, uuid.uuid4().hex, CATALOG_CACHE_TIMEOUT)
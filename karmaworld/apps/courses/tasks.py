@@ -1,21 +1,125 @@
+from django.db import connection, transaction
+from django.db.models import Max
+
 from karmaworld.apps.courses.models import Course
+from karmaworld.apps.courses.models import Department
 from karmaworld.apps.courses.models import School
+from karmaworld.apps.notes.models import Note
 
 from celery import task
 from celery.utils.log import get_task_logger
 
 logger = get_task_logger(__name__)
 
-@task(name="fix_note_counts")
-def fix_note_counts():
+# Rows are reconciled this many ids at a time, each range in its own
+# transaction, so the counters are never locked for long.
+FIX_COUNTS_CHUNK = 5000
+
+# Correct counts of the courses with ids in [%s, %s). Only visible notes
+# are counted, matching Course.change_note_counts.
+COURSE_COUNTS_SQL = """
+    SELECT course.id AS id,
+           count(note.id) AS file_count,
+           coalesce(sum(note.thanks), 0) AS thank_count
+    FROM {course} course
+    LEFT JOIN {note} note ON note.course_id = course.id AND note.is_hidden = %s
+    WHERE course.id >= %s AND course.id < %s
+    GROUP BY course.id
+""".format(course=Course._meta.db_table, note=Note._meta.db_table)
+
+# Correct counts of the schools with ids in [%s, %s). Courses belong to
+# their own school, or else the school of their department.
+SCHOOL_COUNTS_SQL = """
+    SELECT school.id AS id,
+           coalesce(sum(course.file_count), 0) AS file_count
+    FROM {school} school
+    LEFT JOIN (SELECT coalesce(c.school_id, d.school_id) AS school_id, c.file_count
+               FROM {course} c
+               LEFT JOIN {department} d ON d.id = c.department_id) course
+           ON course.school_id = school.id
+    WHERE school.id >= %s AND school.id < %s
+    GROUP BY school.id
+""".format(school=School._meta.db_table, course=Course._meta.db_table,
+           department=Department._meta.db_table)
+
+# Set the counts in one statement, returning the stored and correct values
+# of the rows that were wrong.
+POSTGRES_UPDATE_SQL = """
+    UPDATE {table} SET {assignments}
+    FROM ({counts}) counts, {table} stored
+    WHERE {table}.id = counts.id AND stored.id = counts.id AND ({differences})
+    RETURNING {returning}
+"""
+
+
+def _update_postgres(model, fields, counts_sql, params):
+    table = model._meta.db_table
+    sql = POSTGRES_UPDATE_SQL.format(
+        table=table, counts=counts_sql,
+        assignments=', '.join('{0} = counts.{0}'.format(f) for f in fields),
+        differences=' OR '.join('stored.{0} <> counts.{0}'.format(f) for f in fields),
+        returning=', '.join(['stored.{0}'.format(f) for f in fields] +
+                            ['counts.{0}'.format(f) for f in fields]))
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    return [(row[:len(fields)], row[len(fields):]) for row in cursor.fetchall()]
+
+
+def _update_generic(model, fields, counts_sql, params):
+    cursor = connection.cursor()
+    cursor.execute(counts_sql, params)
+    correct = dict((row[0], tuple(row[1:])) for row in cursor.fetchall())
+
+    low, high = params[-2:]
+    changes = []
+    for row in model.objects.filter(id__gte=low, id__lt=high).values_list('id', *fields):
+        stored, counts = tuple(row[1:]), correct[row[0]]
+        if stored != counts:
+            model.objects.filter(id=row[0]).update(**dict(zip(fields, counts)))
+            changes.append((stored, counts))
+    return changes
+
+
+def reconcile_counts(model, fields, counts_sql, params=()):
     """
-    Set the field file_count on every Course and School to the correct value.
+    Set fields on every row of model to the values selected by counts_sql
+    for ids in [%s, %s), after any params.
+    Returns the number of rows which were wrong and the total absolute
+    drift of each field.
     """
+    if connection.vendor == 'postgresql':
+        update = _update_postgres
+    else:
+        update = _update_generic
+
+    wrong = 0
+    drift = dict((field, 0) for field in fields)
+    max_id = model.objects.aggregate(Max('id'))['id__max'] or 0
+    for low in xrange(0, max_id + 1, FIX_COUNTS_CHUNK):
+        with transaction.commit_on_success():
+            changes = update(model, fields, counts_sql,
+                             list(params) + [low, low + FIX_COUNTS_CHUNK])
+        wrong += len(changes)
+        for stored, counts in changes:
+            for field, old, new in zip(fields, stored, counts):
+                drift[field] += abs(new - old)
+    return wrong, drift
 
-    for c in Course.objects.all():
-        c.update_note_count()
-        print "Updated course {c}".format(c=c)
 
-    for s in School.objects.all():
-        s.update_note_count()
-        print "Updated school {s}".format(s=s)
+@task(name="fix_note_counts")
+def fix_note_counts():
+    """
+    Set the fields file_count and thank_count on every Course and School
+    to the correct value, and report how far they had drifted.
+    """
+    # Schools are summed from courses, so courses go first.
+    for model, fields, counts_sql, params in (
+            (Course, ('file_count', 'thank_count'), COURSE_COUNTS_SQL, (False,)),
+            (School, ('file_count',), SCHOOL_COUNTS_SQL, ())):
+        wrong, drift = reconcile_counts(model, fields, counts_sql, params)
+        report = "{n} {model} rows had wrong counts".format(
+            n=wrong, model=model.__name__)
+        for field in fields:
+            report += ", {field} off by {d} in total".format(field=field, d=drift[field])
+        print report
+        logger.info(report)
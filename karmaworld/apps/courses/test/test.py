@@ -2,6 +2,8 @@ from django.db import IntegrityError, DatabaseError
 from django.middleware.transaction import transaction
 from django.test import TestCase
 from karmaworld.apps.courses.models import *
+from karmaworld.apps.courses.tasks import fix_note_counts
+from karmaworld.apps.notes.models import Note
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 from django.utils.text import slugify
@@ -152,5 +154,52 @@ class CoursesTests(TestCase):
         self.assertIn('status', responseContent)
         self.assertEqual(responseContent['status'], 'fail')
 
-
-
+    def testFixNoteCounts(self):
+        """Test that drifted counters are set back to the counts of visible notes"""
+        Note(course=self.course1, name=u"Lecture notes", thanks=4).save()
+        Note(course=self.course1, name=u"Hidden notes", thanks=2, is_hidden=True).save()
+        Course.objects.filter(id=self.course1.id).update(file_count=7, thank_count=0)
+        School.objects.filter(id=self.harvard.id).update(file_count=0)
+
+        fix_note_counts()
+
+        course = Course.objects.get(id=self.course1.id)
+        self.assertEqual((course.file_count, course.thank_count), (1, 4))
+        self.assertEqual(School.objects.get(id=self.harvard.id).file_count, 1)
+
+    def testSchoolDirectory(self):
+        """Test that the cached school directory follows course changes"""
+        self.assertEqual([school['name'] for school in get_school_directory()],
+                         ['Harvard University'])
+
+        # cached: no queries
+        with self.assertNumQueries(0):
+            get_school_directory()
+
+        yale = School.objects.create(name="Yale University")
+        Course.objects.create(name="Intro to Study", instructor_name="Bob Smith", school=yale)
+        self.assertEqual([school['name'] for school in get_school_directory()],
+                         ['Harvard University', 'Yale University'])
+
+    def testCourseListPages(self):
+        """Test that paging the course list by cursor matches paging by offset"""
+        for count in (3, 2, 1):
+            Course.objects.create(name="Course %d" % count, instructor_name="Bob Smith",
+                                  school=self.harvard, file_count=count)
+
+        def draw(start, after=None):
+            params = {'draw': 1, 'start': start, 'length': 2, 'search[value]': '',
+                      'order[0][column]': 2, 'order[0][dir]': 'desc'}
+            if after:
+                params['after'] = after
+            response = self.client.get(reverse('course_list_ajax'), params,
+                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            return json.loads(response.content)
+
+        first = draw(0)
+        self.assertEqual(first['recordsTotal'], 4)
+        self.assertEqual([row[2] for row in first['data']], [3, 2])
+        by_offset = draw(2)
+        by_cursor = draw(2, first['next_cursor'])
+        self.assertEqual(by_cursor['data'], by_offset['data'])
+        self.assertEqual([row[2] for row in by_cursor['data']], [1, 0])
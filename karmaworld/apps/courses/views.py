@@ -3,6 +3,7 @@
 # Copyright (C) 2012  FinalsClub Foundation
 """ Views for the KarmaNotes Courses app """
 import calendar
+import datetime
 from time import strftime
 from django.db.models import Q
 from django.utils.html import escape
@@ -11,8 +12,10 @@ from querystring_parser import parser as querystring_parser
 import json
 from django.conf import settings
 from django.core import serializers
+from django.core.cache import cache
 from django.core.exceptions import MultipleObjectsReturned
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
 
 from django.http import HttpResponse, HttpResponseBadRequest
 from django.views.decorators.cache import cache_page
@@ -24,6 +27,8 @@ from django.views.generic.edit import CreateView
 
 from karmaworld.apps.courses.models import Course
 from karmaworld.apps.courses.models import School
+from karmaworld.apps.courses.models import get_course_count
+from karmaworld.apps.courses.models import get_school_directory
 from karmaworld.apps.courses.forms import CourseForm
 from karmaworld.apps.notes.models import Note
 from karmaworld.apps.users.models import CourseKarmaEvent
@@ -34,6 +39,10 @@ from django.contrib import messages
 FLAG_FIELD = 'flags'
 USER_PROFILE_FLAGS_FIELD = 'flagged_courses'
 
+# The home page shows an approximate note count, refreshed this often (seconds).
+NOTE_COUNT_KEY = 'note_count'
+NOTE_COUNT_TIMEOUT = 10 * 60
+
 
 # https://docs.djangoproject.com/en/1.5/topics/class-based-views/mixins/#an-alternative-better-solution
 class CourseListView(View):
@@ -69,18 +78,15 @@ class CourseListSubView(TemplateView):
     def get_context_data(self, **kwargs):
         """ Add the CourseForm to ListView context """
         # get the total number of notes
-        kwargs['note_count'] = Note.objects.count()
+        note_count = cache.get(NOTE_COUNT_KEY)
+        if note_count is None:
+            note_count = Note.objects.count()
+            cache.set(NOTE_COUNT_KEY, note_count, NOTE_COUNT_TIMEOUT)
+        kwargs['note_count'] = note_count
         # get the course form for the form at the bottom of the homepage
         kwargs['course_form'] = CourseForm()
 
-        schools = set()
-        for course in Course.objects.all().select_related('school', 'department', 'department__school'):
-            if course.school:
-                schools.add(course.school)
-            elif course.department and course.department.school:
-                schools.add(course.department.school)
-
-        kwargs['schools'] = sorted(list(schools), key=lambda x: x.name)
+        kwargs['schools'] = get_school_directory()
 
         # Include settings constants for honeypot
         for key in ('HONEYPOT_FIELD_NAME', 'HONEYPOT_VALUE'):
@@ -259,45 +265,95 @@ def course_json(course):
     return course_data
 
 
+# DataTables sort columns of the course list
+COURSE_LIST_ORDER_FIELDS = {
+    1: 'updated_at',
+    2: 'file_count',
+    3: 'thank_count',
+}
+
+
+def encode_course_cursor(course, order_field):
+    """ Position of a course in a course list sorted by order_field """
+    value = getattr(course, order_field.lstrip('-'))
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat()
+    return json.dumps([order_field, value, course.id])
+
+
+def after_course_cursor(objects, order_field, cursor):
+    """
+    Limit courses sorted by order_field, then id, to those after the given
+    cursor. Returns None if the cursor cannot be read or is for another
+    sort order.
+    """
+    try:
+        cursor_field, value, course_id = json.loads(cursor)
+    except (TypeError, ValueError):
+        return None
+    if cursor_field != order_field:
+        return None
+
+    field = order_field.lstrip('-')
+    if connection.vendor == 'postgresql':
+        # A row value comparison is a single range scan of the (field, id)
+        # index, where the OR below is not.
+        qn = connection.ops.quote_name
+        column = Course._meta.get_field(field).column
+        where = '({0}.{1}, {0}.{2}) {3} (%s, %s)'.format(qn(Course._meta.db_table), qn(column), qn('id'),
+                                                         '<' if order_field.startswith('-') else '>')
+        return objects.extra(where=[where], params=[value, course_id])
+
+    after = 'lt' if order_field.startswith('-') else 'gt'
+    return objects.filter(Q(**{field + '__' + after: value}) |
+                          Q(**{field: value, 'id__' + after: course_id}))
+
+
 def course_list_ajax_handler(request):
+    """
+    Server-side processing for the DataTables course list.
+    Sorting is by one column, then id. A draw may pass the next_cursor of
+    the previous page as 'after' to page by key instead of by offset.
+    """
     request_dict = querystring_parser.parse(request.GET.urlencode())
     draw = int(request_dict['draw'])
     start = request_dict['start']
     length = request_dict['length']
     search = request_dict.get('search', None)
+    search_value = search['value'] if search and search['value'] else u''
 
     objects = Course.objects.all()
 
-    if search and search['value']:
-        objects = objects.filter(Q(name__icontains=search['value']) |
-                                 Q(school__name__icontains=search['value']) |
-                                 Q(department__school__name__icontains=search['value']))
+    if search_value:
+        # Schools are matched first so the course query does not need
+        # to join them. Names are matched by trigram indexes on Postgres.
+        schools = School.objects.filter(name__icontains=search_value).values('id')
+        objects = objects.filter(Q(name__icontains=search_value) |
+                                 Q(school__in=schools) |
+                                 Q(department__school__in=schools))
 
-    order_fields = []
-    for order_index in request_dict['order']:
-        order_field = None
+    order_field = '-file_count'
+    for order_index in request_dict.get('order', {}):
         order = request_dict['order'][order_index]
-        if order['column'] == 1:
-            order_field = 'updated_at'
-        elif order['column'] == 2:
-            order_field = 'file_count'
-        elif order['column'] == 3:
-            order_field = 'thank_count'
-
-        if order['dir'] == 'desc':
-            order_field = '-' + order_field
-
-        if order_field:
-            order_fields.append(order_field)
-
-    objects = objects.order_by(*order_fields)
-
-    displayRecords = objects.count()
-
-    if start > 0:
-        objects = objects[start:]
-
-    objects = objects[:length]
+        if order['column'] in COURSE_LIST_ORDER_FIELDS:
+            order_field = COURSE_LIST_ORDER_FIELDS[order['column']]
+            if order['dir'] == 'desc':
+                order_field = '-' + order_field
+            break
+    id_order = '-id' if order_field.startswith('-') else 'id'
+
+    displayRecords = get_course_count(objects, search_value)
+
+    rows = objects.order_by(order_field, id_order)\
+                  .select_related('school', 'department', 'department__school')\
+                  .prefetch_related('professor')
+    after = None
+    if start > 0 and request_dict.get('after'):
+        after = after_course_cursor(rows, order_field, request_dict['after'])
+    if after is None:
+        page = list(rows[start:start + length])
+    else:
+        page = list(after[:length])
 
     row_data = [
         [
@@ -306,14 +362,15 @@ def course_list_ajax_handler(request):
             course.file_count,
             course.thank_count,
             course.school.name if course.school else course.department.school.name,
-        ] for course in objects
+        ] for course in page
     ]
 
     response_dict = {
         'draw': draw,
-        'recordsTotal': Course.objects.count(),
+        'recordsTotal': get_course_count(Course.objects.all()),
         'recordsFiltered': displayRecords,
-        'data': row_data
+        'data': row_data,
+        'next_cursor': encode_course_cursor(page[-1], order_field) if page else None,
     }
 
     return HttpResponse(json.dumps(response_dict), mimetype='application/json')
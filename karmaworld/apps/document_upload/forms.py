@@ -3,6 +3,7 @@
 # Copyright (C) 2013  FinalsClub Foundation
 
 from django.forms import ModelForm
+from django.forms import URLField
 
 from karmaworld.apps.document_upload.models import RawDocument
 
@@ -10,3 +11,8 @@ class RawDocumentForm(ModelForm):
     class Meta:
         model = RawDocument
         fields = ('name', 'tags', 'course', 'fp_file', 'mimetype', 'category')
+
+
+class RawDocumentBatchForm(RawDocumentForm):
+    """ One file of an upload batch; fp_file is only checked to be a URL """
+    fp_file = URLField(max_length=255)
@@ -4,8 +4,11 @@
 
 import datetime
 
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
+from django.utils.text import slugify
 import django_filepicker
+from taggit.models import Tag, TaggedItem
 
 from karmaworld.apps.notes.models import Document
 from karmaworld.apps.notes.models import Note
@@ -21,12 +24,66 @@ class RawDocumentManager(models.Manager):
         """
         return self.get(fp_file=fp_file,upstream_link=upstream_link)
 
+    def create_batch(self, raw_documents, tag_names):
+        """
+        Insert the unsaved RawDocuments of an upload batch, all with the same
+        upload_batch, and tag each with the list of tag_names at the same
+        index, in a few queries. Returns the saved RawDocuments in order.
+        """
+        if not raw_documents:
+            return []
+        # documents are only kept along with all of their tags
+        with transaction.commit_on_success():
+            # bulk_create() does not call save(), so make the slugs here. Files
+            # with the same name get distinct uploaded_at, and so distinct slugs.
+            now = datetime.datetime.utcnow()
+            slugs = [slugify(unicode(raw_document.name)) for raw_document in raw_documents]
+            taken = set(self.filter(slug__in=slugs).values_list('slug', flat=True))
+            for i, raw_document in enumerate(raw_documents):
+                raw_document.uploaded_at = now + datetime.timedelta(microseconds=i)
+                slug = slugs[i]
+                if slug in taken or slug in slugs[:i]:
+                    slug = u"{0}-{1}-{2}-{3}".format(slug, raw_document.uploaded_at.month,
+                            raw_document.uploaded_at.day, raw_document.uploaded_at.microsecond)
+                raw_document.slug = slug
+            self.bulk_create(raw_documents)
+
+            # bulk_create() does not set ids, so load the rows back
+            upload_batch = raw_documents[0].upload_batch
+            saved = list(self.filter(upload_batch=upload_batch).order_by('uploaded_at'))
+
+            tags = dict((tag.name, tag) for tag in Tag.objects.filter(
+                        name__in=set(name for names in tag_names for name in names)))
+            content_type = ContentType.objects.get_for_model(self.model)
+            tagged_items = []
+            for raw_document, names in zip(saved, tag_names):
+                for name in set(names):
+                    if name not in tags:
+                        # new tags are few; save() makes their unique slugs
+                        tags[name] = Tag.objects.create(name=name)
+                    tagged_items.append(TaggedItem(tag=tags[name], content_type=content_type,
+                                                   object_id=raw_document.id))
+            TaggedItem.objects.bulk_create(tagged_items)
+        return saved
+
 
 class RawDocument(Document):
     objects      = RawDocumentManager()
 
     is_processed = models.BooleanField(default=False)
 
+    # Conversion progress in Google Drive, kept so that polling for the
+    # exports can resume after a restart without uploading again.
+    gdrive_file_id = models.CharField(max_length=255, null=True, blank=True)
+    gdrive_polls = models.IntegerField(default=0)
+
+    # SHA-256 of the uploaded file, which keys the ConversionCache
+    sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+
+    # Files uploaded together share an upload_batch, by which their
+    # progress can be looked up (see document_upload.views.upload_batch_status)
+    upload_batch = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+
     class Meta:
         """ Sort files most recent first """
         ordering = ['-uploaded_at']
@@ -70,7 +127,13 @@ class RawDocument(Document):
 
     def process_document(self, user=None):
         if not self.is_processed:
-            tasks.process_raw_document.delay(self, user)
+            tasks.start_conversion(self, user)
+
+    @staticmethod
+    def process_batch(upload_batch, user=None):
+        """ Convert every RawDocument of upload_batch, with one task message """
+        user_id = user.id if user and user.is_authenticated() else None
+        tasks.process_upload_batch.delay(upload_batch, user_id)
 
 
 auto_add_check_unique_together(RawDocument)
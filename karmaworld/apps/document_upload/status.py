@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+"""
+Progress of converting each RawDocument into a Note, kept in the cache so
+that upload pages can follow it without reloading anything heavy.
+"""
+
+import time
+
+from django.core.cache import cache
+from django.db.models import get_model
+
+QUEUED = 'queued'
+CONVERTING = 'converting'
+SANITIZING = 'sanitizing'
+DONE = 'done'
+FAILED = 'failed'
+FINISHED = (DONE, FAILED)
+
+STATUS_KEY = 'upload-status-{0}'
+# Long enough to outlast any conversion; older statuses are read from the
+# database instead.
+STATUS_TIMEOUT = 60 * 60 * 24
+# How often waiting requests look at the cache again, in seconds
+POLL_INTERVAL = 0.5
+
+
+def set_status(raw_document_id, status, **extra):
+    """ Record that the RawDocument with the given id is now at status """
+    value = dict(extra, status=status, updated_at=time.time())
+    cache.set(STATUS_KEY.format(raw_document_id), value, STATUS_TIMEOUT)
+
+
+def set_statuses(raw_document_ids, status):
+    """ set_status() of many RawDocuments at once """
+    value = {'status': status, 'updated_at': time.time()}
+    cache.set_many(dict((STATUS_KEY.format(raw_document_id), value)
+                        for raw_document_id in raw_document_ids), STATUS_TIMEOUT)
+
+
+def get_statuses(raw_document_ids):
+    """
+    Returns the status of each RawDocument by id. Each is a dict with at
+    least status and updated_at, note_url once done, and errors of the
+    Google Drive exports which failed, if any. RawDocuments the
+    cache has forgotten are done if processed and queued if not; unknown
+    ids are left out.
+    """
+    keys = dict((STATUS_KEY.format(raw_document_id), raw_document_id)
+                for raw_document_id in raw_document_ids)
+    statuses = dict((keys[key], value) for key, value in cache.get_many(keys.keys()).iteritems())
+
+    missing = [raw_document_id for raw_document_id in raw_document_ids
+               if raw_document_id not in statuses]
+    if missing:
+        # models imports tasks, which imports this module
+        RawDocument = get_model('document_upload', 'RawDocument')
+        for raw_document_id, is_processed in RawDocument.objects.filter(id__in=missing) \
+                                                                .values_list('id', 'is_processed'):
+            statuses[raw_document_id] = {'status': DONE if is_processed else QUEUED,
+                                         'updated_at': 0}
+    return statuses
+
+
+def all_finished(statuses):
+    """ Whether there are statuses and all of them are done or failed """
+    return bool(statuses) and all(status['status'] in FINISHED for status in statuses.itervalues())
+
+
+def wait_for_statuses(raw_document_ids, since, timeout):
+    """
+    Long-poll: returns get_statuses(raw_document_ids) as soon as any was
+    updated after the time since, or all are finished, or after timeout
+    seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        statuses = get_statuses(raw_document_ids)
+        if all_finished(statuses) or time.time() >= deadline or \
+           any(status['updated_at'] > since for status in statuses.itervalues()):
+            return statuses
+        time.sleep(POLL_INTERVAL)
@@ -1,19 +1,232 @@
 #!/usr/bin/env python
 # -*- coding:utf8 -*-
 # Copyright (C) 2013  FinalsClub Foundation
+import time
 import traceback
 
 from celery import task
 from celery.utils.log import get_task_logger
-from karmaworld.apps.notes.gdrive import convert_raw_document
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import get_model
+from karmaworld.apps.document_upload import status
+from karmaworld.apps.notes.gdrive import CONVERSION_STAGES
+from karmaworld.apps.notes.gdrive import ConversionNotReady
+from karmaworld.apps.notes.gdrive import delete_artifacts
+from karmaworld.apps.notes.gdrive import new_conversion_job
 
 logger = get_task_logger(__name__)
 
-@task()
-def process_raw_document(raw_document, user):
-    """ Process a RawDocument instance in to a Note instance """
+# A stage of a job is claimed under this cache key when it starts, so that
+# a message delivered twice runs the stage once. While the stage runs the
+# claim lasts as long as the stage may run, so that a stage whose worker
+# was killed can be run again once its message is delivered again.
+STAGE_CLAIM_KEY = 'conversion-{0}-{1}'
+STAGE_RUNNING = 'running'
+STAGE_FINISHED = 'finished'
+# Hard time limit of each stage, well over pdfconvert.PDF2HTML_TIMEOUT
+STAGE_TIME_LIMIT = 15 * 60
+# How long finished stages and started upload batches stay claimed
+FINISHED_CLAIM_TIMEOUT = 60 * 60 * 24
+# A stage which fails is run again after STAGE_RETRY_DELAY seconds, doubling
+# each time, until it has been tried STAGE_MAX_ATTEMPTS times.
+STAGE_RETRY_DELAY = 60
+STAGE_MAX_ATTEMPTS = 3
+UPLOAD_BATCH_CLAIM_KEY = 'upload-batch-{0}'
+
+# The upload status shown while each stage runs; see document_upload.status
+STAGE_STATUSES = {
+    'fetch': status.CONVERTING,
+    'convert': status.CONVERTING,
+    'extract': status.CONVERTING,
+    'render': status.CONVERTING,
+    'sanitize': status.SANITIZING,
+    'persist': status.SANITIZING,
+}
+
+
+def _dispatch(stage, job, countdown=None):
+    """ Queue the conversion stage named stage for job """
+    job['queued_at'] = time.time() + (countdown or 0)
+    STAGE_TASKS[stage].apply_async(args=[job], countdown=countdown)
+
+
+def _claim_stage(stage, job):
+    """ Returns False if this stage of job was already claimed """
+    return cache.add(STAGE_CLAIM_KEY.format(job['id'], stage), STAGE_RUNNING, STAGE_TIME_LIMIT)
+
+
+def _finish_stage(stage, job):
+    """ Keep the claim of a stage which ran, so it is not run again """
+    cache.set(STAGE_CLAIM_KEY.format(job['id'], stage), STAGE_FINISHED, FINISHED_CLAIM_TIMEOUT)
+
+
+def _release_stage(stage, job):
+    cache.delete(STAGE_CLAIM_KEY.format(job['id'], stage))
+
+
+def _set_status(job, job_status, **extra):
+    """
+    Record the upload status of job, along with the exports Google Drive
+    failed to give, by download type, if any
+    """
+    if job.get('errors'):
+        extra['errors'] = job['errors']
+    status.set_status(job['raw_document_id'], job_status, **extra)
+
+
+def _set_done(job):
+    """ Record that the note of job exists, with its url if it can be made """
+    note_url = None
+    try:
+        note_url = get_model('notes', 'Note').objects.get(id=job['note_id']).get_absolute_url()
+    except:
+        logger.warn("no url for note {0}\n{1}".format(job['note_id'], traceback.format_exc()))
+    _set_status(job, status.DONE, note_id=job['note_id'], note_url=note_url)
+
+
+def _run_stage(stage, job):
+    """
+    Run one conversion stage on job, then queue the stage after it.
+    How long the job waited for and spent in each stage is logged and
+    kept in job['timings'].
+    """
+    if not _claim_stage(stage, job):
+        if cache.get(STAGE_CLAIM_KEY.format(job['id'], stage)) == STAGE_FINISHED:
+            logger.warn("conversion {0} job={1} delivered again, skipping".format(stage, job['id']))
+        else:
+            # Either the stage is running elsewhere, or its worker was
+            # killed and this is its message delivered again. Look again
+            # once the claim has run out, when only the latter is left.
+            logger.warn("conversion {0} job={1} is claimed, checking again in {2}s".format(
+                        stage, job['id'], STAGE_TIME_LIMIT))
+            _dispatch(stage, job, countdown=STAGE_TIME_LIMIT)
+        return
+
+    started = time.time()
+    # models imports this module, so fetch RawDocument lazily
+    RawDocument = get_model('document_upload', 'RawDocument')
     try:
-        convert_raw_document(raw_document, user=user)
+        if stage in STAGE_STATUSES:
+            _set_status(job, STAGE_STATUSES[stage])
+        raw_document = RawDocument.objects.get(id=job['raw_document_id'])
+        dict(CONVERSION_STAGES)[stage](job, raw_document)
+    except ConversionNotReady, e:
+        # free this worker until it is worth trying again
+        logger.info("conversion {0} job={1} not ready, retrying in {2}s".format(
+                    stage, job['id'], e.countdown))
+        _release_stage(stage, job)
+        _dispatch(stage, job, countdown=e.countdown)
+        return
     except:
-        logger.error(traceback.format_exc())
+        logger.error("conversion {0} failed for job {1}\n{2}".format(
+                     stage, job['id'], traceback.format_exc()))
+        _release_stage(stage, job)
+        attempts = job.setdefault('attempts', {})
+        attempts[stage] = attempts.get(stage, 0) + 1
+        if attempts[stage] < STAGE_MAX_ATTEMPTS:
+            # keep the artifacts for the next attempt
+            _dispatch(stage, job, countdown=STAGE_RETRY_DELAY * 2 ** (attempts[stage] - 1))
+            return
+        if stage in STAGE_STATUSES:
+            _set_status(job, status.FAILED)
+        delete_artifacts(job)
+        return
+
+    _finish_stage(stage, job)
+    finished = time.time()
+    job['timings'][stage] = {
+        'wait': started - job.get('queued_at', started),
+        'run': finished - started,
+    }
+    logger.info("conversion {0} job={1} raw_document={2} wait={3:.3f}s run={4:.3f}s".format(
+                stage, job['id'], job['raw_document_id'],
+                job['timings'][stage]['wait'], job['timings'][stage]['run']))
+
+    if stage == 'persist':
+        _set_done(job)
+
+    stages = [name for name, run in CONVERSION_STAGES]
+    if job.get('skip_to'):
+        _dispatch(job.pop('skip_to'), job)
+    elif stage != stages[-1]:
+        _dispatch(stages[stages.index(stage) + 1], job)
+
+
+# Each stage is a separate task so it can be routed to a queue with its own
+# concurrency; see CELERY_ROUTES. Messages are acknowledged once the stage
+# has run, so that a stage whose worker is lost is delivered again.
+@task(name="conversion_fetch", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_fetch(job):
+    _run_stage('fetch', job)
+
+
+@task(name="conversion_convert", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_convert(job):
+    _run_stage('convert', job)
+
+
+@task(name="conversion_extract", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_extract(job):
+    _run_stage('extract', job)
+
+
+@task(name="conversion_render", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_render(job):
+    _run_stage('render', job)
+
+
+@task(name="conversion_sanitize", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_sanitize(job):
+    _run_stage('sanitize', job)
+
+
+@task(name="conversion_persist", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_persist(job):
+    _run_stage('persist', job)
+
+
+@task(name="conversion_index", ignore_result=True, acks_late=True,
+       time_limit=STAGE_TIME_LIMIT)
+def conversion_index(job):
+    _run_stage('index', job)
+
+
+STAGE_TASKS = {
+    'fetch': conversion_fetch,
+    'convert': conversion_convert,
+    'extract': conversion_extract,
+    'render': conversion_render,
+    'sanitize': conversion_sanitize,
+    'persist': conversion_persist,
+    'index': conversion_index,
+}
+
+
+def start_conversion(raw_document, user=None):
+    """ Queue the first stage of converting a saved RawDocument into a Note """
+    job = new_conversion_job(raw_document, user)
+    status.set_status(raw_document.id, status.QUEUED)
+    _dispatch(CONVERSION_STAGES[0][0], job)
+    return job
+
 
+@task(name="process_upload_batch", ignore_result=True)
+def process_upload_batch(upload_batch, user_id=None):
+    """ Start converting every RawDocument uploaded in upload_batch """
+    if not cache.add(UPLOAD_BATCH_CLAIM_KEY.format(upload_batch), True, FINISHED_CLAIM_TIMEOUT):
+        logger.warn("upload batch {0} delivered again, skipping".format(upload_batch))
+        return
+    RawDocument = get_model('document_upload', 'RawDocument')
+    user = User.objects.get(id=user_id) if user_id else None
+    for raw_document in RawDocument.objects.filter(upload_batch=upload_batch, is_processed=False):
+        try:
+            start_conversion(raw_document, user=user)
+        except:
+            logger.error(traceback.format_exc())
@@ -4,15 +4,30 @@ when you run "manage.py test".
 
 Replace this with more appropriate tests for your application.
 """
+import json
+
+import mock
 from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
 from django.http import HttpRequest
 
 from django.test import TestCase, Client
 from karmaworld.apps.courses.models import Course
 from karmaworld.apps.courses.models import School
 from karmaworld.apps.document_upload.forms import RawDocumentForm
+from karmaworld.apps.document_upload.forms import RawDocumentBatchForm
+from karmaworld.apps.document_upload.models import RawDocument
+from karmaworld.apps.document_upload import status
+from karmaworld.apps.document_upload import tasks
+from karmaworld.apps.document_upload.tasks import _claim_stage, _run_stage
+from karmaworld.apps.document_upload.views import _remember_uploads, upload_status
+from karmaworld.apps.document_upload.views import upload_batch_status, upload_status_stream
 from karmaworld.apps.notes.gdrive import *
+from karmaworld.apps.notes.gdrive import _save_raw_document_fields
 from karmaworld.apps.notes.models import Note, ANONYMOUS_UPLOAD_URLS
+from karmaworld.apps.notes.models import ConversionCache
 from karmaworld.apps.notes.models import find_orphan_notes
 
 TEST_USERNAME = 'alice'
@@ -69,6 +84,255 @@ class ConversionTest(TestCase):
                                      'tags': '',
                                      'mimetype': 'application/octet-stream'})
 
+    def testConversionJobArtifacts(self):
+        """Test that stages hand files to each other through storage"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/vOtEo0FrSbu2WDbAOzLn',
+                                 'course': str(self.course.id),
+                                 'name': 'KarmaNotes test 3',
+                                 'tags': '',
+                                 'mimetype': 'text/enml'})
+        self.assertTrue(r_d_f.is_valid())
+        job = new_conversion_job(r_d_f.save(commit=False))
+        self.assertEqual(job['mimetype'], 'text/enml')
+        self.assertEqual(job['upload_mimetype'], 'text/html')
+        self.assertIsNone(job['user_id'])
+
+        save_artifact(job, 'original', '<en-note>hi</en-note>')
+        path = job['artifacts']['original']
+        self.assertEqual(read_artifact(job, 'original'), '<en-note>hi</en-note>')
+
+        # downloads are stored from temporary files
+        download = tempfile.TemporaryFile()
+        download.write('hi')
+        download.seek(0)
+        save_artifact(job, 'text', download)
+        download.close()
+        self.assertEqual(read_artifact(job, 'text'), 'hi')
+
+        # kept out of the public media storage
+        self.assertFalse(default_storage.exists(path))
+        self.assertTrue(artifact_storage().exists(path))
+        delete_artifacts(job)
+        self.assertFalse(artifact_storage().exists(path))
+        self.assertEqual(job['artifacts'], {})
+
+    def testConversionJobMessages(self):
+        """Test that jobs travel as JSON and each stage runs once per job"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/S2lhT3INSFCVFURR2RV7',
+                                 'course': str(self.course.id),
+                                 'name': 'graph3.txt',
+                                 'tags': '',
+                                 'mimetype': 'text/plain'})
+        self.assertTrue(r_d_f.is_valid())
+        job = new_conversion_job(r_d_f.save())
+        save_artifact(job, 'original', 'hi')
+        self.assertEqual(json.loads(json.dumps(job)), job)
+        delete_artifacts(job)
+
+        self.assertTrue(_claim_stage('fetch', job))
+        self.assertFalse(_claim_stage('fetch', job))
+        self.assertTrue(_claim_stage('convert', job))
+
+        # a stage which fails is queued again, keeping its artifacts,
+        # until it has failed STAGE_MAX_ATTEMPTS times
+        save_artifact(job, 'original', 'hi')
+        job['raw_document_id'] = -1
+        job['errors'] = {'text': 'HTTP 503'}
+        with mock.patch.object(tasks, '_dispatch') as dispatch:
+            _run_stage('extract', job)
+            dispatch.assert_called_once_with('extract', job, countdown=tasks.STAGE_RETRY_DELAY)
+            self.assertIn('original', job['artifacts'])
+            for attempt in range(1, tasks.STAGE_MAX_ATTEMPTS):
+                _run_stage('extract', job)
+            self.assertEqual(dispatch.call_count, tasks.STAGE_MAX_ATTEMPTS - 1)
+        self.assertEqual(job['artifacts'], {})
+        self.assertEqual(status.get_statuses([-1])[-1]['status'], status.FAILED)
+        # and the upload status tells why
+        self.assertEqual(status.get_statuses([-1])[-1]['errors'], {'text': 'HTTP 503'})
+
+        # a stage claimed by a run which may still be going is checked again
+        # once the claim has run out
+        with mock.patch.object(tasks, '_dispatch') as dispatch:
+            _run_stage('fetch', job)
+            dispatch.assert_called_once_with('fetch', job, countdown=tasks.STAGE_TIME_LIMIT)
+
+    def testConversionWaitsForDrive(self):
+        """Test that Drive is polled with a growing delay, without uploading again"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/S2lhT3INSFCVFURR2RV7',
+                                 'course': str(self.course.id),
+                                 'name': 'graph3.txt',
+                                 'tags': '',
+                                 'mimetype': 'text/plain'})
+        self.assertTrue(r_d_f.is_valid())
+        raw_document = r_d_f.save()
+        job = new_conversion_job(raw_document)
+        save_artifact(job, 'original', 'hi')
+        file_dict = {u'id': u'drive-file', u'alternateLink': u'https://drive/file',
+                     u'exportLinks': {u'text/plain': u'https://drive/file.txt'}}
+
+        gdrive = 'karmaworld.apps.notes.gdrive.'
+        with mock.patch(gdrive + 'build_api_service'), \
+             mock.patch(gdrive + 'gdrive_exports_ready', return_value=False), \
+             mock.patch(gdrive + 'upload_to_gdrive', return_value=file_dict) as upload, \
+             mock.patch(gdrive + 'poll_gdrive', return_value=None) as poll, \
+             mock.patch.object(tasks, '_dispatch') as dispatch:
+            countdowns = []
+            for attempt in range(3):
+                with self.assertRaises(ConversionNotReady) as raised:
+                    convert_document(job, raw_document)
+                countdowns.append(raised.exception.countdown)
+            self.assertEqual(countdowns, [GDRIVE_FIRST_POLL_DELAY * 2 ** i for i in range(3)])
+            self.assertEqual(upload.call_count, 1)
+            self.assertEqual(poll.call_count, 2)
+            self.assertEqual(poll.call_args[0][1], u'drive-file')
+
+            # the stage is queued again after the next delay, and released
+            # so that it can run then
+            _run_stage('convert', job)
+            dispatch.assert_called_once_with('convert', job,
+                                             countdown=GDRIVE_FIRST_POLL_DELAY * 2 ** 3)
+            self.assertTrue(_claim_stage('convert', job))
+
+            # a later run, such as after a restart, carries on from the file id
+            poll.return_value = file_dict
+            convert_document(job, RawDocument.objects.get(id=raw_document.id))
+            self.assertEqual(upload.call_count, 1)
+            self.assertEqual(job['gdrive']['id'], u'drive-file')
+        delete_artifacts(job)
+
+    def testFailedExportIsNotCached(self):
+        """Test that a conversion missing its HTML export is not reused"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/S2lhT3INSFCVFURR2RV7',
+                                 'course': str(self.course.id),
+                                 'name': 'graph3.txt',
+                                 'tags': '',
+                                 'mimetype': 'text/plain'})
+        self.assertTrue(r_d_f.is_valid())
+        raw_document = r_d_f.save()
+        job = new_conversion_job(raw_document)
+        job.update(sha256='0' * 64, errors={'html': 'HTTP 503'},
+                   gdrive={'alternateLink': 'https://drive.google.com/file/x'})
+        save_artifact(job, 'text', 'hi')
+        try:
+            persist_document(job, raw_document)
+        finally:
+            delete_artifacts(job)
+        self.assertEqual(Note.objects.get(id=job['note_id']).text, 'hi')
+        self.assertIsNone(ConversionCache.lookup('0' * 64, job['upload_mimetype']))
+
+    def testGdrivePollStateIsPersisted(self):
+        """Test that Drive poll progress survives reloading the RawDocument"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/S2lhT3INSFCVFURR2RV7',
+                                 'course': str(self.course.id),
+                                 'name': 'graph3.txt',
+                                 'tags': '',
+                                 'mimetype': 'text/plain'})
+        self.assertTrue(r_d_f.is_valid())
+        raw_document = r_d_f.save()
+        self.assertIsNone(raw_document.gdrive_file_id)
+
+        _save_raw_document_fields(raw_document, gdrive_file_id='abc123', gdrive_polls=3)
+        self.assertEqual(raw_document.gdrive_polls, 3)
+        reloaded = RawDocument.objects.get(id=raw_document.id)
+        self.assertEqual(reloaded.gdrive_file_id, 'abc123')
+        self.assertEqual(reloaded.gdrive_polls, 3)
+
+    def testUploadBatch(self):
+        """Test that a batch of files is saved in bulk and can be looked up"""
+        files = [{'fp_file': 'https://www.filepicker.io/api/file/batch{0}'.format(i),
+                  'course': str(self.course.id),
+                  'name': 'lecture',
+                  'tags': 'econ, week {0}'.format(i),
+                  'mimetype': 'text/plain'} for i in range(3)]
+        forms = [RawDocumentBatchForm(f) for f in files]
+        self.assertTrue(all(form.is_valid() for form in forms))
+        raw_documents = []
+        for form in forms:
+            raw_document = form.save(commit=False)
+            raw_document.upload_batch = 'a' * 32
+            raw_documents.append(raw_document)
+
+        saved = RawDocument.objects.create_batch(raw_documents,
+                                                 [form.cleaned_data['tags'] for form in forms])
+        self.assertEqual([r.fp_file.name for r in saved], [f['fp_file'] for f in files])
+        self.assertEqual(len(set(r.slug for r in saved)), 3)
+        self.assertEqual(sorted(t.name for t in saved[2].tags.all()), ['econ', 'week 2'])
+
+        request = HttpRequest()
+        request.method = 'GET'
+        request.session = SessionStore()
+        _remember_uploads(request, [r.id for r in saved])
+        response = upload_batch_status(request, 'a' * 32)
+        self.assertEqual(response.status_code, 200)
+        statuses = json.loads(response.content)['files']
+        self.assertEqual([f['status'] for f in statuses], ['queued'] * 3)
+        self.assertNotIn('fp_file', statuses[0])
+        self.assertEqual(upload_batch_status(request, 'b' * 32).status_code, 404)
+        # other sessions are not told about it
+        request.session = SessionStore()
+        self.assertEqual(upload_batch_status(request, 'a' * 32).status_code, 404)
+
+        # the same file twice in one upload is refused before anything is saved
+        twice = [dict(files[0], fp_file='https://www.filepicker.io/api/file/twice')] * 2
+        response = self.client.post(reverse('upload_batch_post'), json.dumps(twice),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content)['errors'].keys(), ['1'])
+        self.assertFalse(RawDocument.objects.filter(fp_file=twice[0]['fp_file']).exists())
+
+    def testUploadStatus(self):
+        """Test following the conversion status of an upload"""
+        r_d_f = RawDocumentForm({'fp_file': 'https://www.filepicker.io/api/file/S2lhT3INSFCVFURR2RV7',
+                                 'course': str(self.course.id),
+                                 'name': 'graph3.txt',
+                                 'tags': '',
+                                 'mimetype': 'text/plain'})
+        self.assertTrue(r_d_f.is_valid())
+        raw_document = r_d_f.save()
+        request = HttpRequest()
+        request.method = 'GET'
+        request.session = SessionStore()
+        _remember_uploads(request, [raw_document.id])
+        self.assertEqual(status.get_statuses([raw_document.id])[raw_document.id]['status'],
+                         status.QUEUED)
+
+        request.GET = {'ids': str(raw_document.id)}
+        data = json.loads(upload_status(request).content)
+        self.assertFalse(data['finished'])
+
+        # without a cached status, it comes from the database
+        cache.delete(status.STATUS_KEY.format(raw_document.id))
+        with mock.patch('karmaworld.apps.document_upload.views.LONG_POLL_TIMEOUT', 0):
+            data = json.loads(upload_status(request).content)
+        self.assertEqual(data['statuses'][str(raw_document.id)]['status'], status.QUEUED)
+        self.assertFalse(data['finished'])
+
+        status.set_status(raw_document.id, status.CONVERTING)
+        converting = status.wait_for_statuses([raw_document.id], 0, 0)[raw_document.id]
+        self.assertEqual(converting['status'], status.CONVERTING)
+
+        status.set_status(raw_document.id, status.DONE, note_url='/note/x')
+        request.GET = {'ids': str(raw_document.id), 'since': repr(converting['updated_at'])}
+        data = json.loads(upload_status(request).content)
+        self.assertTrue(data['finished'])
+        self.assertEqual(data['statuses'][str(raw_document.id)]['status'], status.DONE)
+        self.assertEqual(data['statuses'][str(raw_document.id)]['note_url'], '/note/x')
+
+        response = upload_status_stream(request)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        events = ''.join(response.streaming_content)
+        self.assertIn('event: status', events)
+        self.assertIn('event: finished', events)
+
+        # other sessions are not told about it
+        request.session = SessionStore()
+        data = json.loads(upload_status(request).content)
+        self.assertEqual(data['statuses'], {})
+        self.assertFalse(data['finished'])
+        self.assertEqual(upload_status_stream(request).status_code, 400)
+
+        self.assertEqual(self.client.get(reverse('upload_status') + '?ids=x').status_code, 400)
+
     def testSessionUserAssociation1(self):
         """If the user is already logged in when they
         upload a note, it should set note.user correctly."""
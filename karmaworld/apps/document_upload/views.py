@@ -3,10 +3,36 @@
 # Copyright (C) 2013  FinalsClub Foundation
 
 import datetime
+import json
+import time
+import uuid
 
-from django.http import HttpResponse
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.http import StreamingHttpResponse
+from django.views.decorators.http import require_GET, require_POST
+from karmaworld.apps.document_upload.forms import RawDocumentBatchForm
 from karmaworld.apps.document_upload.forms import RawDocumentForm
+from karmaworld.apps.document_upload.models import RawDocument
+from karmaworld.apps.document_upload import status
 from karmaworld.apps.notes.models import ANONYMOUS_UPLOAD_URLS
+from karmaworld.apps.notes.models import Note
+
+# Most files accepted in one upload batch, and whose status is asked for
+# at once
+UPLOAD_BATCH_MAX_FILES = 100
+
+# Session key of the ids of the RawDocuments uploaded in the session, the
+# only ones whose status it may ask for. Only the latest are kept.
+UPLOADED_RAW_DOCUMENTS = 'uploaded_raw_documents'
+REMEMBERED_UPLOADS = 5 * UPLOAD_BATCH_MAX_FILES
+
+# Status requests hold a web worker while they wait, so they are kept well
+# under gunicorn's 30 second timeout; clients ask again (EventSource
+# reconnects by itself) to follow longer conversions.
+LONG_POLL_TIMEOUT = 10
+EVENT_STREAM_TIMEOUT = 20
 
 
 def save_fp_upload(request):
@@ -25,14 +51,11 @@ def save_fp_upload(request):
         if request.user.is_authenticated():
             raw_document.save()
         else:
-            anonymous_upload_urls = request.session.get(ANONYMOUS_UPLOAD_URLS, [])
-            anonymous_upload_urls.append(request.POST['fp_file'])
-            request.session[ANONYMOUS_UPLOAD_URLS] = anonymous_upload_urls
-            request.session.modified = True
-            request.session.save()
+            _remember_anonymous_uploads(request, [request.POST['fp_file']])
             raw_document.save()
         # save the tags to the database, too. don't forget those guys.
         r_d_f.save_m2m()
+        _remember_uploads(request, [raw_document.id])
         # Proccess document after the tags are saved so that it isn't converted
         # to a note before the tags are attached to the document
         raw_document.process_document(user=request.user)
@@ -40,3 +63,217 @@ def save_fp_upload(request):
         return HttpResponse({'success'})
     else:
         return HttpResponse(r_d_f.errors, status=400)
+
+
+def _remember_anonymous_uploads(request, fp_files):
+    """ Keep fp_files in the session, to give their notes to the user who logs in """
+    anonymous_upload_urls = request.session.get(ANONYMOUS_UPLOAD_URLS, [])
+    anonymous_upload_urls.extend(fp_files)
+    request.session[ANONYMOUS_UPLOAD_URLS] = anonymous_upload_urls
+    request.session.modified = True
+    request.session.save()
+
+
+def _remember_uploads(request, raw_document_ids):
+    """ Let the session follow the status of the given RawDocuments """
+    status.set_statuses(raw_document_ids, status.QUEUED)
+    uploaded = request.session.get(UPLOADED_RAW_DOCUMENTS, []) + list(raw_document_ids)
+    request.session[UPLOADED_RAW_DOCUMENTS] = uploaded[-REMEMBERED_UPLOADS:]
+
+
+@require_POST
+def save_fp_upload_batch(request):
+    """
+    ajax endpoint for saving many FilePicker uploaded files at once. Takes a
+    JSON list of objects with the fields of save_fp_upload, and returns the
+    upload_batch they can be looked up by.
+    """
+    try:
+        files = json.loads(request.body)
+    except ValueError:
+        files = None
+    if not isinstance(files, list) or not files:
+        return HttpResponseBadRequest(json.dumps({'status': 'fail', 'message': 'Expected a list of files'}),
+                                      mimetype="application/json")
+    if len(files) > UPLOAD_BATCH_MAX_FILES:
+        return HttpResponseBadRequest(json.dumps({'status': 'fail',
+                                                  'message': 'At most {0} files per upload'.format(UPLOAD_BATCH_MAX_FILES)}),
+                                      mimetype="application/json")
+
+    forms = [RawDocumentBatchForm(f if isinstance(f, dict) else {}) for f in files]
+    errors = dict((i, dict((field, [unicode(e) for e in field_errors])
+                           for field, field_errors in form.errors.items()))
+                  for i, form in enumerate(forms) if not form.is_valid())
+    # forms are only checked against the database, not each other
+    seen = set()
+    for i, form in enumerate(forms):
+        if i in errors:
+            continue
+        fp_file = form.cleaned_data['fp_file']
+        if fp_file in seen:
+            errors[i] = {'fp_file': ['This file is already in the upload.']}
+        seen.add(fp_file)
+    if errors:
+        return HttpResponseBadRequest(json.dumps({'status': 'fail', 'errors': errors}),
+                                      mimetype="application/json")
+
+    upload_batch = uuid.uuid4().hex
+    raw_documents = []
+    for form in forms:
+        raw_document = form.save(commit=False)
+        raw_document.ip = request.META['REMOTE_ADDR']
+        raw_document.upload_batch = upload_batch
+        raw_documents.append(raw_document)
+
+    # Tags are saved with the documents, before any of them is converted
+    try:
+        saved = RawDocument.objects.create_batch(raw_documents,
+                                                 [form.cleaned_data['tags'] for form in forms])
+    except IntegrityError:
+        # another upload of one of the files got in first
+        return HttpResponseBadRequest(json.dumps({'status': 'fail',
+                                                  'message': 'These files have already been uploaded'}),
+                                      mimetype="application/json")
+    if not request.user.is_authenticated():
+        _remember_anonymous_uploads(request, [form.cleaned_data['fp_file'] for form in forms])
+    _remember_uploads(request, [raw_document.id for raw_document in saved])
+    RawDocument.process_batch(upload_batch, user=request.user)
+
+    return HttpResponse(json.dumps({
+        'status': 'success',
+        'upload_batch': upload_batch,
+        'status_url': reverse('upload_batch_status', args=[upload_batch]),
+        'raw_documents': [raw_document.id for raw_document in saved],
+    }), mimetype="application/json")
+
+
+@require_GET
+def upload_batch_status(request, upload_batch):
+    """
+    ajax endpoint for the progress of each file of an upload batch. Only
+    files uploaded in this session are reported.
+    """
+    uploaded = request.session.get(UPLOADED_RAW_DOCUMENTS, [])
+    raw_documents = list(RawDocument.objects.filter(upload_batch=upload_batch, id__in=uploaded)
+                                            .order_by('uploaded_at')
+                                            .values('id', 'name', 'fp_file', 'is_processed'))
+    if not raw_documents:
+        return HttpResponseNotFound(json.dumps({'status': 'fail', 'message': 'No such upload'}),
+                                    mimetype="application/json")
+
+    statuses = status.get_statuses([r['id'] for r in raw_documents])
+    # notes keep the Filepicker link of the file they came from
+    notes = dict((note.fp_file.name, note) for note in
+                 Note.objects.filter(fp_file__in=[r['fp_file'] for r in raw_documents])
+                             .select_related('course__school', 'course__department__school')
+                             .defer('text'))
+    files = []
+    for raw_document in raw_documents:
+        note = notes.get(raw_document['fp_file'])
+        if note or raw_document['is_processed']:
+            raw_document_status = status.DONE
+        else:
+            raw_document_status = statuses.get(raw_document['id'], {}).get('status', status.QUEUED)
+        files.append({
+            'id': raw_document['id'],
+            'name': raw_document['name'],
+            'status': raw_document_status,
+            'url': note.get_absolute_url() if note else None,
+        })
+    return HttpResponse(json.dumps({'upload_batch': upload_batch, 'files': files}),
+                        mimetype="application/json")
+
+
+def _raw_document_ids(request):
+    """ The RawDocument ids given as ?ids=1,2,3, or None if there are none or too many """
+    try:
+        ids = [int(i) for i in request.GET.get('ids', '').split(',') if i]
+    except ValueError:
+        return None
+    if not ids or len(ids) > UPLOAD_BATCH_MAX_FILES:
+        return None
+    return ids
+
+
+def _bad_ids():
+    return HttpResponseBadRequest(json.dumps({'status': 'fail',
+                                              'message': 'Expected ?ids= of up to {0} uploads'.format(UPLOAD_BATCH_MAX_FILES)}),
+                                  mimetype="application/json")
+
+
+def _uploaded_ids(request):
+    """ The ids of ?ids= which were uploaded in this session, or None if ?ids= is bad """
+    ids = _raw_document_ids(request)
+    if ids is None:
+        return None
+    uploaded = set(request.session.get(UPLOADED_RAW_DOCUMENTS, []))
+    return [i for i in ids if i in uploaded]
+
+
+@require_GET
+def upload_status(request):
+    """
+    ajax long-poll endpoint for the conversion status of uploads. Given
+    ?ids=1,2,3 and the time of the last answer as ?since=, answers when any
+    of their statuses changes, all are finished, or LONG_POLL_TIMEOUT
+    passes, with the statuses by id, whether all are finished and the since
+    to pass next time. Only uploads made in this session are reported.
+    """
+    ids = _uploaded_ids(request)
+    if ids is None:
+        return _bad_ids()
+    try:
+        since = float(request.GET.get('since', 0))
+    except ValueError:
+        since = 0
+    statuses = status.wait_for_statuses(ids, since, LONG_POLL_TIMEOUT) if ids else {}
+    # the newest status seen; anything updated later is news next time
+    since = max([since] + [s['updated_at'] for s in statuses.itervalues()])
+    return HttpResponse(json.dumps({'since': since, 'statuses': statuses,
+                                    'finished': status.all_finished(statuses)}),
+                        mimetype="application/json")
+
+
+def _status_events(ids, since, timeout):
+    """ Server-sent events of each status of ids changed after since """
+    deadline = time.time() + timeout
+    # ask the client to reconnect soon once the stream ends
+    yield 'retry: {0}\n\n'.format(int(status.POLL_INTERVAL * 1000))
+    while True:
+        statuses = status.wait_for_statuses(ids, since, max(deadline - time.time(), 0))
+        changed = dict((raw_document_id, raw_document_status)
+                       for raw_document_id, raw_document_status in statuses.iteritems()
+                       if raw_document_status['updated_at'] > since)
+        if changed:
+            since = max(s['updated_at'] for s in changed.itervalues())
+            # the event id comes back as Last-Event-ID when reconnecting
+            yield 'id: {0!r}\nevent: status\ndata: {1}\n\n'.format(since, json.dumps(changed))
+        if status.all_finished(statuses):
+            yield 'event: finished\ndata: {}\n\n'
+            return
+        if time.time() >= deadline:
+            return
+
+
+@require_GET
+def upload_status_stream(request):
+    """
+    Server-sent events endpoint for the conversion status of uploads made in
+    this session, given as ?ids=1,2,3. Sends a status event with the
+    statuses by id whenever they change, then finished once all are done or
+    failed. The stream closes after EVENT_STREAM_TIMEOUT; EventSource
+    reconnects and carries on from the last event.
+    """
+    ids = _uploaded_ids(request)
+    if not ids:
+        return _bad_ids()
+    try:
+        since = float(request.META.get('HTTP_LAST_EVENT_ID', 0))
+    except ValueError:
+        since = 0
+    response = StreamingHttpResponse(_status_events(ids, since, EVENT_STREAM_TIMEOUT),
+                                     content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # stop nginx and the like from buffering events
+    response['X-Accel-Buffering'] = 'no'
+    return response
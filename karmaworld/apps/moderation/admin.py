@@ -23,14 +23,19 @@ reset_flags.short_description = "Reset flags to 0"
 
 
 # Create a simple action to set is_hidden
+# Notes are saved one at a time so course and school counts follow.
 def hide_notes(modeladmin, request, queryset):
-    queryset.update(is_hidden=True)
+    for note in queryset.filter(is_hidden=False):
+        note.is_hidden = True
+        note.save()
 hide_notes.short_description = "Hide selected notes"
 
 
 # Create a simple action to unset is_hidden
 def show_notes(modeladmin, request, queryset):
-    queryset.update(is_hidden=False)
+    for note in queryset.filter(is_hidden=True):
+        note.is_hidden = False
+        note.save()
 show_notes.short_description = "Show selected notes"
 
 
@@ -5,6 +5,7 @@
 
 from django.contrib import admin
 
+from karmaworld.apps.notes.models import ConversionCache
 from karmaworld.apps.notes.models import Note
 
 class NoteAdmin(admin.ModelAdmin):
@@ -17,3 +18,12 @@ class NoteAdmin(admin.ModelAdmin):
     list_display = ('fp_file', 'upstream_link', 'name', 'id')
 
 admin.site.register(Note, NoteAdmin)
+
+
+class ConversionCacheAdmin(admin.ModelAdmin):
+    """ Shows which uploaded files were converted from the cache """
+    list_display = ('sha256', 'mimetype', 'note_id', 'hits', 'created_at', 'last_hit_at')
+    search_fields = ('sha256',)
+    exclude = ('text', 'html')
+
+admin.site.register(ConversionCache, ConversionCacheAdmin)
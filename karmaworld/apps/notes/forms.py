@@ -7,7 +7,7 @@ from django_filepicker.widgets import FPFileWidget
 from django.template.loader import render_to_string
 from karmaworld.utils.widgets import RichTextEditor
 
-from karmaworld.apps.notes.models import Note, NoteMarkdown
+from karmaworld.apps.notes.models import Note, NoteMarkdown, SearchIndexUpdate
 
 
 class NoteForm(ModelForm):
@@ -17,6 +17,8 @@ class NoteForm(ModelForm):
         # TODO: use transaction.atomic for this when we switch to Django 1.6+
         instance = super(NoteForm, self).save(*args, **kwargs)
         instance.tags.set(*self.cleaned_data['tags'])
+        # tags are not Note fields, so saving would not notice the change
+        SearchIndexUpdate.enqueue(instance.id, SearchIndexUpdate.ADD)
         if instance.is_hidden:
             instance.is_hidden = False
             instance.save()
@@ -2,15 +2,28 @@
 # -*- coding:utf8 -*-
 # Copyright (C) 2012  FinalsClub Foundation
 import base64
+import hashlib
 
 import datetime
 import logging
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.files.base import ContentFile
+from django.core.files.base import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.storage import get_storage_class
+from django.db import transaction
+from django.db.models import Max
+from storages.backends.s3boto import S3BotoStorage
+from karmaworld.apps.notes.models import ConversionCache
+from karmaworld.apps.notes.models import Note
 from karmaworld.apps.notes.models import UserUploadMapping
 from karmaworld.apps.notes.models import NoteMarkdown
+from karmaworld.apps.notes.models import SearchIndexUpdate
+from karmaworld.apps.notes.search import get_search_index
 from karmaworld.apps.notes import sanitizer
+from karmaworld.apps.notes.pdfconvert import pdf2html
 from karmaworld.apps.quizzes.models import Keyword
 from karmaworld.apps.users.models import NoteKarmaEvent
 import os
@@ -21,8 +34,10 @@ import magic
 import re
 import json
 import time
+from multiprocessing.pool import ThreadPool
 
 import httplib2
+import requests
 import html2text
 from apiclient.discovery import build
 from apiclient.http import MediaInMemoryUpload
@@ -37,6 +52,18 @@ GOOGLE_SERVICE_EMAIL = os.environ['GOOGLE_SERVICE_EMAIL']
 GOOGLE_SERVICE_KEY_BASE64 = os.environ['GOOGLE_SERVICE_KEY_BASE64']
 GOOGLE_USER = os.environ['GOOGLE_USER']
 
+def build_credentials():
+    """
+    Returns OAuth credentials of the service account acting on behalf of
+    GOOGLE_USER.
+    """
+    # Pull in the service's p12 private key.
+    p12 = base64.decodestring(GOOGLE_SERVICE_KEY_BASE64)
+    return SignedJwtAssertionCredentials(GOOGLE_SERVICE_EMAIL, p12,
+                               scope='https://www.googleapis.com/auth/drive',
+                               sub=GOOGLE_USER)
+
+
 def build_api_service():
     """
     Build and returns a Drive service object authorized with the service
@@ -49,55 +76,71 @@ def build_api_service():
     https://developers.google.com/drive/delegation
     """
 
-    # Pull in the service's p12 private key.
-    p12 = base64.decodestring(GOOGLE_SERVICE_KEY_BASE64)
-    credentials = SignedJwtAssertionCredentials(GOOGLE_SERVICE_EMAIL, p12,
-                               scope='https://www.googleapis.com/auth/drive',
-                               sub=GOOGLE_USER)
-
+    credentials = build_credentials()
     return build('drive', 'v2', http=credentials.authorize(httplib2.Http()))
 
 
-def pdf2html(content):
-    pdf_file = tempfile.NamedTemporaryFile()
-    pdf_file.write(content)
-    pdf_file.flush()
-    tmp_dir = tempfile.gettempdir()
-    html_file_name = uuid.uuid4().hex
-    html_file_path = os.path.join(tmp_dir, html_file_name)
-
-    command = ['pdf2htmlEX', pdf_file.name, html_file_name]
-    devnull = open('/dev/null', 'w')
-    if settings.TESTING:
-        call = subprocess.Popen(command, shell=False, cwd=tmp_dir, stdout=devnull, stderr=devnull)
-    else:
-        call = subprocess.Popen(command, shell=False, cwd=tmp_dir)
-    call.wait()
-    devnull.close()
-    if call.returncode != 0:
-        raise ValueError("PDF file could not be processed")
-
-    pdf_file.close()
-
-    try:
-        html_file = open(html_file_path, 'r')
-        html = html_file.read()
-        html_file.close()
-        os.remove(html_file_path)
-    except IOError, e:
-        raise ValueError("PDF file could not be processed")
+# Exports are downloaded in parallel, each given up on if the connection
+# stalls for GDRIVE_DOWNLOAD_TIMEOUT seconds, the whole download takes
+# longer than GDRIVE_DOWNLOAD_DEADLINE seconds or the export is bigger
+# than GDRIVE_MAX_EXPORT_BYTES.
+GDRIVE_DOWNLOAD_THREADS = 3
+GDRIVE_DOWNLOAD_TIMEOUT = 30
+GDRIVE_DOWNLOAD_DEADLINE = 300
+GDRIVE_MAX_EXPORT_BYTES = 100 * 1024 * 1024
+GDRIVE_DOWNLOAD_CHUNK = 64 * 1024
 
-    if len(html) == 0:
-        raise ValueError("PDF file results in empty HTML file")
 
-    return html
+class DownloadError(Exception):
+    pass
 
 
-def download_from_gdrive(service, file_dict, extension=None, mimetype=None):
-    """ Take in a gdrive service, file_dict from upload, and either an
-        extension or mimetype.
+def build_download_session(credentials):
+    """ Returns a requests session authorized by credentials, which keeps
+        a connection to Google for each download thread.
+    """
+    if credentials.access_token is None or credentials.access_token_expired:
+        credentials.refresh(httplib2.Http())
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=GDRIVE_DOWNLOAD_THREADS)
+    session.mount('https://', adapter)
+    session.headers['Authorization'] = 'Bearer ' + credentials.access_token
+    return session
+
+
+def download_to_file(session, url):
+    """ Stream url into a temporary file, which is returned rewound. """
+    deadline = time.time() + GDRIVE_DOWNLOAD_DEADLINE
+    response = session.get(url, stream=True, timeout=GDRIVE_DOWNLOAD_TIMEOUT)
+    try:
+        if response.status_code != 200:
+            raise DownloadError("HTTP status {0}".format(response.status_code))
+
+        size = 0
+        download = tempfile.TemporaryFile()
+        for chunk in response.iter_content(GDRIVE_DOWNLOAD_CHUNK):
+            size += len(chunk)
+            if size > GDRIVE_MAX_EXPORT_BYTES:
+                download.close()
+                raise DownloadError("larger than {0} bytes".format(GDRIVE_MAX_EXPORT_BYTES))
+            if time.time() > deadline:
+                download.close()
+                raise DownloadError("took longer than {0}s".format(GDRIVE_DOWNLOAD_DEADLINE))
+            download.write(chunk)
+    finally:
+        response.close()
+
+    download.seek(0)
+    return download
+
+
+def download_from_gdrive(session, file_dict, extension=None, mimetype=None):
+    """ Take in an authorized requests session, file_dict from upload,
+        and either an extension or mimetype.
         You must provide an `extension` or `mimetype`
-        Returns contextual files from google
+        Returns a dict of the downloaded exports as temporary files, and
+        a dict of error messages for the exports which failed.
     """
     download_urls = {}
     download_urls['text'] = file_dict[u'exportLinks']['text/plain']
@@ -113,24 +156,52 @@ def download_from_gdrive(service, file_dict, extension=None, mimetype=None):
     else:
         download_urls['html'] = file_dict[u'exportLinks']['text/html']
 
-    content_dict = {}
-    for download_type, download_url in download_urls.items():
-        print "\n%s -- %s" % (download_type, download_url)
-        resp, content = service._http.request(download_url)
+    def download(item):
+        download_type, download_url = item
+        try:
+            return download_type, download_to_file(session, download_url), None
+        except (DownloadError, requests.RequestException), e:
+            return download_type, None, str(e)
 
-        if resp.status in [200]:
-            print "\t downloaded!"
-            # save to the File.property resulting field
-            content_dict[download_type] = content
+    pool = ThreadPool(min(GDRIVE_DOWNLOAD_THREADS, len(download_urls)))
+    try:
+        results = pool.map(download, download_urls.items())
+    finally:
+        pool.close()
+        pool.join()
+
+    downloads, errors = {}, {}
+    for download_type, export_file, error in results:
+        if error:
+            logger.warning("Download of {0} export failed: {1}".format(download_type, error))
+            errors[download_type] = error
         else:
-            print "\t Download failed: %s" % resp.status
+            downloads[download_type] = export_file
+
+    return downloads, errors
+
+
+class ConversionNotReady(Exception):
+    """
+    Raised by a conversion stage which must run again after countdown
+    seconds, such as while Google Drive is still converting a document.
+    """
+    def __init__(self, countdown):
+        super(ConversionNotReady, self).__init__(countdown)
+        self.countdown = countdown
+
 
-    return content_dict
+# Poll Google Drive for exports this many times before giving up. The
+# delay doubles each time, from GDRIVE_FIRST_POLL_DELAY seconds; 8 polls
+# give Drive about two minutes.
+GDRIVE_MAX_POLLS = 8
+GDRIVE_FIRST_POLL_DELAY = 0.5
 
 
 def upload_to_gdrive(service, media, filename, extension=None, mimetype=None):
     """ take a gdrive service object, and a media wrapper and upload to gdrive
-        returns a file_dict
+        returns a file_dict, which may not have exportLinks yet
+        (see poll_gdrive).
         You must provide an `extension` or `mimetype`
     """
     _resource = {'title': filename}
@@ -143,90 +214,252 @@ def upload_to_gdrive(service, media, filename, extension=None, mimetype=None):
     ocr = extension in ['.pdf', '.jpeg', '.jpg', '.png'] or \
           mimetype in ['application/pdf']
 
-    file_dict = service.files().insert(body=_resource, media_body=media,\
-                                       convert=True, ocr=ocr).execute()
-
-    # increase exponent of 2 for exponential growth.
-    # 2 ** -1 = 0.5, 2 ** 0 = 1, 2 ** 1 = 2, 4, 8, 16, ...
-    delay_exp = -1
-    # exponentially wait for exportLinks to be returned if missing
-    while u'exportLinks' not in file_dict or \
-          u'text/plain' not in file_dict[u'exportLinks']:
-        # if a bunch  seconds have passed, give up
-        if delay_exp == 7:
-            raise ValueError('Google Drive failed to read the document.')
+    return service.files().insert(body=_resource, media_body=media,\
+                                  convert=True, ocr=ocr).execute()
 
-        # wait some seconds
-        print "upload_check_sleep({0})".format(2. ** delay_exp)
-        time.sleep(2. ** delay_exp)
-        delay_exp = delay_exp + 1
 
-        # try to get the doc from gdrive
-        file_dict = service.files().get(fileId=file_dict[u'id']).execute()
+def gdrive_exports_ready(file_dict):
+    return u'exportLinks' in file_dict and \
+           u'text/plain' in file_dict[u'exportLinks']
 
-    return file_dict
 
+def poll_gdrive(service, file_id):
+    """ Returns the file_dict of file_id, or None if its exports are not
+        ready yet.
+    """
+    file_dict = service.files().get(fileId=file_id).execute()
+    return file_dict if gdrive_exports_ready(file_dict) else None
 
-def convert_raw_document(raw_document, user=None):
-    """ Upload a raw document to google drive and get a Note back"""
-    fp_file = raw_document.get_file()
 
-    # extract some properties from the document metadata
-    filename = raw_document.name
-    print "this is the mimetype of the document to check:"
+# Artifacts passed between conversion stages are kept in artifact_storage().
+CONVERSION_PATH = 'conversions/{0}/{1}'
+
+_artifact_storage = None
+
+
+def artifact_storage():
+    """
+    Storage for conversion artifacts, which include the uploaded files.
+    Stages may run on different machines, so with S3 storage artifacts
+    share the bucket, but unlike the rest of it they are private. Local
+    storage keeps them in a temporary directory rather than MEDIA_ROOT.
+    """
+    global _artifact_storage
+    if _artifact_storage is None:
+        if issubclass(get_storage_class(), S3BotoStorage):
+            _artifact_storage = S3BotoStorage(acl='private', headers={}, location='',
+                                              querystring_auth=True)
+        else:
+            _artifact_storage = FileSystemStorage(
+                location=os.path.join(tempfile.gettempdir(), 'karmaworld-conversions'))
+    return _artifact_storage
+
+
+def new_conversion_job(raw_document, user=None):
+    """
+    Returns the job passed between conversion stages. It only holds JSON
+    types, so it can travel in task messages; file contents are stored as
+    artifacts.
+    """
     mimetype = raw_document.mimetype
-    print mimetype
-    print ""
+    return {
+        'id': uuid.uuid4().hex,
+        'raw_document_id': raw_document.id,
+        'user_id': user.id if user and not user.is_anonymous() else None,
+        'filename': raw_document.name,
+        'mimetype': mimetype,
+        # A special case for Evernotes
+        'upload_mimetype': 'text/html' if mimetype == 'text/enml' else mimetype,
+        'artifacts': {},
+        'timings': {},
+    }
+
+
+def save_artifact(job, name, content):
+    """ Store content, a string or file, as the artifact name of job """
+    if isinstance(content, basestring):
+        content = ContentFile(content)
+    else:
+        content = File(content)
+    path = CONVERSION_PATH.format(job['id'], name)
+    job['artifacts'][name] = artifact_storage().save(path, content)
+
+
+def read_artifact(job, name):
+    artifact = artifact_storage().open(job['artifacts'][name])
+    try:
+        return artifact.read()
+    finally:
+        artifact.close()
+
 
-    # A special case for Evernotes
-    if raw_document.mimetype == 'text/enml':
-        raw_document.mimetype = 'text/html'
+def delete_artifacts(job):
+    for path in job['artifacts'].values():
+        artifact_storage().delete(path)
+    job['artifacts'] = {}
 
-    original_content = fp_file.read()
 
-    # Include mimetype parameter if there is one to include
-    extra_flags = {'mimetype': raw_document.mimetype} if raw_document.mimetype \
-                  else {}
-    media = MediaInMemoryUpload(original_content, chunksize=1024*1024, \
-                                resumable=True, **extra_flags)
+def fetch_document(job, raw_document):
+    """
+    Stage: copy the uploaded file from Filepicker. If the same file was
+    converted before, skip straight to persisting the cached conversion.
+    """
+    content = raw_document.get_file().read()
+    job['sha256'] = hashlib.sha256(content).hexdigest()
+    _save_raw_document_fields(raw_document, sha256=job['sha256'])
+
+    cached = ConversionCache.lookup(job['sha256'], job['upload_mimetype'])
+    if cached:
+        job['cache_id'] = cached.id
+        job['skip_to'] = 'persist'
+    else:
+        save_artifact(job, 'original', content)
 
 
+def _save_raw_document_fields(raw_document, **fields):
+    for attname, value in fields.items():
+        setattr(raw_document, attname, value)
+    if raw_document.pk:
+        type(raw_document).objects.filter(pk=raw_document.pk).update(**fields)
+
+
+def convert_document(job, raw_document):
+    """
+    Stage: have Google Drive convert the document.
+    Raises ConversionNotReady while Drive is still working on it; the
+    stage then resumes from the file id kept on the RawDocument.
+    """
     service = build_api_service()
+    if raw_document.gdrive_file_id:
+        file_dict = poll_gdrive(service, raw_document.gdrive_file_id)
+    else:
+        # Include mimetype parameter if there is one to include
+        extra_flags = {'mimetype': job['upload_mimetype']} if job['upload_mimetype'] \
+                      else {}
+        media = MediaInMemoryUpload(read_artifact(job, 'original'), chunksize=1024*1024, \
+                                    resumable=True, **extra_flags)
+        file_dict = upload_to_gdrive(service, media, job['filename'], mimetype=job['mimetype'])
+        _save_raw_document_fields(raw_document, gdrive_file_id=file_dict[u'id'], gdrive_polls=0)
+        if not gdrive_exports_ready(file_dict):
+            file_dict = None
+
+    if file_dict is None:
+        polls = raw_document.gdrive_polls + 1
+        if polls > GDRIVE_MAX_POLLS:
+            _save_raw_document_fields(raw_document, gdrive_file_id=None, gdrive_polls=0)
+            raise ValueError('Google Drive failed to read the document.')
+        _save_raw_document_fields(raw_document, gdrive_polls=polls)
+        raise ConversionNotReady(GDRIVE_FIRST_POLL_DELAY * 2 ** (polls - 1))
+
+    job['gdrive'] = {
+        'id': file_dict[u'id'],
+        'alternateLink': file_dict[u'alternateLink'],
+        'exportLinks': file_dict[u'exportLinks'],
+    }
+
+
+def extract_document(job, raw_document):
+    """ Stage: download the text and other exports from Google Drive """
+    session = build_download_session(build_credentials())
+    downloads, errors = download_from_gdrive(session, job['gdrive'], mimetype=job['mimetype'])
+    # kept with the job, and so in the upload status, by download type
+    job['errors'] = errors
+    for download_type, export_file in downloads.items():
+        try:
+            save_artifact(job, download_type, export_file)
+        finally:
+            export_file.close()
+
+    # Without the HTML export the note is still usable as text
+    required = [download_type for download_type in errors if download_type != 'html']
+    if required:
+        raise ValueError("Google Drive exports could not be downloaded: " +
+                         ", ".join("{0} ({1})".format(t, errors[t]) for t in required))
+
+
+def render_document(job, raw_document):
+    """ Stage: choose or render the HTML of the document """
+    if job['upload_mimetype'] == PDF_MIMETYPE:
+        pdf = 'original'
+    elif job['upload_mimetype'] in PPT_MIMETYPES:
+        pdf = 'pdf'
+    else:
+        if 'html' in job['artifacts']:
+            job['artifacts']['rendered.html'] = job['artifacts']['html']
+        return
+
+    pdf_file = artifact_storage().open(job['artifacts'][pdf])
+    try:
+        html_file = pdf2html(pdf_file)
+    finally:
+        pdf_file.close()
+    try:
+        save_artifact(job, 'rendered.html', html_file)
+    finally:
+        html_file.close()
+
 
-    # upload to google drive
-    file_dict = upload_to_gdrive(service, media, filename, mimetype=mimetype)
+def sanitize_document(job, raw_document):
+    """ Stage: sanitize the HTML and move embedded assets to S3 """
+    if 'rendered.html' in job['artifacts']:
+        # sanitized as NoteMarkdown.save would, which can then skip it
+        job['editable'] = raw_document.category in Note.EDITABLE_CATEGORIES
+        html = sanitizer.sanitize_uploaded_html(read_artifact(job, 'rendered.html'),
+                                                job['editable'])
+        save_artifact(job, 'sanitized.html', html)
 
-    # download from google drive
-    content_dict = download_from_gdrive(service, file_dict, mimetype=mimetype)
 
+def persist_document(job, raw_document):
+    """ Stage: turn the RawDocument into a Note """
+    if raw_document.is_processed:
+        # persisted by an earlier run of this stage, whose message was
+        # delivered again
+        notes = Note.objects.filter(fp_file=raw_document.fp_file.name).order_by('id')[:1]
+        if notes:
+            job['note_id'] = notes[0].id
+            return
+
+    # so that a failed run leaves nothing behind for its retry to repeat
+    with transaction.commit_on_success():
+        _persist_document(job, raw_document)
+
+
+def _persist_document(job, raw_document):
     # this should have already happened, lets see why it hasn't
+    raw_document.mimetype = job['upload_mimetype']
     raw_document.is_processed = True
     raw_document.save()
 
     note = raw_document.convert_to_note()
+    job['note_id'] = note.id
 
-    # Cache the uploaded file's URL
-    note.gdrive_url = file_dict['alternateLink']
-    note.text = content_dict['text']
-
-    # Extract HTML from the appropriate place
-    html = ''
-    if raw_document.mimetype == PDF_MIMETYPE:
-        html = pdf2html(original_content)
-    elif raw_document.mimetype in PPT_MIMETYPES:
-        html = pdf2html(content_dict['pdf'])
-    elif 'html' in content_dict and content_dict['html']:
-        html = content_dict['html']
-
+    if job.get('cache_id'):
+        cached = ConversionCache.objects.get(id=job['cache_id'])
+        text, html = cached.text, cached.html
+        sanitized = cached.editable == note.is_editable()
+    else:
+        # Cache the uploaded file's URL
+        note.gdrive_url = job['gdrive']['alternateLink']
+        text = read_artifact(job, 'text') if 'text' in job['artifacts'] else None
+        html = read_artifact(job, 'sanitized.html') if 'sanitized.html' in job['artifacts'] \
+               else None
+        sanitized = True
+        # A conversion missing an export may have met a passing Drive
+        # error, so it is not reused for later uploads of the file.
+        if not job.get('errors') and html is not None:
+            ConversionCache.store(job['sha256'], job['upload_mimetype'], text=text, html=html,
+                                  editable=job.get('editable', False), note_id=note.id)
+
+    if text:
+        note.text = text
     if html:
-        html = sanitizer.data_uris_to_s3(html)
-        NoteMarkdown.objects.create(note=note, html=html)
+        NoteMarkdown(note=note, html=html).save(sanitized=sanitized)
 
     # If we know the user who uploaded this,
     # associate them with the note
-    if user and not user.is_anonymous():
-        note.user = user
-        NoteKarmaEvent.create_event(user, note, NoteKarmaEvent.UPLOAD)
+    if job['user_id']:
+        note.user = User.objects.get(id=job['user_id'])
+        NoteKarmaEvent.create_event(note.user, note, NoteKarmaEvent.UPLOAD)
     else:
         try:
             mapping = UserUploadMapping.objects.get(fp_file=raw_document.fp_file)
@@ -240,6 +473,49 @@ def convert_raw_document(raw_document, user=None):
     note.save()
 
 
+def index_document(job, raw_document):
+    """ Stage: make the new note searchable without waiting for the queue """
+    # the note was queued when it was saved; changes queued after it is
+    # read below are not in what is sent, so they stay queued
+    queued = SearchIndexUpdate.objects.filter(note_id=job['note_id'],
+                                              action=SearchIndexUpdate.ADD) \
+                                      .aggregate(last=Max('id'))['last']
+    note = Note.objects.get(id=job['note_id'])
+    refused = get_search_index().add_notes([note])
+    if note.id not in refused and queued is not None:
+        SearchIndexUpdate.objects.filter(note_id=note.id, action=SearchIndexUpdate.ADD,
+                                         id__lte=queued).delete()
+    delete_artifacts(job)
+
+
+# The stages of converting a RawDocument into a Note, in order. Each runs
+# as its own task; see document_upload.tasks. A stage may name a later
+# stage to continue from in job['skip_to'].
+CONVERSION_STAGES = (
+    ('fetch', fetch_document),
+    ('convert', convert_document),
+    ('extract', extract_document),
+    ('render', render_document),
+    ('sanitize', sanitize_document),
+    ('persist', persist_document),
+    ('index', index_document),
+)
 
 
-
+def convert_raw_document(raw_document, user=None):
+    """ Run every conversion stage in this process and return the Note """
+    job = new_conversion_job(raw_document, user)
+    try:
+        for stage, run in CONVERSION_STAGES:
+            if job.get('skip_to') not in (None, stage):
+                continue
+            job.pop('skip_to', None)
+            while True:
+                try:
+                    run(job, raw_document)
+                    break
+                except ConversionNotReady, e:
+                    time.sleep(e.countdown)
+    finally:
+        delete_artifacts(job)
+    return Note.objects.get(id=job['note_id'])
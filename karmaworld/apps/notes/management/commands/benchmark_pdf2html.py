@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from karmaworld.apps.notes.pdfconvert import PDF2HTML_PROCESSES
+from karmaworld.apps.notes.pdfconvert import pdf2html
+
+
+def convert(path):
+    """ Returns (path, seconds, bytes of HTML, error) """
+    started = time.time()
+    try:
+        with open(path, 'rb') as pdf_file:
+            html_file = pdf2html(pdf_file)
+        html_file.seek(0, os.SEEK_END)
+        size = html_file.tell()
+        html_file.close()
+        return path, time.time() - started, size, None
+    except Exception, e:
+        return path, time.time() - started, 0, str(e)
+
+
+class Command(BaseCommand):
+    args = '<pdf file or directory> ...'
+    help = "Convert a corpus of sample PDFs with pdf2htmlEX, as the render " \
+           "stage of document conversion does, and report timings."
+
+    def handle(self, *args, **kwargs):
+        paths = []
+        for arg in args:
+            if os.path.isdir(arg):
+                paths.extend(sorted(os.path.join(arg, name) for name in os.listdir(arg)
+                                    if name.lower().endswith('.pdf')))
+            else:
+                paths.append(arg)
+        if not paths:
+            raise CommandError("No PDF files given")
+
+        started = time.time()
+        pool = ThreadPool(PDF2HTML_PROCESSES)
+        results = pool.map(convert, paths)
+        pool.close()
+        pool.join()
+        elapsed = time.time() - started
+
+        failures = 0
+        pdf_bytes = html_bytes = 0
+        for path, seconds, size, error in results:
+            pdf_bytes += os.path.getsize(path)
+            html_bytes += size
+            if error:
+                failures += 1
+                print "{0}: failed after {1:.2f}s: {2}".format(path, seconds, error)
+            else:
+                print "{0}: {1:.2f}s, {2} bytes of HTML".format(path, seconds, size)
+
+        print "Converted {0} of {1} PDFs in {2:.2f}s, {3:.2f} PDFs/s, " \
+              "{4:.2f} MB of PDF/s, {5} bytes of HTML".format(
+              len(results) - failures, len(results), elapsed,
+              len(results) / elapsed, pdf_bytes / elapsed / 1024 / 1024, html_bytes)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from karmaworld.apps.notes import sanitizer
+
+# Runs of each pipeline per file; the fastest is reported.
+REPEAT = 3
+CANONICAL_HREF = 'https://www.karmanotes.org/benchmark'
+
+
+def chain(html, editable):
+    """ The separate passes an upload used to go through """
+    html = sanitizer.data_uris_to_s3(html)
+    if editable:
+        html = sanitizer.sanitize_html_to_editable(html)
+    else:
+        html = sanitizer.sanitize_html_preserve_formatting(html)
+    return sanitizer.set_canonical_rel(html, CANONICAL_HREF)
+
+
+def fused(html, editable):
+    return sanitizer.sanitize_uploaded_html(html, editable, CANONICAL_HREF)
+
+
+def fake_s3_upload_all(files):
+    pass
+
+
+def best_time(pipeline, html, editable):
+    times = []
+    for i in range(REPEAT):
+        started = time.time()
+        pipeline(html, editable)
+        times.append(time.time() - started)
+    return min(times)
+
+
+class Command(BaseCommand):
+    args = '<html file or directory> ...'
+    help = "Time sanitizing HTML files, such as pdf2htmlEX output, with the " \
+           "single pass sanitize_uploaded_html against the separate " \
+           "data_uris_to_s3, sanitize and set_canonical_rel passes. Data " \
+           "URI's are not uploaded to S3, so only parsing is timed."
+
+    def handle(self, *args, **kwargs):
+        paths = []
+        for arg in args:
+            if os.path.isdir(arg):
+                paths.extend(sorted(os.path.join(arg, name) for name in os.listdir(arg)
+                                    if name.lower().endswith(('.html', '.htm'))))
+            else:
+                paths.append(arg)
+        if not paths:
+            raise CommandError("No HTML files given")
+
+        upload = sanitizer._s3_upload_all
+        sanitizer._s3_upload_all = fake_s3_upload_all
+        try:
+            totals = {'chain': 0, 'fused': 0}
+            for path in paths:
+                with open(path, 'r') as html_file:
+                    html = html_file.read().decode('utf8', 'replace')
+                for editable in (False, True):
+                    try:
+                        chain_time = best_time(chain, html, editable)
+                        fused_time = best_time(fused, html, editable)
+                    except Exception, e:
+                        print "{0}: failed: {1}".format(path, e)
+                        continue
+                    totals['chain'] += chain_time
+                    totals['fused'] += fused_time
+                    print "{0} ({1}, {2} bytes): chain {3:.3f}s, fused {4:.3f}s, " \
+                          "{5:.1f}x".format(path, 'editable' if editable else 'formatted',
+                                            len(html), chain_time, fused_time,
+                                            chain_time / fused_time)
+        finally:
+            sanitizer._s3_upload_all = upload
+
+        if totals['fused']:
+            print "Total: chain {0:.3f}s, fused {1:.3f}s, {2:.1f}x".format(
+                  totals['chain'], totals['fused'], totals['chain'] / totals['fused'])
@@ -2,19 +2,42 @@
 # -*- coding:utf8 -*-
 # Copyright (C) 2013  FinalsClub Foundation
 
+import time
 import traceback
-from django.core.management.base import BaseCommand
-from karmaworld.apps.notes.models import Note
-from karmaworld.apps.notes.search import SearchIndex
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_connection
+from karmaworld.apps.notes.models import Note, SearchIndexUpdate
+from karmaworld.apps.notes.search import get_search_index, prefetch_tags
+from karmaworld.apps.notes.tasks import INDEX_DOCUMENTS_PER_REQUEST, _chunks
+
+# Notes are read from the database this many at a time, in order of id,
+# and sent to the index INDEX_DOCUMENTS_PER_REQUEST per request.
+CHUNK_SIZE = 500
+# Requests to the index in flight at once
+INDEX_THREADS = 4
+
 
 class Command(BaseCommand):
-    args = 'none'
-    help = "Populate the search index in IndexDen with all the notes" \
+    args = '[bulk [<note id>]]'
+    help = "Populate the configured search index with all the notes" \
            "in the database. Will not clear the index beforehand, so notes" \
-           "in the index that are not overwritten will still be around."
+           "in the index that are not overwritten will still be around. " \
+           "With bulk, notes are sent in batches, several at a time, and " \
+           "the last note id sent is printed as they go; given that id, " \
+           "an interrupted bulk run carries on after it."
 
     def handle(self, *args, **kwargs):
-        index = SearchIndex()
+        if args and args[0] == 'bulk':
+            try:
+                after = int(args[1]) if len(args) > 1 else 0
+            except ValueError:
+                raise CommandError("Expected the id of the note to carry on after, not {0}".format(args[1]))
+            self.populate_bulk(after)
+            return
+
+        index = get_search_index()
         for note in Note.objects.iterator():
             try:
                 print "Indexing {n}".format(n=note)
@@ -23,3 +46,57 @@ class Command(BaseCommand):
                 traceback.print_exc()
                 continue
 
+    def populate_bulk(self, after):
+        index = get_search_index()
+        notes = Note.objects.filter(text__isnull=False).exclude(text='').order_by('id') \
+                            .only('id', 'name', 'text', 'course', 'uploaded_at', 'thanks')
+        total = notes.filter(id__gt=after).count()
+        print "Indexing {0} notes after note {1}".format(total, after)
+
+        def send(batch):
+            try:
+                return index.add_notes(batch)
+            except Exception:
+                traceback.print_exc()
+                return [note.id for note in batch]
+            finally:
+                # the local index writes from this thread
+                close_connection()
+
+        pool = ThreadPool(INDEX_THREADS)
+        started = time.time()
+        indexed = 0
+        failed = 0
+        last_id = after
+        sending = None
+        try:
+            while True:
+                # read the next chunk while the last one is being sent
+                chunk = list(notes.filter(id__gt=last_id)[:CHUNK_SIZE])
+                if chunk:
+                    prefetch_tags(chunk)
+                    last_id = chunk[-1].id
+
+                if sending:
+                    sent_chunk, result = sending
+                    refused = [note_id for batch_refused in result.get()
+                               for note_id in batch_refused]
+                    # the queue retries them, with backoff
+                    for note_id in refused:
+                        SearchIndexUpdate.enqueue(note_id, SearchIndexUpdate.ADD)
+                    indexed += len(sent_chunk) - len(refused)
+                    failed += len(refused)
+                    elapsed = max(time.time() - started, 0.001)
+                    # every note up to the last of the chunk has been sent
+                    print "Indexed {0} of {1} notes, {2:.1f} notes/s, {3} queued to retry, " \
+                          "up to note {4}".format(indexed, total, (indexed + failed) / elapsed,
+                                                  failed, sent_chunk[-1].id)
+
+                if not chunk:
+                    break
+                sending = (chunk, pool.map_async(send, list(_chunks(chunk, INDEX_DOCUMENTS_PER_REQUEST))))
+        finally:
+            pool.close()
+            pool.join()
+
+        print "Done in {0:.0f}s".format(time.time() - started)
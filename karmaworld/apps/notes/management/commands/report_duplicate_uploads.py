@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+from karmaworld.apps.document_upload.models import RawDocument
+from karmaworld.apps.notes.models import ConversionCache
+from karmaworld.apps.notes.models import Note
+
+
+class Command(BaseCommand):
+    args = '[minimum copies]'
+    help = "List files uploaded more than once (or at least the given number " \
+           "of times), identified by the SHA-256 of their contents, with the " \
+           "course and note of every copy."
+
+    def handle(self, *args, **kwargs):
+        minimum = int(args[0]) if args else 2
+        duplicates = RawDocument.objects.filter(sha256__isnull=False) \
+                                        .values('sha256') \
+                                        .annotate(copies=Count('id')) \
+                                        .filter(copies__gte=minimum) \
+                                        .order_by('-copies')
+
+        for duplicate in duplicates:
+            print "{sha256}: uploaded {copies} times".format(**duplicate)
+            raw_documents = RawDocument.objects.filter(sha256=duplicate['sha256']) \
+                                               .select_related('course') \
+                                               .order_by('uploaded_at')
+            # notes keep the Filepicker link of the file they came from
+            notes = dict(Note.objects.filter(fp_file__in=[r.fp_file.name for r in raw_documents])
+                                     .values_list('fp_file', 'id'))
+            for raw_document in raw_documents:
+                note_id = notes.get(raw_document.fp_file.name)
+                print u"    {0} {1}: {2} ({3})".format(
+                    raw_document.uploaded_at, raw_document.course, raw_document.name,
+                    "note {0}".format(note_id) if note_id else "not converted")
+
+        hits = ConversionCache.objects.aggregate(Sum('hits'))['hits__sum'] or 0
+        print "{0} files uploaded at least {1} times; {2} conversions served " \
+              "from the cache".format(len(duplicates), minimum, hits)
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from karmaworld.apps.notes import sanitizer
+from karmaworld.apps.notes.models import NoteMarkdown
+
+# Rows are loaded this many at a time, as their html can be large.
+CHUNK_SIZE = 100
+
+
+class Command(BaseCommand):
+    args = 'none'
+    help = "Sanitize the html of every note again which was last sanitized " \
+           "by an older version of the sanitizer."
+
+    def handle(self, *args, **kwargs):
+        stale = NoteMarkdown.objects.filter(~Q(sanitizer_version=sanitizer.SANITIZER_VERSION),
+                                            html__isnull=False)
+        ids = list(stale.values_list('note_id', flat=True).order_by('note_id'))
+        print "{0} notes to sanitize with version {1}".format(len(ids), sanitizer.SANITIZER_VERSION)
+
+        sanitized = 0
+        for start in xrange(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start + CHUNK_SIZE]
+            for note_markdown in NoteMarkdown.objects.filter(note_id__in=chunk) \
+                                                     .select_related('note'):
+                try:
+                    note_markdown.save()
+                    sanitized += 1
+                except Exception, e:
+                    print "Note {0}: {1}".format(note_markdown.note_id, e)
+            print "Sanitized {0} of {1}".format(sanitized, len(ids))
@@ -8,24 +8,24 @@
 """
 import os
 import time
+import hashlib
 import urllib
 import logging
 import datetime
-import traceback
 
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.core.urlresolvers import reverse
 from django.utils.safestring import mark_safe
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-from django.core.files.storage import default_storage
 from django.db.models import SET_NULL
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.conf import settings
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.db import models
+from django.db import IntegrityError, transaction
 from django.utils.text import slugify
 
 import markdown
@@ -37,12 +37,12 @@ from karmaworld.apps.notes import sanitizer
 from karmaworld.apps.users.models import UserProfile
 from karmaworld.apps.users.models import NoteKarmaEvent
 from karmaworld.apps.users.models import GenericKarmaEvent
-from karmaworld.apps.notes.search import SearchIndex
 from karmaworld.apps.courses.models import Course
 from karmaworld.apps.licenses.models import License
 
 from karmaworld.utils.filepicker import sign_fp_policy
 from karmaworld.utils.filepicker import encode_fp_policy
+from karmaworld.utils import s3
 
 from karmaworld.settings.manual_unique_together import auto_add_check_unique_together
 
@@ -59,11 +59,6 @@ s3_upload_headers = {
     'Content-Type': 'text/html',
 }
 
-# This is a bit hacky, but nothing else works. Grabbed this from a proper
-# file configured via S3 management console.
-# https://github.com/FinalsClub/karmaworld/issues/273#issuecomment-32572169
-all_read_xml_acl = '<?xml version="1.0" encoding="UTF-8"?>\n<AccessControlPolicy xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Owner><ID>710efc05767903a0eae5064bbc541f1c8e68f8f344fa809dc92682146b401d9c</ID><DisplayName>Andrew</DisplayName></Owner><AccessControlList><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="CanonicalUser"><ID>710efc05767903a0eae5064bbc541f1c8e68f8f344fa809dc92682146b401d9c</ID><DisplayName>Andrew</DisplayName></Grantee><Permission>READ</Permission></Grant><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="CanonicalUser"><ID>710efc05767903a0eae5064bbc541f1c8e68f8f344fa809dc92682146b401d9c</ID><DisplayName>Andrew</DisplayName></Grantee><Permission>WRITE</Permission></Grant><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="CanonicalUser"><ID>710efc05767903a0eae5064bbc541f1c8e68f8f344fa809dc92682146b401d9c</ID><DisplayName>Andrew</DisplayName></Grantee><Permission>READ_ACP</Permission></Grant><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="CanonicalUser"><ID>710efc05767903a0eae5064bbc541f1c8e68f8f344fa809dc92682146b401d9c</ID><DisplayName>Andrew</DisplayName></Grantee><Permission>WRITE_ACP</Permission></Grant><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:type="Group"><URI>http://acs.amazonaws.com/groups/global/AllUsers</URI></Grantee><Permission>READ</Permission></Grant></AccessControlList></AccessControlPolicy>'
-
 
 class Document(models.Model):
     """
@@ -234,10 +229,20 @@ class Note(Document):
     tweeted         = models.BooleanField(default=False)
     thanks          = models.PositiveIntegerField(default=0)
 
+    # Changes to these require the whole search document to be sent again.
+    # Changes to thanks only need the document's variables updated.
+    INDEXED_ATTNAMES = ('name', 'text', 'course_id', 'uploaded_at')
+    # Fields whose loaded values are remembered to tell what a save changed.
+    TRACKED_ATTNAMES = INDEXED_ATTNAMES + ('thanks', 'is_hidden')
+
     class Meta:
         unique_together = ('fp_file', 'upstream_link')
         ordering = ['-uploaded_at']
 
+    def __init__(self, *args, **kwargs):
+        super(Note, self).__init__(*args, **kwargs)
+        self.remember_loaded_state()
+
     def __unicode__(self):
         return u"Note at {0} (from {1}) ({2})".format(self.fp_file, self.upstream_link, self.id)
 
@@ -251,6 +256,33 @@ class Note(Document):
         # gdrive_url might also fit the bill?
         return (self.fp_file, self.upstream_link)
 
+    def remember_loaded_state(self):
+        """
+        Remember the values of the tracked fields, so that saving can tell
+        what changed without reading the row again.
+        Deferred fields are not loaded for this; they are taken to be
+        unchanged, as what they were loaded with is not known.
+        """
+        # deferred fields are not in __dict__ until first read
+        self._loaded_state = dict((attname, self.__dict__[attname])
+                                  for attname in self.TRACKED_ATTNAMES
+                                  if attname in self.__dict__)
+
+    def loaded_value(self, attname):
+        """ Returns the value a tracked field was loaded with. """
+        if attname not in self._loaded_state:
+            # deferred when loaded, so taken to be unchanged
+            return getattr(self, attname)
+        return self._loaded_state[attname]
+
+    def changed_fields(self):
+        """
+        Returns the set of tracked fields which differ from the values
+        they were loaded with.
+        """
+        return set(attname for attname, value in self._loaded_state.iteritems()
+                   if self.__dict__.get(attname) != value)
+
     def get_relative_s3_path(self):
         """
         returns s3 path relative to the appropriate bucket.
@@ -269,20 +301,8 @@ class Note(Document):
         if not html or not len(html):
             return
         # upload the HTML file to static host if it is not already there
-        filepath = self.get_relative_s3_path()
-        if not default_storage.exists(filepath):
-            # This is a pretty ugly hackified answer to some s3boto shortcomings
-            # and some decent default settings chosen by django-storages.
-
-            # Create the new key (key == filename in S3 bucket)
-            newkey = default_storage.bucket.new_key(filepath)
-            # Upload data!
-            newkey.set_contents_from_string(html, headers=s3_upload_headers)
-            if not newkey.exists():
-                raise LookupError('Unable to find uploaded S3 document {0}'.format(str(newkey)))
-
-            # set the permissions for everyone to read.
-            newkey.set_xml_acl(all_read_xml_acl)
+        s3.put(self.get_relative_s3_path(), 'text/html', html,
+               headers=s3_upload_headers, overwrite=False)
 
     def update_note_on_s3(self, html):
         # do nothing if HTML is empty.
@@ -290,13 +310,11 @@ class Note(Document):
             return
         # if it's not already there then bail out
         filepath = self.get_relative_s3_path()
-        if not default_storage.exists(filepath):
+        if not s3.exists(filepath):
             logger.warn("Cannot update note on S3, it does not exist already: " + unicode(self))
             return
 
-        key = default_storage.bucket.get_key(filepath)
-        key.set_contents_from_string(html, headers=s3_upload_headers)
-        key.set_xml_acl(all_read_xml_acl)
+        s3.put(filepath, 'text/html', html, headers=s3_upload_headers)
 
     def remaining_thanks_for_mturk(self):
         return KEYWORD_MTURK_THRESHOLD - self.thanks
@@ -355,7 +373,8 @@ class Note(Document):
         """ update the parent Course.updated_at model
             with the latest uploaded_at """
         self.course.updated_at = self.uploaded_at
-        self.course.save()
+        # Saving the whole course would overwrite its note counts
+        Course.objects.filter(pk=self.course_id).update(updated_at=self.uploaded_at)
 
     def save(self, *args, **kwargs):
         if self.uploaded_at and self.uploaded_at > self.course.updated_at:
@@ -372,113 +391,180 @@ class Note(Document):
         return self.category in Note.EDITABLE_CATEGORIES
 
 
-    def allows_edit_by(self, user, cache={}):
+    def allows_edit_by(self, user):
         """
-        Security policy for editing notes. Hand rolled for now.
-        cache is a dictionary to return some calculated info pass-by-ref.
-          (does nothing, maintained for consistency)
+        Security policy for editing notes.
         Returns True if the user can edit the note.
-        Checks if the user can tag and the note is editable.
+        See NotePermissions.can_edit().
         """
-        # Of course the note must be editable in the first place.
-        # If so, user must be able to tag note to edit it.
-        return self.is_editable() and self.allows_tags_by(user)
+        return NotePermissions(user).can_edit(self)
 
-    def allows_tags_by(self, user, cache={}):
+    def allows_tags_by(self, user):
         """
-        Security policy for tagging notes. Hand rolled for now.
-        cache is a dictionary to return some calculated info pass-by-ref.
-        Returns True if the user can edit the note.
-        Checks if the user can delete and there are enough points to tag.
+        Security policy for tagging notes.
+        Returns True if the user can tag the note.
+        See NotePermissions.can_tag().
         """
-        # If the user cannot delete the note, the user cannot add tags.
-        if not self.allows_delete_by(user, cache):
-            return False
-        # Staff can edit, no worries about points.
-        if cache.has_key('staff') and cache['staff']:
-            return True
-        # Users must have 20 points to edit tags.
-        if cache.has_key('profile'):
-            # make sure to update points, caching is really just for passing
-            # back in the call stack, not caching for long periods.
-            cache['points'] = cache['profile'].get_points()
-        return cache.has_key('points') and cache['points'] >= 20
+        return NotePermissions(user).can_tag(self)
 
-    def allows_delete_by(self, user, cache={}):
+    def allows_delete_by(self, user):
         """
-        Security policy for deleting notes. Hand rolled for now.
-        cache is a dictionary to return some calculated info pass-by-ref
+        Security policy for deleting notes.
         Returns True if the user can delete the note.
-        Checks if user is admin or owns the note.
+        See NotePermissions.can_delete().
+        """
+        return NotePermissions(user).can_delete(self)
+
+
+class NotePermissions(object):
+    """
+    Security policies for editing, tagging and deleting notes. Hand rolled for
+    now.
+
+    The user's profile, staff status and points are looked up once when this
+    object is built, after which any number of notes may be checked against
+    it without touching the database. Use for_request() to share one
+    instance for the life of a request.
+    """
+    # Users must have this many points to edit tags.
+    TAG_POINTS = 20
+
+    def __init__(self, user):
         """
+        user may be a User (possibly anonymous) or a UserProfile.
+        """
+        self.user_id = None
+        self.staff = False
+        self.points = 0
+
         # do not allow unauthenticated users access
         if hasattr(user, 'is_authenticated') and not user.is_authenticated():
+            return
+
+        if hasattr(user, 'has_staff_status'):
+            # already a UserProfile
+            profile = user
+            self.user_id = profile.user_id
+            self.staff = profile.has_staff_status()
+        else:
+            # assume it's a regular User and resolve its profile
+            self.user_id = user.id
+            self.staff = user.is_staff
+            try:
+                profile = UserProfile.objects.get(user_id=user.id)
+            except UserProfile.DoesNotExist:
+                return
+        self.points = profile.get_points()
+
+    @classmethod
+    def for_request(cls, request):
+        """
+        Return the NotePermissions of request.user, memoized on the request,
+        so the profile is looked up at most once per request and points
+        earned since are seen by the next one.
+        """
+        permissions = getattr(request, '_note_permissions', None)
+        if permissions is None:
+            permissions = cls(request.user)
+            request._note_permissions = permissions
+        return permissions
+
+    def can_delete(self, note):
+        """
+        True if the user is staff or owns the note.
+        """
+        if self.user_id is None:
             return False
-        cache['user'] = user
-        # ensure user is a UserProfile by contract.
-        if not hasattr(user, 'has_staff_status'):
-            # assume it's a regular User and try to resolve it
-            user = UserProfile.objects.get(user_id=user.id)
-        cache['profile'] = user
         # if the user is staff, the user can delete.
-        cache['staff'] = False
-        if user.has_staff_status():
-            cache['staff'] = True
+        if self.staff:
             return True
         # apparently some notes are un-owned. so, user is not the owner.
-        if self.user is None:
-            return False
-        # pull user id for this note
-        owner_id = self.user.id
         # Note owner may edit, others may not.
-        return owner_id == user.get_id()
+        return note.user_id is not None and note.user_id == self.user_id
+
+    def can_tag(self, note):
+        """
+        True if the user can delete the note and is either staff or has
+        enough points to tag.
+        """
+        # If the user cannot delete the note, the user cannot add tags.
+        if not self.can_delete(note):
+            return False
+        # Staff can edit, no worries about points.
+        return self.staff or self.points >= self.TAG_POINTS
+
+    def can_edit(self, note):
+        """
+        True if the note is editable and the user can tag it.
+        """
+        # Of course the note must be editable in the first place.
+        # If so, user must be able to tag note to edit it.
+        return note.is_editable() and self.can_tag(note)
 
 class NoteMarkdown(models.Model):
     note     = models.OneToOneField(Note, primary_key=True)
     markdown = models.TextField(blank=True, null=True)
     html     = models.TextField(blank=True, null=True)
+    # html_hash is sanitized_hash() of html as last sanitized, by version
+    # sanitizer_version of the sanitizer; saving it unchanged skips the parse.
+    html_hash         = models.CharField(max_length=64, blank=True, null=True)
+    sanitizer_version = models.PositiveIntegerField(default=0)
+
+    def sanitized_hash(self):
+        """ Identifies html and how it is sanitized for this note """
+        editable = 'editable' if self.note.is_editable() else 'formatted'
+        return hashlib.sha256(editable + ':' + (self.html or u'').encode('utf8')).hexdigest()
+
+    def is_sanitized(self):
+        return self.sanitizer_version == sanitizer.SANITIZER_VERSION and \
+               self.html_hash == self.sanitized_hash()
 
     def save(self, *args, **kwargs):
+        """
+        Pass sanitized=True if html was already sanitized for this note,
+        such as by sanitizer.sanitize_uploaded_html.
+        """
+        sanitized = kwargs.pop('sanitized', False)
         if self.markdown and not self.html:
             self.html = markdown.markdown(self.markdown)
-        if self.note.is_editable():
-            self.html = sanitizer.sanitize_html_to_editable(self.html)
-        else:
-            self.html = sanitizer.sanitize_html_preserve_formatting(self.html)
+        if not (sanitized or self.is_sanitized()):
+            if self.note.is_editable():
+                self.html = sanitizer.sanitize_html_to_editable(self.html)
+            else:
+                self.html = sanitizer.sanitize_html_preserve_formatting(self.html)
+        self.html_hash = self.sanitized_hash()
+        self.sanitizer_version = sanitizer.SANITIZER_VERSION
 
         super(NoteMarkdown, self).save(*args, **kwargs)
 
 auto_add_check_unique_together(Note)
 
 
-def update_note_counts(note_instance):
-    try:
-        # test if the course still exists, or if this is a cascade delete.
-        note_instance.course
-    except Course.DoesNotExist:
-        # this is a cascade delete. there is no course to update
-        pass
+def update_note_counts(note_instance, created=False, deleted=False):
+    """
+    Apply the change made to a note to the note and thank counts of its
+    course and school. Only visible notes are counted.
+    """
+    if created:
+        old_course_id, old_files, old_thanks = None, 0, 0
+    else:
+        old_course_id = note_instance.loaded_value('course_id')
+        old_files = 0 if note_instance.loaded_value('is_hidden') else 1
+        old_thanks = old_files and (note_instance.loaded_value('thanks') or 0)
+
+    if deleted:
+        new_files, new_thanks = 0, 0
     else:
-        # course exists
-        note_instance.course.update_thank_count()
-        note_instance.course.update_note_count()
-        if note_instance.course.school:
-            note_instance.course.school.update_note_count()
-        elif note_instance.course.department.school:
-            note_instance.course.department.school.update_note_count()
-
-@receiver(pre_save, sender=Note, weak=False)
-def note_pre_save_receiver(sender, **kwargs):
-    """Stick an instance of the pre-save value of
-    the given Note instance in the instances itself.
-    This will be looked at in post_save."""
-    if not 'instance' in kwargs:
-        return
+        new_files = 0 if note_instance.is_hidden else 1
+        new_thanks = new_files and (note_instance.thanks or 0)
 
-    try:
-        kwargs['instance'].old_instance = Note.objects.get(id=kwargs['instance'].id)
-    except ObjectDoesNotExist:
-        pass
+    # Courses no longer there because of a cascade delete are not updated.
+    if old_course_id == note_instance.course_id:
+        Course.change_note_counts(note_instance.course_id,
+                                  new_files - old_files, new_thanks - old_thanks)
+    else:
+        Course.change_note_counts(old_course_id, -old_files, -old_thanks)
+        Course.change_note_counts(note_instance.course_id, new_files, new_thanks)
 
 @receiver(post_save, sender=Note, weak=False)
 def note_save_receiver(sender, **kwargs):
@@ -487,16 +573,16 @@ def note_save_receiver(sender, **kwargs):
     note = kwargs['instance']
 
 
-    update_note_counts(note)
+    update_note_counts(note, created=kwargs['created'])
 
-    try:
-        index = SearchIndex()
-        if kwargs['created']:
-            index.add_note(note)
-        else:
-            index.update_note(note, note.old_instance)
-    except Exception:
-        logger.error("Error with IndexDen:\n" + traceback.format_exc())
+    # Queue up the search index change rather than updating the index from
+    # within the request.
+    changed = note.changed_fields()
+    if kwargs['created'] or changed.intersection(Note.INDEXED_ATTNAMES):
+        SearchIndexUpdate.enqueue(note.id, SearchIndexUpdate.ADD)
+    elif 'thanks' in changed:
+        SearchIndexUpdate.enqueue(note.id, SearchIndexUpdate.VARIABLES)
+    note.remember_loaded_state()
 
 
 @receiver(post_delete, sender=Note, weak=False)
@@ -507,19 +593,136 @@ def note_delete_receiver(sender, **kwargs):
 
     # Update course and school counts of how
     # many notes they have
-    update_note_counts(kwargs['instance'])
+    update_note_counts(kwargs['instance'], deleted=True)
 
     # Remove document from search index
-    try:
-        index = SearchIndex()
-        index.remove_note(note)
-    except Exception:
-        logger.error("Error with IndexDen:\n" + traceback.format_exc())
+    SearchIndexUpdate.enqueue(note.id, SearchIndexUpdate.REMOVE)
 
     if note.user:
         GenericKarmaEvent.create_event(note.user, note.name, GenericKarmaEvent.NOTE_DELETED)
 
 
+class SearchIndexUpdate(models.Model):
+    """
+    Outbox of note changes waiting to be sent to the search index.
+    Note receivers only insert rows here; the process_search_index_queue
+    task coalesces them per note and sends them in bulk.
+    """
+    ADD       = 'add'
+    VARIABLES = 'variables'
+    REMOVE    = 'remove'
+
+    ACTION_CHOICES = (
+        (ADD,       'Send the whole document'),
+        (VARIABLES, 'Send only the thanks count'),
+        (REMOVE,    'Remove the document'),
+    )
+
+    # not a ForeignKey: removals must outlive the Note
+    note_id         = models.IntegerField(db_index=True)
+    action          = models.CharField(max_length=15, choices=ACTION_CHOICES)
+    queued_at       = models.DateTimeField(default=datetime.datetime.utcnow)
+    # failed sends are retried with exponential backoff
+    attempts        = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=datetime.datetime.utcnow, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+
+    def __unicode__(self):
+        return u"{0} note {1}".format(self.action, self.note_id)
+
+    @staticmethod
+    def enqueue(note_id, action):
+        SearchIndexUpdate.objects.create(note_id=note_id, action=action)
+
+
+class NoteSearchDocument(models.Model):
+    """
+    Copy of the indexed fields of a Note, searched by LocalSearchIndex.
+    On PostgreSQL the table also has a search_vector tsvector column,
+    maintained by a trigger and not known to Django (see migration 0023).
+    """
+    # not a ForeignKey: the index is only changed by the search queue
+    note_id   = models.IntegerField(primary_key=True)
+    course_id = models.IntegerField(null=True, db_index=True)
+    name      = models.CharField(max_length=255, blank=True)
+    text      = models.TextField(blank=True)
+    tags      = models.TextField(blank=True)
+    thanks    = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u"Search document for note {0}".format(self.note_id)
+
+
+class NoteSearchTerm(models.Model):
+    """
+    Inverted index used by LocalSearchIndex on databases other than
+    PostgreSQL: how many times a term appears in each document.
+    """
+    document   = models.ForeignKey(NoteSearchDocument, related_name='terms')
+    term       = models.CharField(max_length=64, db_index=True)
+    name_count = models.PositiveIntegerField(default=0)
+    # counts the text and the tags
+    text_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('document', 'term')
+
+    def __unicode__(self):
+        return u"{0} in note {1}".format(self.term, self.document_id)
+
+
+class ConversionCache(models.Model):
+    """
+    Output of converting an uploaded file, keyed by the SHA-256 of its
+    bytes, so that an identical upload need not be converted again.
+    Embedded assets were already moved to S3, so html refers to them there.
+    """
+    sha256      = models.CharField(max_length=64)
+    # the mimetype the file was converted as
+    mimetype    = models.CharField(max_length=255, blank=True)
+    text        = models.TextField(blank=True, null=True)
+    html        = models.TextField(blank=True, null=True)
+    # whether html was sanitized for editing, or preserving formatting
+    editable    = models.BooleanField(default=False)
+    # the note first converted from the file. Not a ForeignKey, as the
+    # cache outlives the note. Its gdrive_url is not shared, being unique.
+    note_id     = models.IntegerField(blank=True, null=True)
+    created_at  = models.DateTimeField(default=datetime.datetime.utcnow)
+    # how many uploads were served from this entry
+    hits        = models.PositiveIntegerField(default=0)
+    last_hit_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        unique_together = ('sha256', 'mimetype')
+
+    def __unicode__(self):
+        return u"Conversion of {0} ({1})".format(self.sha256, self.mimetype)
+
+    @staticmethod
+    def lookup(sha256, mimetype):
+        """ Returns the cached conversion, counting the hit, or None """
+        try:
+            cached = ConversionCache.objects.get(sha256=sha256, mimetype=mimetype or '')
+        except ConversionCache.DoesNotExist:
+            return None
+        ConversionCache.objects.filter(id=cached.id).update(
+            hits=models.F('hits') + 1, last_hit_at=datetime.datetime.utcnow())
+        return cached
+
+    @staticmethod
+    def store(sha256, mimetype, **outputs):
+        """ Cache the outputs of a conversion, unless already cached """
+        try:
+            with transaction.commit_on_success():
+                ConversionCache.objects.create(sha256=sha256, mimetype=mimetype or '',
+                                               **outputs)
+        except IntegrityError:
+            # converted concurrently by another upload
+            pass
+
+
 class UserUploadMapping(models.Model):
     user = models.ForeignKey(User)
     fp_file = models.CharField(max_length=255)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+"""
+Run pdf2htmlEX without letting one large PDF exhaust a worker.
+"""
+import logging
+import os
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# At most this many pdf2htmlEX processes run at once in a worker process.
+PDF2HTML_PROCESSES = 2
+# pdf2htmlEX is killed after this many seconds, or if it maps more than
+# this much memory.
+PDF2HTML_TIMEOUT = 300
+PDF2HTML_MAX_MEMORY = 1024 * 1024 * 1024
+# PDFs larger than this are rendered a page per file, so pdf2htmlEX need
+# not hold the whole document's HTML at once.
+PDF2HTML_SPLIT_BYTES = 10 * 1024 * 1024
+
+COPY_CHUNK = 64 * 1024
+PAGE_FILENAME = 'page%d.page'
+PAGE_CONTAINER_RE = re.compile(r'<div id="page-container"[^>]*>')
+
+_slots = threading.BoundedSemaphore(PDF2HTML_PROCESSES)
+
+
+def _limit_memory():
+    resource.setrlimit(resource.RLIMIT_AS, (PDF2HTML_MAX_MEMORY, PDF2HTML_MAX_MEMORY))
+
+
+def _copy(source, destination):
+    while True:
+        chunk = source.read(COPY_CHUNK)
+        if not chunk:
+            break
+        destination.write(chunk)
+
+
+def run_pdf2htmlex(command, cwd):
+    """
+    Run command in cwd, once a slot is free, with the wall clock and memory
+    limits. Raises ValueError if it fails or runs out of time.
+    """
+    with _slots:
+        devnull = open(os.devnull, 'w')
+        try:
+            output = devnull if settings.TESTING else None
+            call = subprocess.Popen(command, shell=False, cwd=cwd, stdout=output,
+                                    stderr=output, preexec_fn=_limit_memory)
+            deadline = time.time() + PDF2HTML_TIMEOUT
+            while call.poll() is None:
+                if time.time() > deadline:
+                    logger.warning("Killing pdf2htmlEX after {0}s: {1}".format(
+                                   PDF2HTML_TIMEOUT, ' '.join(command)))
+                    call.kill()
+                    call.wait()
+                    raise ValueError("PDF file took longer than {0}s to process".format(
+                                     PDF2HTML_TIMEOUT))
+                time.sleep(0.1)
+        finally:
+            devnull.close()
+
+    if call.returncode != 0:
+        raise ValueError("PDF file could not be processed")
+
+
+def _join_pages(work_dir, html_path, html_file):
+    """ Write the split output of pdf2htmlEX as one document to html_file """
+    with open(html_path, 'r') as main:
+        html = main.read()
+    container = PAGE_CONTAINER_RE.search(html)
+    if container is None:
+        raise ValueError("PDF file could not be processed")
+
+    html_file.write(html[:container.end()])
+    page = 1
+    while os.path.exists(os.path.join(work_dir, PAGE_FILENAME % page)):
+        with open(os.path.join(work_dir, PAGE_FILENAME % page), 'r') as page_file:
+            _copy(page_file, html_file)
+        page += 1
+    html_file.write(html[container.end():])
+
+
+def pdf2html(pdf_file):
+    """
+    Convert the PDF read from the file pdf_file into HTML.
+    Returns a rewound temporary file of the HTML, which the caller closes.
+    """
+    work_dir = tempfile.mkdtemp()
+    try:
+        pdf_path = os.path.join(work_dir, 'document.pdf')
+        with open(pdf_path, 'wb') as pdf_copy:
+            _copy(pdf_file, pdf_copy)
+
+        split = os.path.getsize(pdf_path) > PDF2HTML_SPLIT_BYTES
+        command = ['pdf2htmlEX', '--dest-dir', work_dir]
+        if split:
+            command += ['--split-pages', '1', '--page-filename', PAGE_FILENAME]
+        command += [pdf_path, 'document.html']
+        run_pdf2htmlex(command, work_dir)
+
+        html_path = os.path.join(work_dir, 'document.html')
+        if not os.path.exists(html_path):
+            raise ValueError("PDF file could not be processed")
+
+        html_file = tempfile.TemporaryFile()
+        try:
+            if split:
+                _join_pages(work_dir, html_path, html_file)
+            else:
+                with open(html_path, 'r') as html:
+                    _copy(html, html_file)
+        except:
+            html_file.close()
+            raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if html_file.tell() == 0:
+        html_file.close()
+        raise ValueError("PDF file results in empty HTML file")
+
+    html_file.seek(0)
+    return html_file
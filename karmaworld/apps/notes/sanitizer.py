@@ -9,11 +9,25 @@ from html5lib.tokenizer import HTMLTokenizer
 from bleach.sanitizer import BleachSanitizer
 from bleach import _render
 import bleach_whitelist
+import lxml.html
+from django.conf import settings
 from bs4 import BeautifulSoup
+from karmaworld.utils import s3
 from PIL import Image
 from cStringIO import StringIO
 import base64
-import uuid
+import hashlib
+
+# Increase when the rules below change, so that saved HTML is sanitized
+# again (see the resanitize_notes command).
+SANITIZER_VERSION = 1
+
+VALID_IMAGE_FORMATS = ('png', 'gif', 'jpeg')
+
+# html5lib reads the contents of these elements as text, or (select) by
+# rules of its own, where libxml2 reads elements. The lxml engine hands
+# HTML with any of them to html5lib.
+LXML_MISPARSED_ELEMENTS_RE = re.compile(r'<(?:textarea|select|plaintext|xmp|iframe|noembed|noframes|noscript)[\s/>]', re.I)
 
 def _canonical_link_predicate(tag):
     return tag.name == u'link' and \
@@ -109,21 +123,50 @@ class PreserveFormattingSanitizer(SuppressingSanitizer):
     strip_disallowed_elements = True
     strip_html_comments = True
 
-class DataUriReplacer(HTMLTokenizer, HTMLSanitizerMixin):
+class DataUriRehostingMixin(object):
     """
     Convert any valid image data URI's to files, and upload them to s3. Replace
     the data URI with a link to the file in s3.
     """
     VALID_IMAGE_URI = "^data:image/(png|gif|jpeg);base64,[A-Za-z0-9+/=]+$"
     VALID_FONT_FACE_FORMATS = ["woff"]
+    # Might be better to use a full-fledged CSS parser, but it has to be
+    # modern enough to support font-faces and data-uri's.
+    FONT_FACE_DATA_URI_RE = re.compile(r"""(?P<intro>
+            @font-face\s*{      # font-face opening
+            (?:[^\}]+;)?        # any parts before the src
+            \s*src\s*:\s*             # src declaration
+              url\(['"])?data:      # url opener
+                (?P<mimetype>application/font-(?P<ext>%s)) # mimetype
+                ;base64, 
+                (?P<data_uri>[A-Za-z0-9+/=]+) # data-uri itself
+             (?P<outro>['"]?\)) # url closer 
+    """ % "|".join(VALID_FONT_FACE_FORMATS), re.VERBOSE | re.DOTALL)
+
+    # (filepath, mimetype, data) to upload by filepath, shared by the
+    # tokenizers of one document (see _rehosting)
+    uploads = None
 
     def __init__(self, *args, **kwargs):
         self.in_style = False
-        self.style_content = []
-        self.font_face_cache = {}
-        super(DataUriReplacer, self).__init__(*args, **kwargs)
-
-    def sanitize_token(self, token):
+        # s3 url and (filepath, mimetype, data) by data URI
+        self.rehosted_urls = {}
+        self.token_uploads = []
+        super(DataUriRehostingMixin, self).__init__(*args, **kwargs)
+
+    def rehost_and_sanitize(self, token, sanitize):
+        """
+        Rehost the data URI's of token, then sanitize it with sanitize. The
+        contents of the data URI's are only uploaded if the token is kept.
+        """
+        self.token_uploads = []
+        result = sanitize(self.rehost_token(token))
+        if result is not None:
+            for upload in self.token_uploads:
+                self.uploads[upload[0]] = upload
+        return result
+
+    def rehost_token(self, token):
         # Handle images
         tag_name = token.get("name")
         if tag_name == u"img":
@@ -131,7 +174,7 @@ class DataUriReplacer(HTMLTokenizer, HTMLSanitizerMixin):
             if 'src' in attrs:
                 src = attrs['src']
                 if re.match(self.VALID_IMAGE_URI, src):
-                    url = self._upload_image(src)
+                    url = self._rehosted_url(src)
                     attrs['src'] = url
                     token['data'] = [(k,v) for k,v in attrs.iteritems()]
 
@@ -149,74 +192,83 @@ class DataUriReplacer(HTMLTokenizer, HTMLSanitizerMixin):
         return token
 
     def _extract_and_upload_data_uri_fonts(self, raw_css):
-        # Might be better to use a full-fledged CSS parser, but it has to be
-        # modern enough to support font-faces and data-uri's.
-        pattern = r"""(?P<intro>
-                @font-face\s*{      # font-face opening
-                (?:[^\}]+;)?        # any parts before the src
-                \s*src\s*:\s*             # src declaration
-                  url\(['"])?data:      # url opener
-                    (?P<mimetype>application/font-(?P<ext>%s)) # mimetype
-                    ;base64, 
-                    (?P<data_uri>[A-Za-z0-9+/=]+) # data-uri itself
-                 (?P<outro>['"]?\)) # url closer 
-        """ % "|".join(self.VALID_FONT_FACE_FORMATS)
-        return re.sub(pattern,
-                repl=self._upload_font_match,
-                string=raw_css,
-                flags=re.VERBOSE | re.DOTALL)
+        return self.FONT_FACE_DATA_URI_RE.sub(self._upload_font_match, raw_css)
 
     def _upload_font_match(self, match):
-        url = ""
-        if match:
-            ext = match.group('ext')
-            mimetype = match.group('mimetype')
-            data_uri = match.group('data_uri')
-            if ext in self.VALID_FONT_FACE_FORMATS:
-                filepath = "fonts/{}.{}".format(uuid.uuid4(), ext)
-                sio = StringIO()
-                sio.write(base64.b64decode(data_uri))
-                sio.seek(0)
-                value = sio.getvalue()
-                if value in self.font_face_cache:
-                    url = self.font_face_cache[value]
-                else:
-                    url = self._s3_upload(filepath, mimetype, sio.getvalue())
-                    self.font_face_cache[value] = url
-        return u"".join((match.group('intro'), url, match.group('outro')))
-
-    def _upload_image(self, data_uri):
-        mimetype, data = data_uri.split(";base64,")
-        sio = StringIO()
-        sio.write(base64.b64decode(data))
-        sio.seek(0)
+        url = self._rehosted_url(_font_data_uri(match))
+        return u"".join((match.group('intro') or u"", url, match.group('outro')))
+
+    def _rehosted_url(self, data_uri):
+        """
+        s3 url of the contents of data_uri. Files are named by their
+        contents, so the url is known before they are uploaded.
+        """
+        if data_uri not in self.rehosted_urls:
+            upload = _decode_data_uri(data_uri)
+            self.rehosted_urls[data_uri] = (s3.s3_url(upload[0]), upload)
+        url, upload = self.rehosted_urls[data_uri]
+        self.token_uploads.append(upload)
+        return url
+
+def _font_data_uri(match):
+    """ The data URI matched by DataUriRehostingMixin.FONT_FACE_DATA_URI_RE """
+    return u"data:{0};base64,{1}".format(match.group('mimetype'), match.group('data_uri'))
+
+def _decode_data_uri(data_uri):
+    """
+    Decode an image or font data URI. Returns the s3 path for its contents,
+    named by their hash so that each is stored once however many documents
+    hold it, their mimetype and the contents.
+    """
+    mimetype, data = data_uri[len("data:"):].split(";base64,")
+    content = base64.b64decode(data)
+    if mimetype.startswith("image/"):
+        # Check the image is what it claims, without decoding and encoding
+        # it again.
         try:
-            image = Image.open(sio)
-        except IOError:
+            image = Image.open(StringIO(content))
+            image.verify()
+        except Exception:
             raise ValueError("Bad image data URI")
+        fmt = (image.format or "").lower()
+        if fmt not in VALID_IMAGE_FORMATS:
+            raise ValueError("Bad image data URI")
+        mimetype = "image/" + fmt
+        directory = "images"
+    else:
+        fmt = mimetype.split("-")[-1]
+        directory = "fonts"
+    filepath = "{0}/{1}.{2}".format(directory, hashlib.sha256(content).hexdigest(), fmt)
+    return filepath, mimetype, content
 
-        fmt = mimetype.split("/")[1]
-
-        image_data = StringIO()
-        image.save(image_data, format=fmt)
-
-        filepath = "images/{}.{}".format(uuid.uuid4(), fmt)
-        return self._s3_upload(filepath, mimetype, image_data.getvalue())
+def _s3_upload_all(files):
+    """
+    Store each (filepath, mimetype, data) of files in s3, unless it is
+    already there.
+    """
+    s3.put_many(files, overwrite=False)
 
-    def _s3_upload(self, filepath, mimetype, data):
-        from django.core.files.storage import default_storage
-        from karmaworld.apps.notes.models import all_read_xml_acl
-        from django.conf import settings
+def _rehosting(tokenizer):
+    """
+    Subclass tokenizer, which rehosts data URI's, for one document. Data
+    URI's are replaced with the urls their contents will have, and the
+    contents of those left in the sanitized document are uploaded together
+    by upload_all() once it is parsed.
+    """
+    class RehostingTokenizer(tokenizer):
+        uploads = {}
 
-        new_key = default_storage.bucket.new_key(filepath)
-        new_key.set_contents_from_string(data, {"Content-Type": mimetype})
-        new_key.set_xml_acl(all_read_xml_acl)
-        parts = [settings.S3_URL, filepath]
-        if parts[0].startswith("//"):
-            # Fully resolve the URL as https for happiness in all things. ॐ
-            parts.insert(0, "https:")
-        return "".join(parts)
+        @classmethod
+        def upload_all(cls):
+            _s3_upload_all(cls.uploads.values())
+    return RehostingTokenizer
 
+class DataUriReplacer(DataUriRehostingMixin, HTMLTokenizer, HTMLSanitizerMixin):
+    """
+    Tokenizer which only moves data URI's to s3.
+    """
+    def sanitize_token(self, token):
+        return self.rehost_and_sanitize(token, lambda token: token)
 
     def __iter__(self):
         for token in HTMLTokenizer.__iter__(self):
@@ -224,11 +276,130 @@ class DataUriReplacer(HTMLTokenizer, HTMLSanitizerMixin):
             if token:
                 yield token
 
-def _sanitize_html(raw_html, tokenizer):
+class EditableRehostingSanitizer(DataUriRehostingMixin, EditableSanitizer):
+    """
+    EditableSanitizer which first moves data URI's to s3, so an uploaded
+    document is parsed once rather than once per step.
+    """
+    def sanitize_token(self, token):
+        return self.rehost_and_sanitize(token, lambda token: EditableSanitizer.sanitize_token(self, token))
+
+class PreserveFormattingRehostingSanitizer(DataUriRehostingMixin, PreserveFormattingSanitizer):
+    """
+    PreserveFormattingSanitizer which first moves data URI's to s3.
+    """
+    def sanitize_token(self, token):
+        return self.rehost_and_sanitize(token, lambda token: PreserveFormattingSanitizer.sanitize_token(self, token))
+
+def _canonicalizing(tokenizer, href):
+    """
+    Subclass tokenizer to start its output with <link rel="canonical">.
+    Sanitizers strip <link>, so the link is added after sanitizing.
+    """
+    class CanonicalizingTokenizer(tokenizer):
+        canonical_href = href
+
+        def __iter__(self):
+            yield {'type': tokenTypes['StartTag'], 'name': u'link',
+                   'data': [(u'rel', u'canonical'), (u'href', href)],
+                   'selfClosing': True, 'selfClosingAcknowledged': False}
+            for token in tokenizer.__iter__(self):
+                yield token
+    return CanonicalizingTokenizer
+
+def _html5lib_sanitize_html(raw_html, tokenizer):
     parser = html5lib.HTMLParser(tokenizer=tokenizer)
     clean = _render(parser.parseFragment(raw_html))
     return clean
 
+def _lxml_remove(element):
+    """ Remove element and its contents, but not the text after it """
+    parent = element.getparent()
+    if element.tail:
+        previous = element.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or u'') + element.tail
+        else:
+            parent.text = (parent.text or u'') + element.tail
+    parent.remove(element)
+
+def _lxml_clean_children(element, sanitizer):
+    """
+    Apply the rules of sanitizer, a sanitizing tokenizer, to the children
+    of element, feeding it the same tokens html5lib would.
+    """
+    for child in list(element):
+        if not isinstance(child.tag, basestring) or \
+                child.tag in sanitizer.suppressed_elements:
+            # comments, processing instructions, script and the like
+            _lxml_remove(child)
+            continue
+
+        token = sanitizer.sanitize_token({'type': tokenTypes['StartTag'], 'name': child.tag,
+                                          'data': child.items(), 'selfClosing': False})
+        if child.tag == u'style':
+            # font data URI's are rehosted from the text of style elements
+            if child.text:
+                text = sanitizer.sanitize_token({'type': tokenTypes['Characters'],
+                                                 'data': child.text})
+                child.text = text['data'] if text else None
+            sanitizer.sanitize_token({'type': tokenTypes['EndTag'], 'name': child.tag,
+                                      'data': []})
+
+        _lxml_clean_children(child, sanitizer)
+        if token is None:
+            # stripped, but its contents are kept
+            child.drop_tag()
+        else:
+            child.attrib.clear()
+            for name, value in token['data']:
+                child.set(name, value)
+
+def _lxml_sanitize_html(raw_html, tokenizer):
+    """
+    Sanitize like _html5lib_sanitize_html, with the same whitelists, but
+    parse and serialize with lxml (libxml2), which is much faster.
+    """
+    if isinstance(raw_html, str):
+        raw_html = raw_html.decode('utf-8', 'replace')
+    if not raw_html.strip():
+        return u''
+    if LXML_MISPARSED_ELEMENTS_RE.search(raw_html):
+        return _html5lib_sanitize_html(raw_html, tokenizer)
+
+    # Inside an explicit body, libxml2 keeps <html>, <head> and <body> tags
+    # of whole documents from moving anything, and does not wrap leading
+    # text in <p>. Like html5lib parsing a fragment, everything is kept in
+    # document order, head contents first should libxml2 make a head.
+    document = lxml.html.document_fromstring(u'<html><body>{0}</body></html>'.format(raw_html))
+    root = document.makeelement('div', {})
+    for part in document:
+        if part.text and len(root):
+            root[-1].tail = (root[-1].tail or u'') + part.text
+        elif part.text:
+            root.text = (root.text or u'') + part.text
+        root.extend(list(part))
+    _lxml_clean_children(root, tokenizer(u''))
+
+    href = getattr(tokenizer, 'canonical_href', None)
+    if href:
+        root.insert(0, root.makeelement('link', {'rel': 'canonical', 'href': href}))
+        root[0].tail, root.text = root.text, None
+
+    html = lxml.html.tostring(root, encoding=unicode)
+    # strip the <div> which held the fragment
+    return html[len(u'<div>'):-len(u'</div>')]
+
+# Available values of settings.SANITIZER_ENGINE
+SANITIZER_ENGINES = {
+    'html5lib': _html5lib_sanitize_html,
+    'lxml': _lxml_sanitize_html,
+}
+
+def _sanitize_html(raw_html, tokenizer):
+    engine = getattr(settings, 'SANITIZER_ENGINE', 'html5lib')
+    return SANITIZER_ENGINES[engine](raw_html, tokenizer)
+
 def sanitize_html_to_editable(raw_html):
     """
     Sanitize the given raw_html, with the result in a format suitable for
@@ -244,8 +415,29 @@ def sanitize_html_preserve_formatting(raw_html):
     return _sanitize_html(raw_html, PreserveFormattingSanitizer)
 
 def data_uris_to_s3(raw_html):
-    parser = html5lib.HTMLParser(tokenizer=DataUriReplacer)
+    tokenizer = _rehosting(DataUriReplacer)
+    parser = html5lib.HTMLParser(tokenizer=tokenizer)
     clean = _render(parser.parseFragment(raw_html))
+    tokenizer.upload_all()
+    return clean
+
+def sanitize_uploaded_html(raw_html, editable, canonical_href=None):
+    """
+    Move data URI's to s3 and sanitize the given HTML for editing (like
+    sanitize_html_to_editable) or preserving formatting (like
+    sanitize_html_preserve_formatting), in a single parse. If canonical_href
+    is given, the result starts with a canonical link to it, as
+    set_canonical_rel would add, but without html/head/body tags.
+    """
+    if editable:
+        rehosting = _rehosting(EditableRehostingSanitizer)
+    else:
+        rehosting = _rehosting(PreserveFormattingRehostingSanitizer)
+    tokenizer = rehosting
+    if canonical_href:
+        tokenizer = _canonicalizing(tokenizer, canonical_href)
+    clean = _sanitize_html(raw_html, tokenizer)
+    rehosting.upload_all()
     return clean
 
 def set_canonical_rel(raw_html, href):
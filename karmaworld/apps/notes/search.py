@@ -3,18 +3,34 @@
 # Copyright (C) 2013  FinalsClub Foundation
 
 import calendar
+import math
 import os
+import re
 import time
 import uuid
+from collections import Counter, defaultdict
 from django.core.exceptions import ImproperlyConfigured
 
 import indextank.client as itc
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.utils.html import escape
+from django.utils.importlib import import_module
+
+from karmaworld.apps.notes.models import NoteSearchDocument, NoteSearchTerm
+from taggit.models import TaggedItem
 
 import logging
 
 PAGE_SIZE = 10
 
+# Extra weight given to matches in the note name by LocalSearchIndex,
+# standing in for IndexDen's name:"..." clause.
+NAME_BOOST = 3.0
+# Approximate length of the snippets LocalSearchIndex shows in results.
+SNIPPET_LENGTH = 200
+
 MOCK_MODE = settings.TESTING
 
 logging.basicConfig()
@@ -31,7 +47,7 @@ else:
   INDEXDEN_PRIVATE_URL = os.environ['INDEXDEN_PRIVATE_URL']
 
 class SearchResult(object):
-    """The result of making a query into IndexDen.
+    """The result of making a query into the search index.
     @param ordered_ids A list of the note IDs found, in order they
                        should be displayed
     @param snippet_dict A dictionary mapping note IDs to snippets
@@ -59,7 +75,97 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-class SearchIndex(object):
+class SearchBackend(object):
+    """Interface of a note search index. Subclasses implement the
+    document operations and search(); see SearchIndex (IndexDen) and
+    LocalSearchIndex (the database).
+    Use get_search_index() to get the configured backend."""
+
+    @staticmethod
+    def _tags_to_str(tags):
+        return ' '.join([str(tag) for tag in tags.all()])
+
+    @staticmethod
+    def _note_tags_to_str(note):
+        """Tags of note as a string, read from prefetch_tags() when it
+        was used on the note."""
+        tags = getattr(note, 'prefetched_tags', None)
+        if tags is None:
+            return SearchBackend._tags_to_str(note.tags)
+        return ' '.join([str(tag) for tag in tags])
+
+    @staticmethod
+    def _note_to_dict(note):
+        d = {
+            'name': note.name,
+            'text': note.text
+        }
+
+        tags = SearchBackend._note_tags_to_str(note)
+        if tags:
+            d['tags'] = tags
+
+        if note.course_id:
+            d['course_id'] = note.course_id
+
+        if note.uploaded_at:
+            d['timestamp'] = calendar.timegm(note.uploaded_at.timetuple())
+
+        return d
+
+    @staticmethod
+    def needs_reindex(new_note, old_note):
+        """Returns True if any of the indexed fields differ between
+        new_note and old_note, meaning the whole document must be sent
+        to the index again rather than just its variables."""
+        return new_note.text != old_note.text or \
+            new_note.name != old_note.name or \
+            SearchBackend._tags_to_str(new_note.tags) != SearchBackend._tags_to_str(old_note.tags) or \
+            new_note.course != old_note.course or \
+            new_note.uploaded_at != old_note.uploaded_at
+
+    def delete_index(self):
+        """Remove every document from the index."""
+        raise NotImplementedError()
+
+    def add_note(self, note):
+        """Add a note to the index, overwriting it if it is already there."""
+        self.add_notes([note])
+
+    def add_notes(self, notes):
+        """Add many notes to the index. Notes without text are skipped.
+        Returns the IDs of the notes that could not be added."""
+        raise NotImplementedError()
+
+    def update_note(self, new_note, old_note):
+        """Update a note, sending only what changed from old_note."""
+        if not new_note.text:
+            return
+        if self.needs_reindex(new_note, old_note):
+            self.add_note(new_note)
+        elif new_note.thanks != old_note.thanks:
+            self.update_thanks(new_note.id, new_note.thanks)
+
+    def update_thanks(self, note_id, thanks):
+        """Send only the thanks count of a note."""
+        raise NotImplementedError()
+
+    def remove_note(self, note):
+        """Remove a note from the search index."""
+        self.remove_notes([note.id])
+
+    def remove_notes(self, note_ids):
+        """Remove many notes from the search index."""
+        raise NotImplementedError()
+
+    def search(self, query, course_id=None, page=0):
+        """Returns an instance of SearchResult for your query.
+        Matches on the note name are boosted, results may be limited to
+        one course, and results are ranked by relevance * log(thanks)."""
+        raise NotImplementedError()
+
+
+class SearchIndex(SearchBackend):
     """A singleton class used to interface with the IndexDen
     search index."""
 
@@ -91,28 +197,6 @@ class SearchIndex(object):
         # "Relevance" is a black box provided by IndexDen.
         self.index.add_function(0, 'relevance * log(doc.var[0])')
 
-    @staticmethod
-    def _tags_to_str(tags):
-        return ' '.join([str(tag) for tag in tags.all()])
-
-    @staticmethod
-    def _note_to_dict(note):
-        d = {
-            'name': note.name,
-            'text': note.text
-        }
-
-        if note.tags.exists():
-            d['tags'] = SearchIndex._tags_to_str(note.tags)
-
-        if note.course:
-            d['course_id'] = note.course.id
-
-        if note.uploaded_at:
-            d['timestamp'] = calendar.timegm(note.uploaded_at.timetuple())
-
-        return d
-
     def delete_index(self):
         """This is meant for test cases that want to clean up
         after themselves."""
@@ -146,11 +230,7 @@ class SearchIndex(object):
 
         # If the indexable fields have changed,
         # send the document to IndexDen again
-        if new_note.text != old_note.text or \
-            new_note.name != old_note.name or \
-            SearchIndex._tags_to_str(new_note.tags) != SearchIndex._tags_to_str(old_note.tags) or \
-            new_note.course != old_note.course or \
-            new_note.uploaded_at != old_note.uploaded_at:
+        if SearchIndex.needs_reindex(new_note, old_note):
             logger.info("Indexing {n}".format(n=new_note))
             self.index.add_document(new_note.id, SearchIndex._note_to_dict(new_note), variables={0: new_note.thanks})
 
@@ -164,6 +244,41 @@ class SearchIndex(object):
         else:
             logger.info("Note {n} has not changed sufficiently, will not update IndexDen".format(n=new_note))
 
+    def add_notes(self, notes):
+        """Add many notes to the index in a single request. Notes
+        without text are skipped, as in add_note.
+        Returns the IDs of the notes IndexDen failed to add."""
+        if MOCK_MODE:
+            return []
+
+        documents = [{'docid': note.id,
+                      'fields': SearchIndex._note_to_dict(note),
+                      'variables': {0: note.thanks}}
+                     for note in notes if note.text]
+        if not documents:
+            return []
+
+        logger.info("Indexing {c} notes".format(c=len(documents)))
+        results = self.index.add_documents(documents)
+        return [document['docid'] for document, result in zip(documents, results)
+                if not result.get('added')]
+
+    def update_thanks(self, note_id, thanks):
+        """Send only the thanks count of a note."""
+        if MOCK_MODE:
+            return
+
+        logger.info("Indexing thanks variable for note {i}".format(i=note_id))
+        self.index.update_variables(note_id, variables={0: thanks})
+
+    def remove_notes(self, note_ids):
+        """Remove many notes from the search index in a single request."""
+        if MOCK_MODE:
+            return
+
+        logger.info("Removing {c} notes from index".format(c=len(note_ids)))
+        self.index.delete_documents(note_ids)
+
     def remove_note(self, note):
         """Remove a note from the search index."""
         if MOCK_MODE:
@@ -192,3 +307,185 @@ class SearchIndex(object):
         has_more = True if int(raw_results['matches']) > ((page+1) * PAGE_SIZE) else False
 
         return SearchResult(ordered_ids, snippet_dict, has_more)
+
+
+# Words as the local index sees them. Terms are stored lowercased.
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+TERM_MAX_LENGTH = 64
+
+# tsvectors are limited to 1MB, so only the start of very long notes is
+# indexed on PostgreSQL. Keep in step with the trigger in migration 0023.
+# Matches can only be in that start, so snippets are made from it too.
+POSTGRES_TEXT_LIMIT = 100000
+
+# Control characters cannot appear in escaped HTML, so ts_headline marks
+# matches with them and they are swapped for <b> after escaping.
+_START_SEL = u'\x02'
+_STOP_SEL = u'\x03'
+
+_POSTGRES_SEARCH = """
+    SELECT note_id, ts_headline('english', left(text, {text_limit}), query, %s) FROM (
+        SELECT d.note_id, d.text, query,
+               ts_rank(d.search_vector, query) * ln(greatest(d.thanks, 2)) AS score
+        FROM notes_notesearchdocument d, plainto_tsquery('english', %s) query
+        WHERE d.search_vector @@ query {course_filter}
+        ORDER BY score DESC, d.note_id DESC
+        LIMIT %s OFFSET %s
+    ) hits
+    ORDER BY score DESC, note_id DESC
+"""
+
+
+def _terms(text):
+    return [term.lower()[:TERM_MAX_LENGTH] for term in TERM_RE.findall(text or u'')]
+
+
+def _snippet(text, terms):
+    """Escaped window of text around the first matching term, with the
+    matching terms in <b>."""
+    start = 0
+    for match in TERM_RE.finditer(text):
+        if match.group().lower() in terms:
+            start = max(0, match.start() - SNIPPET_LENGTH / 4)
+            break
+    window = text[start:start + SNIPPET_LENGTH]
+
+    pieces = []
+    last = 0
+    for match in TERM_RE.finditer(window):
+        if match.group().lower() in terms:
+            pieces.append(escape(window[last:match.start()]))
+            pieces.append(u'<b>{0}</b>'.format(escape(match.group())))
+            last = match.end()
+    pieces.append(escape(window[last:]))
+    return u''.join(pieces)
+
+
+class LocalSearchIndex(SearchBackend):
+    """Note search index kept in the database, so searching needs no
+    network hop. Uses full text search on PostgreSQL and the
+    NoteSearchTerm inverted index elsewhere.
+
+    IndexDen queries are phrases; here every term of the query must
+    match instead."""
+
+    @staticmethod
+    def _use_postgres():
+        return connection.vendor == 'postgresql'
+
+    def delete_index(self):
+        NoteSearchTerm.objects.all().delete()
+        NoteSearchDocument.objects.all().delete()
+
+    def add_notes(self, notes):
+        documents = [NoteSearchDocument(note_id=note.id,
+                                               course_id=note.course_id,
+                                               name=note.name or u'',
+                                               text=note.text,
+                                               tags=SearchBackend._note_tags_to_str(note),
+                                               thanks=note.thanks or 0)
+                     for note in notes if note.text]
+        if not documents:
+            return []
+
+        logger.info("Indexing {c} notes".format(c=len(documents)))
+        self.remove_notes([document.note_id for document in documents])
+        NoteSearchDocument.objects.bulk_create(documents)
+        if not self._use_postgres():
+            terms = []
+            for document in documents:
+                name_counts = Counter(_terms(document.name))
+                text_counts = Counter(_terms(document.text) + _terms(document.tags))
+                for term in set(name_counts) | set(text_counts):
+                    terms.append(NoteSearchTerm(document_id=document.note_id, term=term,
+                                                       name_count=name_counts[term],
+                                                       text_count=text_counts[term]))
+            NoteSearchTerm.objects.bulk_create(terms)
+        return []
+
+    def update_thanks(self, note_id, thanks):
+        NoteSearchDocument.objects.filter(note_id=note_id).update(thanks=thanks)
+
+    def remove_notes(self, note_ids):
+        NoteSearchTerm.objects.filter(document__in=note_ids).delete()
+        NoteSearchDocument.objects.filter(note_id__in=note_ids).delete()
+
+    def search(self, query, course_id=None, page=0):
+        terms = set(_terms(query))
+        if not terms:
+            return SearchResult([], {}, False)
+
+        # Fetch one extra result to tell whether there is another page.
+        if self._use_postgres():
+            hits = self._search_postgres(query, course_id, page * PAGE_SIZE, PAGE_SIZE + 1)
+        else:
+            hits = self._search_terms(terms, course_id, page * PAGE_SIZE, PAGE_SIZE + 1)
+
+        has_more = len(hits) > PAGE_SIZE
+        hits = hits[:PAGE_SIZE]
+        ordered_ids = [note_id for note_id, snippet in hits]
+        return SearchResult(ordered_ids, dict(hits), has_more)
+
+    def _search_postgres(self, query, course_id, offset, limit):
+        """Rank with ts_rank, where the name is weighted above the tags
+        and the tags above the text."""
+        params = [u'StartSel={0}, StopSel={1}, MinWords=15, MaxWords=35'.format(_START_SEL, _STOP_SEL),
+                  query]
+        course_filter = ''
+        if course_id:
+            course_filter = 'AND d.course_id = %s'
+            params.append(int(course_id))
+        params.extend([limit, offset])
+
+        cursor = connection.cursor()
+        cursor.execute(_POSTGRES_SEARCH.format(course_filter=course_filter,
+                                               text_limit=POSTGRES_TEXT_LIMIT), params)
+        return [(note_id, escape(headline).replace(_START_SEL, u'<b>').replace(_STOP_SEL, u'</b>'))
+                for note_id, headline in cursor.fetchall()]
+
+    def _search_terms(self, terms, course_id, offset, limit):
+        """Rank with the term counts of the inverted index, boosting
+        matches in the name."""
+        matches = NoteSearchTerm.objects.filter(term__in=terms)
+        if course_id:
+            matches = matches.filter(document__course_id=int(course_id))
+
+        relevance = {}
+        matched_terms = {}
+        thanks = {}
+        for note_id, term, name_count, text_count, note_thanks in \
+                matches.values_list('document', 'term', 'name_count', 'text_count', 'document__thanks'):
+            relevance[note_id] = relevance.get(note_id, 0) + \
+                math.log(1 + text_count) + NAME_BOOST * math.log(1 + name_count)
+            matched_terms.setdefault(note_id, set()).add(term)
+            thanks[note_id] = note_thanks
+
+        scores = [(relevance[note_id] * math.log(max(thanks[note_id], 2)), note_id)
+                  for note_id in relevance if matched_terms[note_id] == terms]
+        scores.sort(reverse=True)
+        ordered_ids = [note_id for score, note_id in scores[offset:offset + limit]]
+
+        texts = dict(NoteSearchDocument.objects.filter(note_id__in=ordered_ids)
+                                                      .values_list('note_id', 'text'))
+        return [(note_id, _snippet(texts[note_id], terms)) for note_id in ordered_ids]
+
+
+def prefetch_tags(notes):
+    """Load the tags of all of notes in a single query, rather than one
+    query per note when they are indexed."""
+    if not notes:
+        return
+    tags = defaultdict(list)
+    tagged_items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(notes[0]),
+                                             object_id__in=[note.id for note in notes]) \
+                                     .select_related('tag').order_by('id')
+    for tagged_item in tagged_items:
+        tags[tagged_item.object_id].append(tagged_item.tag)
+    for note in notes:
+        note.prefetched_tags = tags[note.id]
+
+
+def get_search_index():
+    """Returns the search backend named by settings.SEARCH_BACKEND."""
+    module_name, class_name = settings.SEARCH_BACKEND.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)()
@@ -2,16 +2,33 @@
 # -*- coding:utf8 -*-
 # Copyright (C) 2013  FinalsClub Foundation
 import os
+import datetime
 
 import traceback
 from celery import task
 from celery.utils.log import get_task_logger
+from django.core.cache import cache
+from django.db.models import F
 from karmaworld.apps.notes.models import Note
+from karmaworld.apps.notes.models import SearchIndexUpdate
+from karmaworld.apps.notes.search import get_search_index
 import twitter
 import gdshortener
 
 logger = get_task_logger(__name__)
 
+# How many queued index changes to pick up per run of
+# process_search_index_queue, and how many documents to send to the index
+# per bulk request. Documents carry the full note text, so keep it modest.
+INDEX_QUEUE_BATCH = 1000
+INDEX_DOCUMENTS_PER_REQUEST = 50
+# Failed sends are retried after 2 ** attempts minutes, up to this many.
+INDEX_MAX_BACKOFF_MINUTES = 60
+# Held by the one run of process_search_index_queue allowed at a time, for
+# at most as long as a run may take
+INDEX_QUEUE_LOCK_KEY = 'search-index-queue-lock'
+INDEX_QUEUE_TIME_LIMIT = 10 * 60
+
 @task(name="tweet_note")
 def tweet_note():
     """Tweet about a new note."""
@@ -75,3 +92,133 @@ def tweet_string(note):
         return short_url + " " + \
             short_course + ": " + \
             short_note
+
+
+def _coalesce(updates):
+    """
+    Reduce queued SearchIndexUpdates to the one action that matters per note.
+    Returns a dictionary mapping each action to a dictionary of
+    note_id => list of SearchIndexUpdates.
+    """
+    by_note = {}
+    for update in updates:
+        by_note.setdefault(update.note_id, []).append(update)
+
+    coalesced = {SearchIndexUpdate.ADD: {},
+                 SearchIndexUpdate.VARIABLES: {},
+                 SearchIndexUpdate.REMOVE: {}}
+    for note_id, note_updates in by_note.iteritems():
+        actions = [u.action for u in note_updates]
+        if actions[-1] == SearchIndexUpdate.REMOVE:
+            action = SearchIndexUpdate.REMOVE
+        elif SearchIndexUpdate.ADD in actions:
+            action = SearchIndexUpdate.ADD
+        else:
+            action = SearchIndexUpdate.VARIABLES
+        coalesced[action][note_id] = note_updates
+    return coalesced
+
+
+def _retry_later(note_updates):
+    """ Push failed updates back with exponential backoff. """
+    attempts = max(u.attempts for u in note_updates)
+    delay = min(2 ** attempts, INDEX_MAX_BACKOFF_MINUTES)
+    SearchIndexUpdate.objects.filter(id__in=[u.id for u in note_updates])\
+        .update(attempts=F('attempts') + 1,
+                next_attempt_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=delay))
+
+
+def _chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
+@task(name="process_search_index_queue", time_limit=INDEX_QUEUE_TIME_LIMIT)
+def process_search_index_queue():
+    """
+    Send queued note changes to the search index in bulk. Repeated changes to the
+    same note are coalesced into one. Changes that fail are left in the
+    queue and retried with backoff. Runs which overlap one still going
+    return straight away, so that no change is sent twice.
+    """
+    if not cache.add(INDEX_QUEUE_LOCK_KEY, True, INDEX_QUEUE_TIME_LIMIT):
+        logger.info("Search index queue is already being processed")
+        return
+    try:
+        _process_search_index_queue()
+    finally:
+        cache.delete(INDEX_QUEUE_LOCK_KEY)
+
+
+def _process_search_index_queue():
+    now = datetime.datetime.utcnow()
+    updates = list(SearchIndexUpdate.objects.filter(next_attempt_at__lte=now)[:INDEX_QUEUE_BATCH])
+    if not updates:
+        return
+
+    coalesced = _coalesce(updates)
+    done = []
+    failed = []
+    index = get_search_index()
+
+    # Whole documents
+    pending = coalesced[SearchIndexUpdate.ADD]
+    notes = Note.objects.filter(id__in=pending.keys()).select_related('course')
+    found = set()
+    for batch in _chunks(list(notes), INDEX_DOCUMENTS_PER_REQUEST):
+        try:
+            refused = set(index.add_notes(batch))
+        except Exception:
+            logger.error("Error with search index:\n" + traceback.format_exc())
+            refused = set(note.id for note in batch)
+        for note in batch:
+            found.add(note.id)
+            if note.id in refused:
+                failed.append(pending[note.id])
+            else:
+                done.extend(pending[note.id])
+    # Notes deleted since being queued have nothing left to add.
+    for note_id in set(pending) - found:
+        done.extend(pending[note_id])
+
+    # Thanks counts only
+    pending = coalesced[SearchIndexUpdate.VARIABLES]
+    thanks = dict(Note.objects.filter(id__in=pending.keys()).values_list('id', 'thanks'))
+    # A thanks count cannot go before the document it belongs to. Those of
+    # notes whose whole document is still queued, waiting to be retried or
+    # beyond this batch, stay queued and are sent with it.
+    unsent = set(SearchIndexUpdate.objects.filter(note_id__in=pending.keys(),
+                                                  action=SearchIndexUpdate.ADD)
+                                          .values_list('note_id', flat=True))
+    for note_id, note_updates in pending.iteritems():
+        if note_id in unsent:
+            continue
+        if note_id not in thanks:
+            done.extend(note_updates)
+            continue
+        try:
+            index.update_thanks(note_id, thanks[note_id])
+        except Exception:
+            logger.error("Error with search index:\n" + traceback.format_exc())
+            failed.append(note_updates)
+        else:
+            done.extend(note_updates)
+
+    # Removals
+    pending = coalesced[SearchIndexUpdate.REMOVE]
+    for batch in _chunks(pending.keys(), INDEX_DOCUMENTS_PER_REQUEST):
+        try:
+            index.remove_notes(batch)
+        except Exception:
+            logger.error("Error with search index:\n" + traceback.format_exc())
+            failed.extend(pending[note_id] for note_id in batch)
+        else:
+            for note_id in batch:
+                done.extend(pending[note_id])
+
+    SearchIndexUpdate.objects.filter(id__in=[u.id for u in done]).delete()
+    for note_updates in failed:
+        _retry_later(note_updates)
+
+    logger.info("Sent {d} queued index changes, {f} notes will be retried".format(
+        d=len(done), f=len(failed)))
@@ -3,6 +3,7 @@
 # Copyright (C) 2014  FinalsClub Foundation
 import string
 from django import template
+from karmaworld.apps.notes.models import NotePermissions
 
 register = template.Library()
 
@@ -24,15 +25,15 @@ def keyvalue(dict, key):
 
 
 @register.filter()
-def can_edit(user,note):
-    return note.allows_edit_by(user)
+def can_edit(request,note):
+    return NotePermissions.for_request(request).can_edit(note)
 
 
 @register.filter()
-def can_tag(user,note):
-    return note.allows_tags_by(user)
+def can_tag(request,note):
+    return NotePermissions.for_request(request).can_tag(note)
 
 
 @register.filter()
-def can_del(user,note):
-    return note.allows_delete_by(user)
+def can_del(request,note):
+    return NotePermissions.for_request(request).can_delete(note)
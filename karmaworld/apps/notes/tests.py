@@ -2,13 +2,28 @@
 # -*- coding:utf8 -*-
 # Copyright (C) 2012  FinalsClub Foundation
 import re
+import os
+import shutil
 import datetime
-from django.test import TestCase
+import tempfile
+
+import mock
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase, Client
+from django.test.client import RequestFactory
 from bs4 import BeautifulSoup
-from karmaworld.apps.notes.search import SearchIndex
+from karmaworld.apps.notes.search import SearchIndex, LocalSearchIndex, prefetch_tags
 
-from karmaworld.apps.notes.models import Note, NoteMarkdown
+from django.contrib.auth.models import User
+from karmaworld.apps.notes.models import Note, NoteMarkdown, NotePermissions
+from karmaworld.apps.notes.models import SearchIndexUpdate
+from karmaworld.apps.notes.models import ConversionCache
+from karmaworld.apps.notes.tasks import process_search_index_queue
+from karmaworld.apps.notes.tasks import INDEX_QUEUE_LOCK_KEY
+from karmaworld.apps.notes.gdrive import index_document
 from karmaworld.apps.notes import sanitizer
+from karmaworld.apps.notes import pdfconvert
 from karmaworld.apps.courses.models import Course
 from karmaworld.apps.courses.models import School
 
@@ -102,6 +117,351 @@ class TestNotes(TestCase):
             <a href="http://google.com" target="_blank" rel="nofollow">That guy</a>
         """)
 
+    def test_unchanged_html_is_not_sanitized_again(self):
+        rich = NoteMarkdown(note=self.note, html="<h1 class='obtrusive'>Something</h1>")
+        rich.save()
+        self.assertTrue(rich.is_sanitized())
+        self.assertEqual(rich.sanitizer_version, sanitizer.SANITIZER_VERSION)
+
+        # saving it unchanged does not run the sanitizer
+        calls = []
+        def counting(html):
+            calls.append(html)
+            return html
+        editable, formatted = sanitizer.sanitize_html_to_editable, \
+                              sanitizer.sanitize_html_preserve_formatting
+        sanitizer.sanitize_html_to_editable = counting
+        sanitizer.sanitize_html_preserve_formatting = counting
+        try:
+            clean = rich.html
+            rich.save()
+            self.assertEqual(calls, [])
+            rich.html = clean + u'<p>More</p>'
+            rich.save()
+            self.assertEqual(len(calls), 1)
+        finally:
+            sanitizer.sanitize_html_to_editable = editable
+            sanitizer.sanitize_html_preserve_formatting = formatted
+
+        # html sanitized by an older sanitizer is sanitized again
+        NoteMarkdown.objects.filter(note=self.note).update(
+            html=u"<h1 class='obtrusive'>Something</h1>", sanitizer_version=0)
+        stale = NoteMarkdown.objects.get(note=self.note)
+        self.assertFalse(stale.is_sanitized())
+        stale.save()
+        self.assertHTMLEqual(stale.html, clean)
+
+
+class TestSearchIndexQueue(TestCase):
+
+    def setUp(self):
+        self.school = School(name='Marshall College')
+        self.school.save()
+        self.course = Course(school=self.school, name=u'Archaeology 101')
+        self.course.save()
+        self.note = Note(course=self.course, name=u"Lecture notes",
+                         text="This is the plaintext version of a note.")
+        self.note.save()
+
+    def queued(self):
+        return list(SearchIndexUpdate.objects.values_list('note_id', 'action'))
+
+    def test_saves_are_queued(self):
+        self.assertEqual(self.queued(), [(self.note.id, SearchIndexUpdate.ADD)])
+
+        self.note.thanks += 1
+        self.note.save()
+        self.assertEqual(self.queued()[-1], (self.note.id, SearchIndexUpdate.VARIABLES))
+
+        note_id = self.note.id
+        self.note.delete()
+        self.assertEqual(self.queued()[-1], (note_id, SearchIndexUpdate.REMOVE))
+
+    def test_changes_are_tracked_from_load(self):
+        note = Note.objects.get(id=self.note.id)
+        note.thanks += 1
+        note.save()
+        self.assertEqual(self.queued()[-1], (self.note.id, SearchIndexUpdate.VARIABLES))
+
+        note.name = u"Lecture notes, revised"
+        note.save()
+        self.assertEqual(self.queued()[-1], (self.note.id, SearchIndexUpdate.ADD))
+
+        # nothing changed since the last save
+        count = len(self.queued())
+        note.save()
+        self.assertEqual(len(self.queued()), count)
+
+    def test_indexed_note_keeps_later_changes_queued(self):
+        first = SearchIndexUpdate.objects.get()
+        note = Note.objects.get(id=self.note.id)
+
+        def add_notes(notes):
+            # the note changes while it is being sent
+            note.name = u"Lecture notes, revised"
+            note.save()
+            return []
+
+        with mock.patch('karmaworld.apps.notes.gdrive.get_search_index') as get_search_index:
+            get_search_index.return_value.add_notes.side_effect = add_notes
+            index_document({'note_id': self.note.id, 'artifacts': {}}, None)
+        self.assertEqual(self.queued(), [(self.note.id, SearchIndexUpdate.ADD)])
+        self.assertGreater(SearchIndexUpdate.objects.get().id, first.id)
+
+    def test_deferred_fields_are_not_changes(self):
+        note = Note.objects.defer('text', 'course').get(id=self.note.id)
+        # read after loading, not changed
+        note.text
+        note.thanks += 1
+        note.save()
+        self.assertEqual(self.queued()[-1], (self.note.id, SearchIndexUpdate.VARIABLES))
+        course = Course.objects.get(id=self.course.id)
+        self.assertEqual((course.file_count, course.thank_count), (1, 1))
+
+    def test_queue_is_drained(self):
+        self.note.thanks += 1
+        self.note.save()
+        process_search_index_queue()
+        self.assertEqual(self.queued(), [])
+
+    def test_one_run_at_a_time(self):
+        cache.add(INDEX_QUEUE_LOCK_KEY, True)
+        try:
+            process_search_index_queue()
+        finally:
+            cache.delete(INDEX_QUEUE_LOCK_KEY)
+        self.assertEqual(self.queued(), [(self.note.id, SearchIndexUpdate.ADD)])
+
+    def test_thanks_wait_for_the_document(self):
+        # the document is waiting to be retried
+        SearchIndexUpdate.objects.update(
+            next_attempt_at=datetime.datetime.utcnow() + datetime.timedelta(minutes=5))
+        self.note.thanks += 1
+        self.note.save()
+        process_search_index_queue()
+        self.assertEqual(self.queued(), [(self.note.id, SearchIndexUpdate.ADD),
+                                         (self.note.id, SearchIndexUpdate.VARIABLES)])
+
+
+class TestNoteCounts(TestCase):
+
+    def setUp(self):
+        self.school = School(name='Marshall College')
+        self.school.save()
+        self.course = Course(school=self.school, name=u'Archaeology 101')
+        self.course.save()
+        self.other_course = Course(school=self.school, name=u'Geology 101')
+        self.other_course.save()
+
+    def counts(self):
+        course = Course.objects.get(id=self.course.id)
+        other_course = Course.objects.get(id=self.other_course.id)
+        school = School.objects.get(id=self.school.id)
+        return (course.file_count, course.thank_count,
+                other_course.file_count, other_course.thank_count, school.file_count)
+
+    def test_counts_follow_notes(self):
+        note = Note(course=self.course, name=u"Lecture notes", thanks=2)
+        note.save()
+        self.assertEqual(self.counts(), (1, 2, 0, 0, 1))
+
+        note.thanks = 3
+        note.save()
+        self.assertEqual(self.counts(), (1, 3, 0, 0, 1))
+
+        note.course = self.other_course
+        note.save()
+        self.assertEqual(self.counts(), (0, 0, 1, 3, 1))
+
+        note.is_hidden = True
+        note.save()
+        self.assertEqual(self.counts(), (0, 0, 0, 0, 0))
+
+        note.is_hidden = False
+        note.save()
+        Note.objects.get(id=note.id).delete()
+        self.assertEqual(self.counts(), (0, 0, 0, 0, 0))
+
+
+class TestConversionCache(TestCase):
+
+    def test_lookup(self):
+        sha256 = '0' * 64
+        self.assertIsNone(ConversionCache.lookup(sha256, 'text/plain'))
+        ConversionCache.store(sha256, 'text/plain', text=u'Syllabus', html=u'<p>Syllabus</p>')
+
+        # converted as another type, the same bytes give different output
+        self.assertIsNone(ConversionCache.lookup(sha256, 'text/html'))
+        cached = ConversionCache.lookup(sha256, 'text/plain')
+        self.assertEqual(cached.html, u'<p>Syllabus</p>')
+        ConversionCache.lookup(sha256, 'text/plain')
+        self.assertEqual(ConversionCache.objects.get(id=cached.id).hits, 2)
+
+
+class TestThankNote(TestCase):
+
+    def setUp(self):
+        self.school = School(name='Marshall College')
+        self.school.save()
+        self.course = Course(school=self.school, name=u'Archaeology 101')
+        self.course.save()
+        self.note = Note(course=self.course, name=u"Lecture notes",
+                         text="This is the plaintext version of a note.")
+        self.note.save()
+
+        self.user = User(username='Alice')
+        self.user.set_password('password')
+        self.user.save()
+        self.client = Client()
+        self.client.login(username='Alice', password='password')
+
+    def test_thank(self):
+        response = self.client.post(reverse('thank_note', args=[self.note.id]),
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 204)
+
+        self.assertEqual(Note.objects.get(id=self.note.id).thanks, 1)
+        self.assertEqual(Course.objects.get(id=self.course.id).thank_count, 1)
+        self.assertIn(self.note, self.user.get_profile().thanked_notes.all())
+        self.assertEqual(list(SearchIndexUpdate.objects.values_list('action', flat=True))[-1],
+                         SearchIndexUpdate.VARIABLES)
+
+
+class TestLocalSearchIndex(TestCase):
+
+    def setUp(self):
+        self.school = School(name='Marshall College')
+        self.school.save()
+        self.course = Course(school=self.school, name=u'Archaeology 101')
+        self.course.save()
+        self.other_course = Course(school=self.school, name=u'Geology 101')
+        self.other_course.save()
+
+        self.in_text = Note(course=self.course, name=u"Week one", thanks=5,
+                            text=u"Bring a trowel <script> to every dig.")
+        self.in_text.save()
+        self.in_name = Note(course=self.course, name=u"Trowel technique",
+                            text=u"Hold the trowel at an angle.")
+        self.in_name.save()
+        self.elsewhere = Note(course=self.other_course, name=u"Rocks",
+                              text=u"A trowel is not a rock hammer.")
+        self.elsewhere.save()
+
+        self.index = LocalSearchIndex()
+        self.index.add_notes([self.in_text, self.in_name, self.elsewhere])
+
+    def test_search(self):
+        results = self.index.search(u'trowel', self.course.id)
+        self.assertEqual(results.ordered_ids, [self.in_name.id, self.in_text.id])
+        self.assertFalse(results.has_more)
+
+        snippet = results.snippet_dict[self.in_text.id]
+        self.assertIn(u'<b>trowel</b>', snippet)
+        self.assertNotIn(u'<script>', snippet)
+
+        results = self.index.search(u'trowel')
+        self.assertEqual(set(results.ordered_ids),
+                         set([self.in_text.id, self.in_name.id, self.elsewhere.id]))
+        self.assertEqual(self.index.search(u'trowel hammer').ordered_ids, [self.elsewhere.id])
+
+    def test_remove(self):
+        self.index.remove_note(self.in_name)
+        results = self.index.search(u'trowel', self.course.id)
+        self.assertEqual(results.ordered_ids, [self.in_text.id])
+
+    def test_prefetched_tags(self):
+        self.in_name.tags.add('excavation')
+        self.elsewhere.tags.add('excavation', 'geology')
+        notes = list(Note.objects.filter(id__in=[self.in_name.id, self.elsewhere.id])
+                                 .order_by('id').only('id', 'name', 'text', 'course', 'uploaded_at', 'thanks'))
+        with self.assertNumQueries(1):
+            prefetch_tags(notes)
+        with self.assertNumQueries(0):
+            fields = [SearchIndex._note_to_dict(note) for note in notes]
+        self.assertEqual(fields[0]['tags'], 'excavation')
+        self.assertEqual(sorted(fields[1]['tags'].split()), ['excavation', 'geology'])
+        self.assertEqual(fields[1]['course_id'], self.other_course.id)
+
+        self.index.add_notes(notes)
+        self.assertEqual(self.index.search(u'geology').ordered_ids, [self.elsewhere.id])
+
+
+class TestNotePermissions(TestCase):
+
+    def setUp(self):
+        self.school = School(name='Marshall College')
+        self.school.save()
+        self.course = Course(school=self.school, name=u'Archaeology 101')
+        self.course.save()
+
+        self.owner = User(username='Alice')
+        self.owner.save()
+        self.stranger = User(username='Bob')
+        self.stranger.save()
+        self.staff = User(username='Carol', is_staff=True)
+        self.staff.save()
+
+        self.notes = []
+        for i in range(5):
+            note = Note(course=self.course, name=u"Note {0}".format(i),
+                        category=Note.LECTURE_NOTES, user=self.owner)
+            note.save()
+            self.notes.append(note)
+
+    def test_policies(self):
+        note = self.notes[0]
+        self.assertTrue(NotePermissions(self.owner).can_delete(note))
+        self.assertFalse(NotePermissions(self.owner).can_tag(note))
+        self.assertFalse(NotePermissions(self.stranger).can_delete(note))
+        self.assertTrue(NotePermissions(self.staff).can_edit(note))
+
+        profile = self.owner.get_profile()
+        profile.points = NotePermissions.TAG_POINTS
+        profile.save()
+        self.assertTrue(NotePermissions(self.owner).can_edit(note))
+
+    def test_one_lookup_per_request(self):
+        """ Checking many notes looks the profile up once per request. """
+        request = RequestFactory().get('/')
+        request.user = User.objects.get(pk=self.owner.pk)
+        with self.assertNumQueries(1):
+            for note in self.notes:
+                NotePermissions.for_request(request).can_delete(note)
+                NotePermissions.for_request(request).can_tag(note)
+                NotePermissions.for_request(request).can_edit(note)
+        self.assertFalse(NotePermissions.for_request(request).can_tag(self.notes[0]))
+
+        # points earned since show up in the next request, for the same user
+        profile = self.owner.get_profile()
+        profile.points = NotePermissions.TAG_POINTS
+        profile.save()
+        user = request.user
+        request = RequestFactory().get('/')
+        request.user = user
+        self.assertTrue(NotePermissions.for_request(request).can_tag(self.notes[0]))
+
+
+class TestPdfConvert(TestCase):
+    def test_join_pages(self):
+        """ Split pages are put back into the page container in order """
+        work_dir = tempfile.mkdtemp()
+        try:
+            html_path = os.path.join(work_dir, 'document.html')
+            with open(html_path, 'w') as html:
+                html.write('<body><div id="page-container">\n</div></body>')
+            for page in (1, 2):
+                with open(os.path.join(work_dir, pdfconvert.PAGE_FILENAME % page), 'w') as page_file:
+                    page_file.write('<div class="pf">{0}</div>'.format(page))
+
+            joined = tempfile.TemporaryFile()
+            pdfconvert._join_pages(work_dir, html_path, joined)
+            joined.seek(0)
+            self.assertEqual(joined.read(), '<body><div id="page-container">'
+                             '<div class="pf">1</div><div class="pf">2</div>\n</div></body>')
+        finally:
+            shutil.rmtree(work_dir)
+
+
 class TestSanitizeToEditable(TestCase):
     def test_clean(self):
         dirty = """
@@ -128,6 +488,25 @@ class TestSanitizeToEditable(TestCase):
             <h3>This should show up</h3>
         """)
 
+    def test_uploaded_html_in_one_pass(self):
+        """ sanitize_uploaded_html matches the separate sanitizers """
+        dirty = """
+            <script>unsafe</script>
+            <style>html {background-color: pink !important;}</style>
+            <h1 class='obtrusive' style='color: red'>Something</h1>
+            <a href='javascript:alert("Oh no")'>This stuff</a>
+            <a href='http://google.com'>That guy</a>
+            <!-- comment -->
+        """
+        self.assertHTMLEqual(sanitizer.sanitize_uploaded_html(dirty, True),
+                             sanitizer.sanitize_html_to_editable(dirty))
+        self.assertHTMLEqual(sanitizer.sanitize_uploaded_html(dirty, False),
+                             sanitizer.sanitize_html_preserve_formatting(dirty))
+
+        canonicalized = sanitizer.sanitize_uploaded_html(dirty, True, "http://example.com")
+        link = BeautifulSoup(canonicalized).find('link')
+        self.assertEqual(link['href'], "http://example.com")
+
     def test_canonical_rel(self):
         html = """<h1>Hey there!</h1>"""
         canonicalized = sanitizer.set_canonical_rel(html, "http://example.com")
@@ -142,6 +521,74 @@ class TestSanitizeToEditable(TestCase):
         html = '<img src="data:application/pdf;base64,blergh">'
         self.assertHTMLEqual(sanitizer.sanitize_html_to_editable(html), "<img/>")
 
+# Markup for comparing the sanitizer engines. Badly nested markup is left
+# out, as html5lib and libxml2 repair it differently.
+SANITIZER_CORPUS = [
+    """<script>unsafe</script><style>html {background-color: pink !important;}</style>
+       <h1 class='obtrusive' style='color: red; position: fixed'>Something</h1>
+       <h2>OK</h2> &amp; &rdquo;
+       <a href='javascript:alert("Oh no")'>This stuff</a>
+       <a href='http://google.com' onclick='steal()'>That guy</a>
+       <section><h3>This should show up</h3></section>""",
+    "text before <b>bold <i>both</i></b> after <!-- comment --> end",
+    "<table><tbody><tr><td>cell</td></tr></tbody></table><ul><li>one<li>two</ul>",
+    "<p>para<p>second <br> line<img src='http://example.com/b.png' width=3 alt='x'></p>",
+    "<div><script>var a = '<p>not html</p>';</script>kept</div>",
+    "<a href='  JaVaScRiPt:alert(1)'>x</a><a href='mailto:a@example.com'>m</a><a href='/r'>r</a>",
+    "<span style=\"background: url('http://example.com/x.png'); color: blue\">s</span>",
+    "<iframe src='http://example.com'></iframe><object>o</object><form><input value=1>f</form>",
+    u"unicode \xe9\u4e2d &lt;tag&gt; &nbsp;",
+    """<div class="pf w0 h0" style="left:1px"><div class="t m0 x0 h1">Lecture
+       <span class="_ _0">text</span></div></div>""",
+    # a whole document, as pdf2htmlEX writes them
+    """<!DOCTYPE html>
+       <html xmlns="http://www.w3.org/1999/xhtml">
+       <head>
+       <meta charset="utf-8"/>
+       <meta name="generator" content="pdf2htmlEX"/>
+       <style type="text/css">
+       .ff0{font-family:sans-serif;visibility:hidden;}
+       @font-face{font-family:ff1;src:url('fonts/f1.woff')format("woff");}.ff1{font-family:ff1;line-height:0.91;}
+       .m0{transform:matrix(0.25,0,0,0.25,0,0);}
+       </style>
+       <style type="text/css">
+       @media print{.pf{margin:0;box-shadow:none;page-break-after:always;}}
+       </style>
+       <script>try{ pdf2htmlEX.defaultViewer = new pdf2htmlEX.Viewer({}); }catch(e){}</script>
+       <title>Lecture 3 &amp; <b>notes</b></title>
+       </head>
+       <body>
+       <div id="sidebar"><div id="outline"></div></div>
+       <div id="page-container"><div id="pf1" class="pf w0 h0" data-page-no="1">
+       <div class="pc pc1 w0 h0"><img class="bi x0 y0 w1 h1" alt="" src="bg1.png"/>
+       <div class="t m0 x1 h2 y1 ff1 fs0 fc0">Lecture <span class="_ _0"></span>3</div></div>
+       <div class="pi" data-data='{"ctm":[1.0,0.0,0.0,1.0,0.0,0.0]}'></div></div></div>
+       </body>
+       </html>""",
+    "<p>a<textarea>x <b>y</b> &lt;i&gt;</textarea>b</p>",
+    "<select><option>one<b>x</b><option selected>two</select>after",
+    "<p>before<plaintext>some <b>raw</b> text",
+]
+
+
+class TestSanitizerEngines(TestCase):
+    def test_engines_agree(self):
+        for sanitize in (sanitizer.sanitize_html_to_editable,
+                         sanitizer.sanitize_html_preserve_formatting):
+            for html in SANITIZER_CORPUS:
+                with self.settings(SANITIZER_ENGINE='html5lib'):
+                    expected = sanitize(html)
+                with self.settings(SANITIZER_ENGINE='lxml'):
+                    self.assertHTMLEqual(sanitize(html), expected)
+
+    def test_lxml_canonical_rel(self):
+        with self.settings(SANITIZER_ENGINE='lxml'):
+            html = sanitizer.sanitize_uploaded_html("<h1>Hey there!</h1>", True,
+                                                    "http://example.com")
+        self.assertHTMLEqual(html, """<link rel='canonical' href='http://example.com'>
+                                      <h1>Hey there!</h1>""")
+
+
 class TestDataUriToS3(TestCase):
     def test_image_data_uri(self):
         html = '<img src="data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAUAAAAFCAYAAACNbyblAAAAHElEQVQI12P4//8/w38GIAXDIBKE0DHxgljNBAAO9TXL0Y4OHwAAAABJRU5ErkJggg==">'
@@ -167,3 +614,42 @@ class TestDataUriToS3(TestCase):
         # Ensure that cleaning is idempotent.
         self.assertHTMLEqual(s3ified,
                 sanitizer.sanitize_html_preserve_formatting(s3ified))
+
+    def test_data_uris_are_named_by_content(self):
+        image = "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAUAAAAFCAYAAACNbyblAAAAHElEQVQI12P4//8/w38GIAXDIBKE0DHxgljNBAAO9TXL0Y4OHwAAAABJRU5ErkJggg=="
+        font = "data:application/font-woff;base64,d09GRgABAAA="
+        html = '''<img src="{0}"><p><img width=5 src='{0}'></p>
+                  <style>@font-face {{ src: url('{1}'); }}</style>'''.format(image, font)
+        uploaded = []
+        upload = sanitizer._s3_upload_all
+        sanitizer._s3_upload_all = lambda files: uploaded.extend(files)
+        try:
+            clean = sanitizer.sanitize_uploaded_html(html, False)
+            # uploaded together once parsed, once each
+            self.assertEqual(len(uploaded), 2)
+            self.assertEqual(set(f[0] for f in uploaded),
+                             set(sanitizer._decode_data_uri(uri)[0] for uri in (image, font)))
+            self.assertNotIn('data:', clean)
+
+            # only what the sanitized document keeps is uploaded: editable
+            # documents have no styles
+            del uploaded[:]
+            sanitizer.sanitize_uploaded_html(html, True)
+            self.assertEqual([f[0] for f in uploaded], [sanitizer._decode_data_uri(image)[0]])
+            del uploaded[:]
+
+            # data URI's in text are left alone
+            text = '<p>Example markup: &lt;img src="data:image/png;base64,AAAAdGVzdA=="&gt;</p>'
+            self.assertHTMLEqual(sanitizer.sanitize_uploaded_html(text, True), text)
+            self.assertEqual(uploaded, [])
+        finally:
+            sanitizer._s3_upload_all = upload
+
+        filepath, mimetype, content = sanitizer._decode_data_uri(image)
+        self.assertTrue(re.match(r'^images/[0-9a-f]{64}\.png$', filepath), filepath)
+        self.assertEqual(mimetype, 'image/png')
+        self.assertEqual(filepath, sanitizer._decode_data_uri(image)[0])
+        self.assertTrue(sanitizer._decode_data_uri(font)[0].startswith('fonts/'))
+
+        with self.assertRaises(ValueError):
+            sanitizer._decode_data_uri("data:image/png;base64,d09GRgABAAA=")
@@ -26,8 +26,10 @@ from karmaworld.apps.notes.forms import NoteForm
 from karmaworld.apps.notes.forms import NoteDeleteForm
 from karmaworld.apps.notes.models import Note
 from karmaworld.apps.notes.models import NoteMarkdown
+from karmaworld.apps.notes.models import NotePermissions
+from karmaworld.apps.notes.models import SearchIndexUpdate
 from karmaworld.apps.notes.models import KEYWORD_MTURK_THRESHOLD
-from karmaworld.apps.notes.search import SearchIndex
+from karmaworld.apps.notes.search import get_search_index
 from karmaworld.apps.users.models import NoteKarmaEvent
 from karmaworld.apps.courses.forms import CourseForm
 from karmaworld.apps.quizzes.forms import KeywordForm
@@ -51,7 +53,7 @@ USER_PROFILE_FLAGS_FIELD = 'flagged_notes'
 def note_page_context_helper(note, request, context):
 
     if request.method == 'POST':
-        if not note.allows_edit_by(request.user):
+        if not NotePermissions.for_request(request).can_edit(note):
             # This user is Balrog. It. Shall. Not. Pass.
             return HttpResponseForbidden()
         # Only save tags if not forbidden above.
@@ -95,7 +97,7 @@ class NoteView(UpdateView):
     def form_valid(self, form):
         self.note = self.object
         # Ensure that the requesting user has permission to edit.
-        if self.note.allows_edit_by(self.request.user):
+        if NotePermissions.for_request(self.request).can_edit(self.note):
             return super(NoteView, self).form_valid(form)
         else:
             messages.error(self.request, 'Permission denied.')
@@ -134,7 +136,7 @@ class NoteDeleteView(FormView):
     def form_valid(self, form):
         self.note = Note.objects.get(id=form.cleaned_data['note'])
         # Ensure that the requesting user has permission to delete.
-        if self.note.allows_delete_by(self.request.user):
+        if NotePermissions.for_request(self.request).can_delete(self.note):
             self.note.is_hidden = True
             self.note.save()
             messages.success(self.request, 'The note "{0}" was deleted successfully.'.format(self.note.name))
@@ -254,7 +256,7 @@ class NoteSearchView(ListView):
             page = 0
 
         try:
-            index = SearchIndex()
+            index = get_search_index()
 
             if 'course_id' in self.request.GET:
                 raw_results = index.search(self.request.GET['query'],
@@ -265,7 +267,7 @@ class NoteSearchView(ListView):
                                             page=page)
 
         except Exception:
-            logger.error("Error with IndexDen:\n" + traceback.format_exc())
+            logger.error("Error with search index:\n" + traceback.format_exc())
             self.error = True
             return Note.objects.none()
         else:
@@ -311,6 +313,11 @@ class NoteSearchView(ListView):
 
 
 def process_note_thank_events(request_user, note):
+    # The note was not saved, so pass the new thanks on ourselves
+    if not note.is_hidden:
+        Course.change_note_counts(note.course_id, 0, 1)
+    SearchIndexUpdate.enqueue(note.id, SearchIndexUpdate.VARIABLES)
+
     # Give points to the person who uploaded this note
     if note.user != request_user and note.user:
         NoteKarmaEvent.create_event(note.user, note, NoteKarmaEvent.THANKS)
@@ -318,7 +325,7 @@ def process_note_thank_events(request_user, note):
     # If note thanks exceeds a threshold, create a Mechanical
     # Turk task to get some keywords for it
     if note.thanks == KEYWORD_MTURK_THRESHOLD:
-        submit_extract_keywords_hit.delay(note)
+        submit_extract_keywords_hit.delay(note.id)
 
 
 def thank_note(request, pk):
@@ -359,8 +366,11 @@ def edit_note_tags(request, pk):
     Saves the posted string of tags
     """
     note = Note.objects.get(pk=pk)
-    if request.method == "POST" and request.is_ajax() and note.allows_tags_by(request.user):
+    if request.method == "POST" and request.is_ajax() and \
+       NotePermissions.for_request(request).can_tag(note):
         note.tags.set(request.body)
+        # tags are not Note fields, so saving would not notice the change
+        SearchIndexUpdate.enqueue(note.id, SearchIndexUpdate.ADD)
 
         note_json = serializers.serialize('json', [note,])
         resp = json.loads(note_json)[0]
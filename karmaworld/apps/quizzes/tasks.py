@@ -17,6 +17,7 @@ from celery.utils.log import get_task_logger
 from boto.mturk.connection import MTurkConnection
 from django.contrib.sites.models import Site
 from karmaworld.apps.notes.models import Document
+from karmaworld.apps.notes.models import Note
 from karmaworld.apps.quizzes.models import Keyword, KeywordExtractionHIT, EmailParsingHIT
 from django.conf import settings
 import requests
@@ -103,14 +104,24 @@ def run_mturk(whence):
         return MTURK_HOST
 
 @task(name='submit_extract_keywords_hit')
-def submit_extract_keywords_hit(note):
+def submit_extract_keywords_hit(note_id):
     """Create a Mechanical Turk HIT that asks a worker to
-    choose keywords and definitions from the given note."""
+    choose keywords and definitions from the note with the given id."""
 
     MTURK_HOST = run_mturk('submit_extract_keywords_hit')
     if not MTURK_HOST:
         return
 
+    # The note id is the idempotency key: a message delivered twice must
+    # not pay for two HITs.
+    if KeywordExtractionHIT.objects.filter(note_id=note_id).exists():
+        logger.info('Note {0} already has a keywords HIT'.format(note_id))
+        return
+
+    # the note text is not needed, only its course and url
+    note = Note.objects.select_related('course__school', 'course__department__school') \
+                       .defer('text').get(id=note_id)
+
     connection = MTurkConnection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY,
                                  host=MTURK_HOST)
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from django.middleware.transaction import transaction
+
+from karmaworld.apps.users.models import UserProfile
+from karmaworld.apps.users.models import ALL_KARMA_EVENT_CLASSES
+
+
+class Command(BaseCommand):
+    args = '[verify]'
+    help = """Rebuild UserProfile.points from the karma event tables.
+        If the optional 'verify' argument is given, only report the profiles
+        whose running total disagrees with their events; nothing is written."""
+
+    def handle(self, *args, **kwargs):
+        verify_only = 'verify' in args
+
+        # One GROUP BY per event table.
+        totals = defaultdict(int)
+        for cls in ALL_KARMA_EVENT_CLASSES:
+            sums = cls.objects.values('user_id').annotate(total=Sum('points'))
+            for row in sums:
+                totals[row['user_id']] += row['total'] or 0
+
+        drifted = []
+        for user_id, points in UserProfile.objects.values_list('user_id', 'points').iterator():
+            expected = totals.get(user_id, 0)
+            if points != expected:
+                drifted.append((user_id, points, expected))
+
+        for user_id, points, expected in drifted:
+            self.stdout.write('user {0}: has {1} points, events total {2}\n'.format(
+                user_id, points, expected))
+
+        if not verify_only:
+            with transaction.commit_on_success():
+                for user_id, points, expected in drifted:
+                    UserProfile.objects.filter(user_id=user_id).update(points=expected)
+
+        self.stdout.write('{0} of {1} profiles {2}\n'.format(
+            len(drifted), UserProfile.objects.count(),
+            'have drifted' if verify_only else 'were corrected'))
@@ -5,8 +5,8 @@ import logging
 import datetime
 from allauth.account.signals import email_confirmed
 from django.contrib.auth.models import User
-from django.db.models import Sum
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 from django.db import models, DatabaseError
 from django.middleware.transaction import transaction
@@ -27,18 +27,16 @@ class UserProfile(models.Model):
     flagged_notes = models.ManyToManyField('notes.Note', related_name='users_flagged', blank=True, null=True)
     flagged_courses = models.ManyToManyField('courses.Course', related_name='users_flagged', blank=True, null=True)
     school = models.ForeignKey(School, blank=True, null=True)
+    # Running total of the points of every karma event belonging to this user.
+    # Maintained by BaseKarmaEvent.record() and debit_karma_event(), rebuilt
+    # by the rebuild_karma_points management command.
+    points = models.IntegerField(default=0)
 
     def natural_key(self):
         return (self.user,)
 
     def get_points(self):
-        sum = 0
-        for cls in ALL_KARMA_EVENT_CLASSES:
-            points = cls.objects.filter(user=self.user).aggregate(Sum('points'))['points__sum']
-            if points:
-                sum += points
-
-        return sum
+        return self.points
 
     def get_id(self):
         return self.user.id
@@ -119,6 +117,18 @@ class BaseKarmaEvent(models.Model):
     def get_message(self):
         raise NotImplemented()
 
+    @classmethod
+    def record(cls, **kwargs):
+        """
+        Create an event of this class and credit its points to the user's
+        UserProfile.points in the same transaction.
+        """
+        with transaction.commit_on_success():
+            event = cls.objects.create(**kwargs)
+            UserProfile.objects.filter(user_id=event.user_id)\
+                               .update(points=F('points') + event.points)
+        return event
+
 
 class GenericKarmaEvent(BaseKarmaEvent):
     NONE = 'none'
@@ -141,11 +151,10 @@ class GenericKarmaEvent(BaseKarmaEvent):
 
     @staticmethod
     def create_event(user, message, type):
-        event = GenericKarmaEvent.objects.create(user=user,
-                                                 points=GenericKarmaEvent.POINTS[type],
-                                                 event_type=type,
-                                                 message=message)
-        event.save()
+        GenericKarmaEvent.record(user=user,
+                                 points=GenericKarmaEvent.POINTS[type],
+                                 event_type=type,
+                                 message=message)
 
     def get_message(self):
         if self.event_type == self.NONE:
@@ -199,11 +208,10 @@ class NoteKarmaEvent(BaseKarmaEvent):
 
     @staticmethod
     def create_event(user, note, type):
-        event = NoteKarmaEvent.objects.create(user=user,
-                                      note=note,
-                                      points=NoteKarmaEvent.POINTS[type],
-                                      event_type=type)
-        event.save()
+        NoteKarmaEvent.record(user=user,
+                              note=note,
+                              points=NoteKarmaEvent.POINTS[type],
+                              event_type=type)
 
 
 class CourseKarmaEvent(BaseKarmaEvent):
@@ -226,16 +234,28 @@ class CourseKarmaEvent(BaseKarmaEvent):
 
     @staticmethod
     def create_event(user, course, type):
-        event = CourseKarmaEvent.objects.create(user=user,
-                                      course=course,
-                                      points=CourseKarmaEvent.POINTS[type],
-                                      event_type=type)
-        event.save()
+        CourseKarmaEvent.record(user=user,
+                                course=course,
+                                points=CourseKarmaEvent.POINTS[type],
+                                event_type=type)
 
 
 ALL_KARMA_EVENT_CLASSES = (GenericKarmaEvent, NoteKarmaEvent, CourseKarmaEvent)
 
 
+def debit_karma_event(sender, instance, **kwargs):
+    """
+    Take the points of a deleted karma event (e.g. cascaded from a deleted
+    Note) back out of the user's running total.
+    """
+    UserProfile.objects.filter(user_id=instance.user_id)\
+                       .update(points=F('points') - instance.points)
+
+for cls in ALL_KARMA_EVENT_CLASSES:
+    post_delete.connect(debit_karma_event, sender=cls, weak=False,
+                        dispatch_uid='debit_karma_event_' + cls.__name__)
+
+
 def user_display_name(user):
     """Return the best way to display a user's
     name to them on the site."""
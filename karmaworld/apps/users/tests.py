@@ -14,6 +14,7 @@ from karmaworld.apps.courses.models import Course
 from karmaworld.apps.courses.models import School
 from karmaworld.apps.notes.views import thank_note, flag_note, downloaded_note
 from karmaworld.apps.users.models import NoteKarmaEvent, GenericKarmaEvent, CourseKarmaEvent, give_email_confirm_karma
+from karmaworld.apps.users.models import UserProfile
 
 
 class TestUsers(TestCase):
@@ -158,3 +159,23 @@ class TestUsers(TestCase):
             GenericKarmaEvent.objects.get(event_type=GenericKarmaEvent.EMAIL_CONFIRMED, user=self.user1)
         except ObjectDoesNotExist:
             self.fail("Karma event not created")
+
+    def test_points_ledger(self):
+        """UserProfile.points follows karma events as they are created and deleted"""
+        thank_note(self.request2, self.note.pk)
+        downloaded_note(self.request2, self.note.pk)
+        profile1 = UserProfile.objects.get(user=self.user1)
+        profile2 = UserProfile.objects.get(user=self.user2)
+        self.assertEqual(profile1.get_points(),
+                         NoteKarmaEvent.POINTS[NoteKarmaEvent.THANKS] +
+                         NoteKarmaEvent.POINTS[NoteKarmaEvent.HAD_NOTE_DOWNLOADED])
+        self.assertEqual(profile2.get_points(),
+                         NoteKarmaEvent.POINTS[NoteKarmaEvent.DOWNLOADED_NOTE])
+
+        # Deleting the note cascades to its karma events.
+        self.note.delete()
+        profile1 = UserProfile.objects.get(user=self.user1)
+        profile2 = UserProfile.objects.get(user=self.user2)
+        self.assertEqual(profile1.get_points(),
+                         GenericKarmaEvent.POINTS[GenericKarmaEvent.NOTE_DELETED])
+        self.assertEqual(profile2.get_points(), 0)
@@ -14,6 +14,9 @@ $(function() {
     return rowContents.html();
   }
 
+  // where the page after the last one drawn starts
+  var nextPage = null;
+
   // load dataTable for course data
   var dataTable = $('#data_table_list').dataTable({
     // we will set column widths explicitly
@@ -41,7 +44,19 @@ $(function() {
     'processing': true,
     'serverSide': true,
     'ajax': function(data, callback, settings) {
+        // When moving to the next page with the same search and sort,
+        // let the server continue from the last row instead of skipping
+        // over all the previous pages.
+        var query = JSON.stringify([data.search, data.order]);
+        if (nextPage && nextPage.query === query && nextPage.start === data.start) {
+          data.after = nextPage.cursor;
+        }
         $.get(course_list_ajax_url, data, function(dataWrapper, textStatus, jqXHR) {
+          nextPage = {
+            query: query,
+            start: data.start + data.length,
+            cursor: dataWrapper.next_cursor
+          };
           for (i = 0; i < dataWrapper.data.length; i++) {
             dataWrapper.data[i][0] = tableRow(dataWrapper.data[i][0]);
           }
@@ -29,75 +29,136 @@ makeFileForm = function(upFile) {
   $('#save-btn').show();
 }
 
-var uploaded_files = new Array();
-
 $(function(){
   // these are obsolete without the drag-drop widget that we removed from the partial above
   // var $dropzone = $('#filepicker_dropzone');
   var $dropzone_result = $('#filepicker_dropzone_result');
 
-  $('#save-btn').on('click', function(e){
+  var save_files = function(e){
     e.stopPropagation();
-    $(this).unbind('click');
-    $(this).addClass('disabled');
+    $('#save-btn').unbind('click');
+    $('#save-btn').addClass('disabled');
 
     var saveIcon = $('#save-btn-icon');
     saveIcon.removeClass('fa-save');
     saveIcon.addClass('fa-spinner fa-spin');
+    $('#forms_container .upload-errors').empty().hide();
 
-    $('#forms_container .inline-form').each(function(i,el){
-        var name, tags, fpurl, course;
-        name = $(el).find('.intext').val();
-        fp_file = $(el).find('.fpurl').val();
-        tags = $(el).find('.taggit-tags').val();
-        category = $(el).find('.category').val();
-        course = $(el).find('.course_id').val();
+    // Send every file in one request
+    var files = [];
+    var csrf;
+    var forms = $('#forms_container .inline-form');
+    forms.each(function(i,el){
         csrf = $(el).find('.csrf').val();
-        email = $('#id_email').val();
-        mimetype = $(el).find('.mimetype').val();
-
-        $.post(upload_post_url, {
-          'name': name,
-          'fp_file': fp_file,
-          'tags': tags,
-          'category': category,
-          'course': course,
-          'csrfmiddlewaretoken': csrf,
-          'mimetype': mimetype,
-          'email': email
-        }, function(data){
-          if (data === 'success') {
-            // For multiple uploads, we may end up clearing and re-
-            //  writing this multiple times, but show the same list
-            //  each time.
-            $('#uploaded_files').empty();
-            for (var i=0; i < uploaded_files.length; i++) {
-              $('#uploaded_files').append($('<li>', {text: uploaded_files[i]}));
-            }
-            $('#thank-points').html(uploaded_files.length*5);
-            $('#success').show();
-            $('#save-btn').hide();
-            $('#filepicker_row').hide();
-            $('#forms_container .inline-form').remove();
-            $('#forms_container').hide();
-            if (document.location.host === 'www.karmanotes.org' ||
-              document.location.host === 'karmanotes.org') {
-              _gat._getTracker()._trackEvent('upload', 'upload form submitted');
-            }
-            if (user_is_authenicated) {
-              setTimeout(function(){
-                location.reload(true);
-              }, 20000);
-            }
-          }
+        files.push({
+          'name': $(el).find('.intext').val(),
+          'fp_file': $(el).find('.fpurl').val(),
+          'tags': $(el).find('.taggit-tags').val(),
+          'category': $(el).find('.category').val(),
+          'course': $(el).find('.course_id').val(),
+          'mimetype': $(el).find('.mimetype').val()
         });
-        // Add the name we've just uploaded to the list
-        uploaded_files.push(name);
     });
-  });
+
+    $.ajax({
+      url: upload_batch_post_url,
+      type: 'POST',
+      contentType: 'application/json',
+      data: JSON.stringify(files),
+      headers: {'X-CSRFToken': csrf},
+      success: function(data){
+        if (data.status === 'success') {
+          $('#uploaded_files').empty();
+          for (var i=0; i < files.length; i++) {
+            $('#uploaded_files').append($('<li>', {text: files[i].name}));
+          }
+          $('#thank-points').html(files.length*5);
+          $('#success').show();
+          $('#save-btn').hide();
+          $('#filepicker_row').hide();
+          $('#forms_container .inline-form').remove();
+          $('#forms_container').hide();
+          if (document.location.host === 'www.karmanotes.org' ||
+            document.location.host === 'karmanotes.org') {
+            _gat._getTracker()._trackEvent('upload', 'upload form submitted');
+          }
+          if (user_is_authenicated) {
+            // show the new notes once they have all been converted
+            follow_uploads(data.raw_documents, function(){
+              location.reload(true);
+            });
+          }
+        }
+      },
+      error: function(xhr){
+        var data = {};
+        try {
+          data = $.parseJSON(xhr.responseText) || {};
+        } catch (err) {}
+        if (data.errors) {
+          // errors of each file, by its position in the upload
+          $.each(data.errors, function(i, fields){
+            var messages = [];
+            $.each(fields, function(field, field_errors){
+              messages = messages.concat(field_errors);
+            });
+            forms.eq(parseInt(i, 10)).find('.upload-errors').text(messages.join(' ')).show();
+          });
+        } else {
+          forms.find('.upload-errors').first()
+               .text(data.message || 'The upload failed, please try again.').show();
+        }
+        // let the files be saved again
+        saveIcon.removeClass('fa-spinner fa-spin');
+        saveIcon.addClass('fa-save');
+        $('#save-btn').removeClass('disabled');
+        $('#save-btn').on('click', save_files);
+      }
+    });
+  };
+
+  $('#save-btn').on('click', save_files);
 
 });
 
+// seconds to wait before asking again after a status request failed
+var UPLOAD_STATUS_RETRY = 3;
+
+/*
+ *  call finished once every upload with one of the given RawDocument ids
+ *  is converted or has failed, following server-sent events where the
+ *  browser has them and long-polling otherwise
+ */
+var follow_uploads = function(ids, finished) {
+  var query = 'ids=' + ids.join(',');
+  if (window.EventSource) {
+    var source = new EventSource(upload_status_stream_url + '?' + query);
+    source.addEventListener('finished', function(){
+      source.close();
+      finished();
+    });
+    return;
+  }
+
+  var poll = function(since) {
+    $.ajax({
+      url: upload_status_url + '?' + query + '&since=' + since,
+      dataType: 'json',
+      success: function(data){
+        if (data.finished) {
+          finished();
+        } else {
+          poll(data.since);
+        }
+      },
+      error: function(){
+        setTimeout(function(){ poll(since); }, UPLOAD_STATUS_RETRY * 1000);
+      }
+    });
+  };
+  poll(0);
+};
+
 var got_file = function(event){
   $('#filepicker_dropzone_result').text(event);
   for (var i=0; i < event.fpfiles.length; i++){
@@ -329,6 +329,41 @@ CELERY_TASK_RESULT_EXPIRES = timedelta(minutes=30)
 setup_loader()
 
 CELERY_DEFAULT_QUEUE = os.environ['CELERY_QUEUE_NAME']
+
+# Tasks take ids and other plain values rather than model instances, so
+# messages are compact JSON and workers load current rows themselves.
+# See: http://docs.celeryproject.org/en/latest/configuration.html#celery-task-serializer
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_ACCEPT_CONTENT = ['json']
+
+# Tasks are routed to queues by kind, and each queue has its own workers
+# (see Procfile), so a burst of conversions does not hold up indexing or
+# periodic tasks. Document conversion stages that wait on Google Drive or
+# pdf2htmlEX get queues of their own, as they are the slowest.
+CONVERSION_QUEUE = CELERY_DEFAULT_QUEUE + '_conversion'
+CONVERSION_DRIVE_QUEUE = CELERY_DEFAULT_QUEUE + '_drive'
+CONVERSION_RENDER_QUEUE = CELERY_DEFAULT_QUEUE + '_render'
+INDEXING_QUEUE = CELERY_DEFAULT_QUEUE + '_indexing'
+MTURK_QUEUE = CELERY_DEFAULT_QUEUE + '_mturk'
+SOCIAL_QUEUE = CELERY_DEFAULT_QUEUE + '_social'
+MAINTENANCE_QUEUE = CELERY_DEFAULT_QUEUE + '_maintenance'
+CELERY_ROUTES = {
+    'process_upload_batch': {'queue': CONVERSION_QUEUE},
+    'conversion_fetch': {'queue': CONVERSION_DRIVE_QUEUE},
+    'conversion_convert': {'queue': CONVERSION_DRIVE_QUEUE},
+    'conversion_extract': {'queue': CONVERSION_DRIVE_QUEUE},
+    'conversion_render': {'queue': CONVERSION_RENDER_QUEUE},
+    'conversion_sanitize': {'queue': CONVERSION_QUEUE},
+    'conversion_persist': {'queue': CONVERSION_QUEUE},
+    'conversion_index': {'queue': INDEXING_QUEUE},
+    'process_search_index_queue': {'queue': INDEXING_QUEUE},
+    'submit_extract_keywords_hit': {'queue': MTURK_QUEUE},
+    'get_extract_keywords_results': {'queue': MTURK_QUEUE},
+    'check_notes_mailbox': {'queue': MTURK_QUEUE},
+    'tweet_note': {'queue': SOCIAL_QUEUE},
+    'fix_note_counts': {'queue': MAINTENANCE_QUEUE},
+}
 ########## END CELERY CONFIGURATION
 
 
@@ -393,6 +428,24 @@ AJAX_SELECT_BOOTSTRAP = False
 ########## END AJAX SELECTS CONFIGURATION
 
 
+########## SEARCH CONFIGURATION
+# Dotted path to the note search backend: IndexDen, or
+# karmaworld.apps.notes.search.LocalSearchIndex to search the database. The
+# local index starts out empty; fill it with "manage.py populate_indexden
+# bulk" before switching to it.
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND',
+                                'karmaworld.apps.notes.search.SearchIndex')
+########## END SEARCH CONFIGURATION
+
+
+########## SANITIZER CONFIGURATION
+# Parser used to sanitize note HTML: 'html5lib', or 'lxml' which applies the
+# same whitelists but is much faster. They may repair badly nested markup
+# differently.
+SANITIZER_ENGINE = os.environ.get('SANITIZER_ENGINE', 'html5lib')
+########## END SANITIZER CONFIGURATION
+
+
 ########## TESTING CONFIGURATION
 TESTING = 'test' in sys.argv
 ########## END TESTING CONFIGURATION
@@ -46,10 +46,14 @@ except:
 
 ########## CACHE CONFIGURATION
 # See: https://docs.djangoproject.com/en/dev/ref/settings/#caches
+# Web and worker processes talk through the cache (upload statuses, claims
+# on conversion stages), so they must all use the same memcached servers:
+# a memcached local to each dyno would keep their writes apart.
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
-        'LOCATION': '127.0.0.1:11211'
+        # semicolon separated host:port list
+        'LOCATION': environ.get('MEMCACHE_SERVERS', '127.0.0.1:11211')
     }
 }
 ########## END CACHE CONFIGURATION
@@ -59,20 +63,22 @@ CACHES = {
 # See: http://docs.celeryproject.org/en/latest/configuration.html#broker-transport
 BROKER_TRANSPORT = 'amqplib'
 
-# Set this number to the amount of allowed concurrent connections on your AMQP
-# provider, divided by the amount of active workers you have.
+# Each process, web or worker, keeps up to this many connections open for
+# publishing tasks and reuses them, rather than connecting for every
+# .delay(). Keep it small: every gunicorn worker and every celery worker
+# process counts against the AMQP provider's connection limit, so the
+# total is roughly (web processes + worker processes) * BROKER_POOL_LIMIT
+# plus one consuming connection per celery worker.
 #
 # For example, if you have the 'Little Lemur' CloudAMQP plan (their free tier),
-# they allow 3 concurrent connections. So if you run a single worker, you'd
-# want this number to be 3. If you had 3 workers running, you'd lower this
-# number to 1, since 3 workers each maintaining one open connection = 3
-# connections total.
+# they allow 3 concurrent connections. Setting this to 0 opens and closes a
+# connection for every message instead, which stays under such a limit at
+# the cost of a connection handshake per task.
 #
 # See: http://docs.celeryproject.org/en/latest/configuration.html#broker-pool-limit
 # See: https://github.com/FinalsClub/karmaworld/issues/392
 # See: http://stackoverflow.com/questions/23249850/celery-cloudamqp-creates-new-connection-for-each-task
-# Basically, the broker pool causes too many connections!
-BROKER_POOL_LIMIT = 0
+BROKER_POOL_LIMIT = int(environ.get('BROKER_POOL_LIMIT', 1))
 
 # See: http://docs.celeryproject.org/en/latest/configuration.html#broker-connection-max-retries
 #BROKER_CONNECTION_MAX_RETRIES = 0
@@ -97,6 +103,10 @@ CELERYBEAT_SCHEDULE = {
         'task': 'fix_note_counts',
         'schedule': timedelta(days=1),
     },
+    'process-search-index-queue': {
+        'task': 'process_search_index_queue',
+        'schedule': timedelta(minutes=1),
+    },
 }
 
 CELERY_TIMEZONE = 'UTC'
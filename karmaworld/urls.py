@@ -17,6 +17,10 @@ from karmaworld.apps.notes.views import NoteView, thank_note, NoteSearchView, fl
     NoteKeywordsView, NoteQuizView, NoteDeleteView
 from karmaworld.apps.moderation import moderator
 from karmaworld.apps.document_upload.views import save_fp_upload
+from karmaworld.apps.document_upload.views import save_fp_upload_batch
+from karmaworld.apps.document_upload.views import upload_batch_status
+from karmaworld.apps.document_upload.views import upload_status
+from karmaworld.apps.document_upload.views import upload_status_stream
 from karmaworld.apps.quizzes.views import set_delete_keyword_annotator, get_keywords_annotator
 from karmaworld.apps.users.views import ProfileView
 
@@ -65,6 +69,11 @@ urlpatterns = patterns('',
 
     # Filepicker upload
     url(r'^api/upload$', save_fp_upload, name='upload_post'),
+    url(r'^api/upload/batch$', save_fp_upload_batch, name='upload_batch_post'),
+    url(r'^api/upload/batch/(?P<upload_batch>[0-9a-f]{32})$', upload_batch_status,
+        name='upload_batch_status'),
+    url(r'^api/upload/status$', upload_status, name='upload_status'),
+    url(r'^api/upload/status/stream$', upload_status_stream, name='upload_status_stream'),
 
     # ---- JSON views ----#
     # return json list of courses for a given school
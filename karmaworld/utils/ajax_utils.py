@@ -1,5 +1,7 @@
 import json
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
+from django.db.models import F
 from django.http import HttpResponseBadRequest, HttpResponseNotFound, HttpResponse
 
 
@@ -40,18 +42,25 @@ def ajax_pk_base(cls, request, pk, event_processor):
 
 
 def ajax_increment(cls, request, pk, field, user_profile_field=None, event_processor=None):
+    """
+    Add one to a counter field of obj. The counter is incremented in the
+    database rather than saving the whole object, so concurrent requests
+    cannot lose each other's counts and no save signals fire.
+    event_processor is responsible for any effects of the new count.
+    """
     def ajax_increment_work(request_user, obj):
-        count = getattr(obj, field)
-        setattr(obj, field,  count+1)
-        obj.save()
+        with transaction.commit_on_success():
+            cls.objects.filter(pk=obj.pk).update(**{field: F(field) + 1})
+            # The row stays locked by the update until commit, so this
+            # reads exactly the value this request produced.
+            setattr(obj, field, cls.objects.filter(pk=obj.pk).values_list(field, flat=True)[0])
 
-        if event_processor:
-            event_processor(request.user, obj)
+            # Record that user has performed this, to prevent
+            # them from doing it again
+            if user_profile_field:
+                getattr(request_user.get_profile(), user_profile_field).add(obj)
 
-        # Record that user has performed this, to prevent
-        # them from doing it again
-        if user_profile_field:
-            getattr(request_user.get_profile(), user_profile_field).add(obj)
-            obj.save()
+        if event_processor:
+            event_processor(request_user, obj)
 
     return ajax_pk_base(cls, request, pk, ajax_increment_work)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding:utf8 -*-
+# Copyright (C) 2015  FinalsClub Foundation
+"""
+Write objects, readable by everyone, to the s3 bucket.
+
+Each object is written with a single PUT, which sets the canned ACL as it
+goes, rather than checking for the key, uploading, checking again and then
+setting the ACL. Connections are pooled and reused across calls.
+"""
+
+import Queue
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from boto.exception import S3ResponseError
+from boto.s3.connection import S3Connection
+from django.conf import settings
+
+# Same grants as the owner full control and AllUsers read of the ACL which
+# used to be set on every object in a second request.
+PUBLIC_READ = 'public-read'
+
+# put_many() writes this many objects at once.
+UPLOAD_THREADS = 8
+
+# bucket connections not in use by any thread
+_idle_buckets = Queue.Queue()
+
+
+@contextmanager
+def bucket_connection():
+    """
+    Check out a connection to the bucket, reusing an idle one if there is
+    one. boto connections must not be shared between threads, so each is
+    used by one thread at a time.
+    """
+    try:
+        bucket = _idle_buckets.get_nowait()
+    except Queue.Empty:
+        connection = S3Connection(settings.AWS_ACCESS_KEY_ID, settings.AWS_SECRET_ACCESS_KEY)
+        bucket = connection.get_bucket(settings.AWS_STORAGE_BUCKET_NAME, validate=False)
+    yield bucket
+    # connections which raised are not reused
+    _idle_buckets.put(bucket)
+
+
+def s3_url(filepath):
+    """ Absolute url of filepath in the bucket """
+    parts = [settings.S3_URL, filepath]
+    if parts[0].startswith("//"):
+        # Fully resolve the URL as https for happiness in all things. ॐ
+        parts.insert(0, "https:")
+    return "".join(parts)
+
+
+def exists(filepath):
+    with bucket_connection() as bucket:
+        return bucket.get_key(filepath) is not None
+
+
+def put(filepath, mimetype, data, headers=None, overwrite=True):
+    """
+    Write data to filepath, readable by everyone. Unless overwrite, the PUT
+    is conditional and nothing is written if filepath already exists.
+    Returns whether data was written.
+    """
+    headers = dict(headers or {})
+    headers['Content-Type'] = mimetype
+    if not overwrite:
+        headers['If-None-Match'] = '*'
+    with bucket_connection() as bucket:
+        try:
+            bucket.new_key(filepath).set_contents_from_string(data, headers=headers,
+                                                              policy=PUBLIC_READ)
+        except S3ResponseError, e:
+            if e.status != 412:
+                raise
+            # Precondition Failed: it is already there
+            return False
+    return True
+
+
+def put_many(files, overwrite=True):
+    """
+    put() every (filepath, mimetype, data) of files, several at a time.
+    Returns whether each was written, in order.
+    """
+    files = list(files)
+    if not files:
+        return []
+    pool = ThreadPool(min(UPLOAD_THREADS, len(files)))
+    try:
+        return pool.map(lambda f: put(*f, overwrite=overwrite), files)
+    finally:
+        pool.close()
+        pool.join()